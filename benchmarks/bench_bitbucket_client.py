@@ -0,0 +1,105 @@
+"""
+Compare the Bitbucket clients under concurrency, against a local fake Bitbucket answering every
+request after `latency` ms:
+- atlassian: the previous implementation, atlassian-python-api (requests) run on the default thread
+  pool with run_async, one Cloud session per user
+- bitbucket_api: the async client, sharing one connection pool across the users
+
+Each round fetches a branch `requests` times, with at most `concurrency` requests in flight, spread
+over 8 users (as the watchers and the API do).
+
+    python benchmarks/bench_bitbucket_client.py [requests] [latency ms]
+
+The atlassian client needs atlassian-python-api (pip install -e .[bench]).
+"""
+import asyncio
+import sys
+import time
+
+from aiohttp import web
+
+from devops_console.sccs.plugins.bitbucket_api import Bitbucket, close_connections
+from devops_console.sccs.utils.aioify import run_async
+
+USERS = 8
+BRANCH = {
+    "name": "master",
+    "target": {
+        "hash": "0123456789abcdef0123456789abcdef01234567",
+        "date": "2022-11-01T12:00:00+00:00",
+        "author": {"raw": "Some Developer <dev@example.com>", "user": {"display_name": "Some Developer"}},
+        },
+    }
+
+
+async def fake_bitbucket(latency: float) -> tuple[web.AppRunner, str]:
+    async def branch(request: web.Request):
+        await asyncio.sleep(latency)
+        return web.json_response(BRANCH)
+
+    app = web.Application()
+    app.router.add_get("/{path:.*}", branch)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0, backlog=1024)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/"
+
+
+def atlassian_client(url: str):
+    from atlassian.bitbucket import Cloud
+
+    sessions = [Cloud(url=url, username=f"user-{i}", password="secret", cloud=True) for i in range(USERS)]
+
+    async def get(i: int, path: str):
+        return await run_async(sessions[i % USERS].get, path)
+
+    return get
+
+
+def async_client(url: str):
+    sessions = [Bitbucket(f"user-{i}", "secret", url=f"{url}2.0/") for i in range(USERS)]
+
+    async def get(i: int, path: str):
+        return await sessions[i % USERS].get(path)
+
+    return get
+
+
+async def run(get, n: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with semaphore:
+            branch = await get(i, "repositories/team/repo/refs/branches/master")
+            assert branch["name"] == "master"
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(n)))
+    return time.perf_counter() - start
+
+
+async def main(n: int = 1000, latency_ms: int = 50):
+    runner, url = await fake_bitbucket(latency_ms / 1000)
+    clients = [("bitbucket_api", async_client(url))]
+    try:
+        clients.insert(0, ("atlassian", atlassian_client(url)))
+    except ImportError:
+        print("atlassian-python-api isn't installed: only the async client is measured")
+
+    print(f"{'client':<16}{'concurrency':>12}{'requests':>10}{'seconds':>10}{'req/s':>10}")
+    try:
+        for name, get in clients:
+            await run(get, USERS, USERS)  # connect
+            for concurrency in (1, 16, 64, 256):
+                count = n if concurrency > 1 else max(1, n // 20)
+                elapsed = await run(get, count, concurrency)
+                print(f"{name:<16}{concurrency:>12}{count:>10}{elapsed:>10.2f}{count / elapsed:>10.0f}")
+    finally:
+        await close_connections()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*(int(arg) for arg in sys.argv[1:])))
@@ -0,0 +1,71 @@
+"""
+Compare the cache codecs on typical cached values: encode/decode time and size in bytes.
+
+    python benchmarks/bench_codec.py
+"""
+import timeit
+
+from devops_console.sccs.codec import PickleCodec, VersionedCodec
+from devops_console.sccs.redis import CacheEntry
+from devops_console.sccs.typing.cd import Available, EnvironmentConfig
+from devops_console.sccs.typing.repositories import Repository
+
+values = {
+    "repositories (400)": CacheEntry(
+        value=[
+            Repository(
+                key=i,
+                name=f"some-service-{i}",
+                slug=f"some-service-{i}",
+                url=f"https://bitbucket.org/croixbleue/some-service-{i}",
+                permission="write",
+                )
+            for i in range(400)
+            ],
+        stale_at=0.0,
+        delta=1.0,
+        ),
+    "cd config (5 envs)": CacheEntry(
+        value=[
+            EnvironmentConfig(
+                key=i,
+                environment=env,
+                version="0123456789abcdef0123456789abcdef01234567",
+                author="Some Developer",
+                date="2022-11-01T12:00:00+00:00",
+                pullrequest=None,
+                )
+            for i, env in enumerate(["master", "development", "qa", "acceptation", "production"])
+            ],
+        stale_at=0.0,
+        delta=1.0,
+        ),
+    "versions available (2000)": CacheEntry(
+        value=[
+            Available(key=i, build=str(i), version="0123456789abcdef0123456789abcdef01234567")
+            for i in range(2000)
+            ],
+        stale_at=0.0,
+        delta=1.0,
+        ),
+    }
+
+codecs = {
+    "pickle": PickleCodec(),
+    "versioned": VersionedCodec(compression=None),
+    "versioned+compression": VersionedCodec(),
+    }
+
+
+def main(number=50):
+    print(f"{'value':<28}{'codec':<24}{'bytes':>10}{'encode µs':>12}{'decode µs':>12}")
+    for value_name, value in values.items():
+        for codec_name, codec in codecs.items():
+            data = codec.encode(value)
+            encode = timeit.timeit(lambda: codec.encode(value), number=number) / number * 1e6
+            decode = timeit.timeit(lambda: codec.decode(data), number=number) / number * 1e6
+            print(f"{value_name:<28}{codec_name:<24}{len(data):>10}{encode:>12.0f}{decode:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
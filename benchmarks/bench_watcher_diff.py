@@ -0,0 +1,85 @@
+"""
+Compare the watcher diffs on a versions-available list (10k builds by default), against fakeredis:
+- list: the previous implementation, the whole list cached under one key and the items matched with
+  a linear search
+- snapshot: realtime.snapshot, items indexed by key, compared by fingerprint, only the changed ones
+  written to a redis hash
+
+Each poll changes 1% of the items, adds 10 and removes 10.
+
+    python benchmarks/bench_watcher_diff.py [items]
+"""
+import asyncio
+import sys
+import time
+
+import fakeredis.aioredis
+
+from devops_console.sccs.realtime.snapshot import Snapshot
+from devops_console.sccs.redis import RedisCache
+from devops_console.sccs.typing import WatcherType
+from devops_console.sccs.typing.cd import Available
+from devops_console.sccs.typing.event import Event, EventType
+
+_sentinel = object()
+
+cache = RedisCache()
+
+
+def versions(n: int, poll: int) -> list[WatcherType]:
+    builds = range(poll * 10, n + poll * 10)
+    return [
+        WatcherType(
+            key=build,
+            data=Available(
+                key=build, build=str(build), version=f"{build * (poll + 1 if build % 100 == 0 else 1):040x}"
+                ).dict(),
+            )
+        for build in builds
+        ]
+
+
+async def list_diff(key: str, values: list[WatcherType]) -> list[Event]:
+    """Watcher.poll before the snapshots."""
+    events = []
+    cached_values = await cache.get_async(key, [])
+    keys_to_delete = set(v.key for v in cached_values) - set(v.key for v in values)
+    for k in keys_to_delete:
+        value = next((v for v in cached_values if v.key == k), None)
+        events.append(Event(_type=EventType.DELETED, value=value, key=k))
+    for value in values:
+        cache_value = next((v for v in cached_values if v.key == value.key), _sentinel)
+        if cache_value is _sentinel:
+            _type = EventType.ADDED
+        elif cache_value != value:
+            _type = EventType.MODIFIED
+        else:
+            continue
+        events.append(Event(key=value.key, _type=_type, value=value))
+    await cache.set_async(key, values)
+    return events
+
+
+async def main(n: int = 10_000, polls: int = 3):
+    cache.aredis = fakeredis.aioredis.FakeRedis()
+    cache._is_initialized = True
+    cache.local.max_entries = 0  # measure the redis round trips
+    snapshot = Snapshot("bench:{versions}")
+    inputs = [versions(n, poll) for poll in range(polls + 1)]
+
+    print(f"{'diff':<12}{'items':>8}{'poll ms':>12}{'events':>10}")
+    for name, diff in (
+            ("list", lambda values: list_diff("bench:versions", values)),
+            ("snapshot", snapshot.update),
+            ):
+        await diff(inputs[0])
+        elapsed, events = 0.0, 0
+        for values in inputs[1:]:
+            start = time.perf_counter()
+            events += len(await diff(values))
+            elapsed += time.perf_counter() - start
+        print(f"{name:<12}{n:>8}{elapsed / polls * 1000:>12.0f}{events // polls:>10}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*map(int, sys.argv[1:])))
@@ -44,6 +44,8 @@ async def wscom_dispatcher(
     environment = body.get("environment")
     environments = body.get("environments", [])
     kwargs = body.get("args") or {}
+    # sequence number of the last event received, to resume a watch (see Watcher.replay)
+    since = body.get("since")
 
     if action == "read":
         if path == "/repositories":
@@ -76,6 +78,7 @@ async def wscom_dispatcher(
                 Intervals.repositories,
                 send_stream,
                 cancel_event,
+                since=since,
                 )
         elif path == "/repository/cd/config":
             await client.watch_continuous_deployment_config(
@@ -86,6 +89,7 @@ async def wscom_dispatcher(
                 cancel_event,
                 repo_slug,
                 environments,
+                since=since,
                 )
         elif path == "/repository/cd/versions_available":
             await client.watch_continuous_deployment_versions_available(
@@ -95,6 +99,7 @@ async def wscom_dispatcher(
                 send_stream,
                 cancel_event,
                 repo_slug,
+                since=since,
                 )
         elif path == "/repository/cd/environments_available":
             await client.watch_continuous_deployment_environments_available(
@@ -104,6 +109,7 @@ async def wscom_dispatcher(
                 send_stream,
                 cancel_event,
                 repo_slug,
+                since=since,
                 )
         return
     elif action == "write":
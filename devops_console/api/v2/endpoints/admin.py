@@ -4,9 +4,13 @@ from fastapi import APIRouter, HTTPException, Body
 from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
 
+from devops_console.clients import CoreClient
 from devops_console.utils import crypto
 from devops_console.sccs.plugins.cache_keys import cache_key_fns
-from devops_console.sccs.redis import RedisCache
+from devops_console.sccs.metrics import metrics
+from devops_console.sccs.realtime.polling import poller
+from devops_console.sccs.redis import RedisCache, cache_stats
+from devops_console.sccs.warmup import WarmUpStatus
 
 cache = RedisCache()
 
@@ -15,7 +19,8 @@ router = APIRouter(prefix="/admin")
 
 @router.delete("/cache/clear")
 async def clear_cache(are_you_sure: bool = False):
-    """Deletes ALL keys in the cache."""
+    """Deletes all the application's keys in the cache. Keys outside of the cache prefix are left
+    untouched."""
 
     if not are_you_sure:
         raise HTTPException(
@@ -24,7 +29,7 @@ async def clear_cache(are_you_sure: bool = False):
             )
 
     try:
-        cache.clear()
+        await cache.clear_async()
         return {"message": "Cache cleared"}
     except Exception as e:
         return HTTPException(status_code=500, detail=str(e))
@@ -53,7 +58,7 @@ async def clear_cache_key(
         key = function_name
 
     try:
-        n = cache.delete(key)
+        n = await cache.delete_async(key)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -68,7 +73,7 @@ async def clear_cache_namespace(namespace: str):
     """Clear all cache keys with the given namespace. """
 
     try:
-        n = cache.delete_namespace(namespace)
+        n = await cache.delete_namespace_async(namespace)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -78,6 +83,72 @@ async def clear_cache_namespace(namespace: str):
         raise HTTPException(status_code=404, detail=f"Cache namespace {namespace} not found")
 
 
+@router.delete("/cache/clear/by_tag/{tag:path}")
+async def clear_cache_tag(tag: str):
+    """Clear all cache keys registered under the given tag, e.g. "repo:<slug>", "fn:<function name>"
+    or "user:<id>"."""
+
+    try:
+        n = await cache.invalidate_tags_async(tag)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if n > 0:
+        return {"message": f"Cleared {n} keys tagged {tag}"}
+    else:
+        raise HTTPException(status_code=404, detail=f"Cache tag {tag} not found")
+
+
+@router.get("/cache/stats")
+async def get_cache_stats():
+    """Hits, misses and timings of each cached function since this replica started."""
+    return cache_stats()
+
+
+@router.get("/cache/memory")
+async def get_cache_memory(samples: int = 20):
+    """Estimated bytes stored in redis per cached function and namespace, largest first, with the
+    quota and accounted bytes of the budgets that have one. Sampled: `samples` entries of each."""
+    try:
+        return await cache.memory_report_async(samples)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/cache/pool")
+async def get_cache_pool():
+    """Connections of the redis pools of this replica, and the state of the cache circuit breaker."""
+    return {"pools": cache.pool_stats(), "breaker": cache.breaker.state, "degraded": cache.degraded}
+
+
+@router.get("/cache/metrics", response_class=PlainTextResponse)
+async def get_cache_metrics():
+    """Same as /cache/stats, in the Prometheus text format."""
+    cache.pool_stats()
+    return PlainTextResponse(metrics.to_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+@router.get("/cache/warmup")
+async def get_cache_warmup_status() -> WarmUpStatus:
+    """Progress of the current (or last) cache warm-up run on this replica."""
+    return CoreClient().warmup.status
+
+
+@router.post("/cache/warmup", status_code=202)
+async def start_cache_warmup() -> WarmUpStatus:
+    """Start a cache warm-up run in the background."""
+    warmup = CoreClient().warmup
+    if not warmup.trigger():
+        raise HTTPException(status_code=409, detail="A cache warm-up is already running")
+    return warmup.status
+
+
+@router.get("/watchers/polling")
+async def get_watchers_polling():
+    """Watchers polled by this replica, polls running and the tokens left in the poll budget."""
+    return poller.stats()
+
+
 @router.get("/security/key", response_class=PlainTextResponse)
 def get_public_key():
     """Returns a public key used to encrypt stuff on the client-side."""
@@ -5,12 +5,11 @@ from anyio import create_task_group
 from fastapi import APIRouter, HTTPException, Depends
 from loguru import logger
 from pydantic import BaseModel
-from requests import HTTPError
-from atlassian.bitbucket.cloud.workspaces import Projects
 
 from devops_console.api.v2.dependencies import CommonHeaders
 from devops_console.clients import CoreClient
 from devops_console.core import settings
+from devops_console.core.repository_collections import repository_collections
 from devops_console.schemas import WebhookSubscription
 from devops_console.schemas.sccs import (
     AddRepositoryContract,
@@ -22,9 +21,10 @@ from devops_console.schemas.sccs import (
     Project,
 )
 from devops_console.sccs.schemas.provision import AddRepositoryDefinition, TemplateParams
-from devops_console.sccs.errors import SccsException
+from devops_console.sccs.errors import BitbucketHTTPError, SccsException
 from devops_console.sccs.plugins.cache_keys import cache_key_fns
-from devops_console.sccs.redis import RedisCache
+from devops_console.sccs.redis import RedisCache, fn_tag
+from devops_console.sccs.warmup import record_repository_usage_async
 
 cache = RedisCache()
 
@@ -42,7 +42,6 @@ client_v2 = core.sccs_v2
 
 @router.get("/repository-collections")
 def get_repository_collections() -> dict[str, RepositoryCollection]:
-    global repository_collections
     return repository_collections
 
 
@@ -60,23 +59,23 @@ async def get_projects(
 
     result = []
     try:
-        projects: Projects = await client.get_projects(plugin_id=plugin_id, credentials=credentials)
+        projects: list[dict] = await client.get_projects(plugin_id=plugin_id, credentials=credentials)
         if projects is not None:
-            for project in projects.each():
+            for project in projects:
                 result.append(
                     Project(
-                        name=project.name,
-                        key=project.key,
-                        description=project.description,
-                        is_private=project.is_private,
-                        created_on=project.created_on,
-                        updated_on=project.updated_on,
+                        name=project["name"],
+                        key=project["key"],
+                        description=project.get("description"),
+                        is_private=project["is_private"],
+                        created_on=project["created_on"],
+                        updated_on=project["updated_on"],
                     )
                 )
 
         return result
-    except HTTPError as e:
-        raise HTTPException(status_code=e.response.status_code, detail=str(e))
+    except BitbucketHTTPError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
 
 
 # ------------------------------------------------------------------------------
@@ -85,21 +84,21 @@ async def get_projects(
 
 
 @router.get("/repositories")
-def get_repositories(
+async def get_repositories(
     common_headers: CommonHeaders = Depends(),
 ) -> list[RepositoryDescription]:
     try:
-        return client_v2.get_repositories(common_headers.credentials)
-    except HTTPError as e:
-        raise HTTPException(status_code=e.response.status_code, detail=str(e))
+        return await client_v2.get_repositories(common_headers.credentials)
+    except BitbucketHTTPError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
 
 
 @router.get("/repositories/{slug}")
-def get_repository(slug: str, common_headers: CommonHeaders = Depends()) -> RepositoryDescription:
+async def get_repository(slug: str, common_headers: CommonHeaders = Depends()) -> RepositoryDescription:
     try:
-        return client_v2.get_repository(common_headers.credentials, slug=slug)
-    except HTTPError as e:
-        raise HTTPException(status_code=e.response.status_code, detail=str(e))
+        return await client_v2.get_repository(common_headers.credentials, slug=slug)
+    except BitbucketHTTPError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
 
 
 class DeploymentStatusesResponse(BaseModel):
@@ -107,19 +106,20 @@ class DeploymentStatusesResponse(BaseModel):
 
 
 @router.get("/repositories/{slug}/cd")
-def get_deployment_statuses(
+async def get_deployment_statuses(
     slug: str, common_headers: CommonHeaders = Depends()
 ) -> DeploymentStatusesResponse:
+    await record_repository_usage_async(slug)
     try:
-        statuses = client_v2.get_deployment_statuses(
+        statuses = await client_v2.get_deployment_statuses(
             credentials=common_headers.credentials,
             slug=slug,
             accepted_environments=None,  # TODO add to route parameters
         )
 
         return DeploymentStatusesResponse(items=statuses)
-    except HTTPError as e:
-        raise HTTPException(status_code=e.response.status_code, detail=str(e))
+    except BitbucketHTTPError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
 
 
 class DeploymentVersionsResponse(BaseModel):
@@ -128,28 +128,28 @@ class DeploymentVersionsResponse(BaseModel):
 
 
 @router.get("/repositories/{slug}/cd/versions")
-def get_cd_versions(
+async def get_cd_versions(
     slug: str,
     top: str | None = None,
     common_headers: CommonHeaders = Depends(),
 ) -> DeploymentVersionsResponse:
     try:
-        commits = client_v2.get_versions(credentials=common_headers.credentials, slug=slug, top=top)
+        commits = await client_v2.get_versions(credentials=common_headers.credentials, slug=slug, top=top)
 
         return DeploymentVersionsResponse(done=len(commits) == 0, items=commits)
 
-    except HTTPError as e:
-        raise HTTPException(status_code=e.response.status_code, detail=str(e))
+    except BitbucketHTTPError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
 
 
 @router.get("/repositories/{slug}/cd/{environment}")
-def get_deployment_status(
+async def get_deployment_status(
     slug: str,
     environment: str,
     common_headers: CommonHeaders = Depends(),
 ) -> DeploymentStatus:
     try:
-        status = client_v2.get_deployment_status(
+        status = await client_v2.get_deployment_status(
             credentials=common_headers.credentials,
             slug=slug,
             environment=environment,
@@ -162,8 +162,8 @@ def get_deployment_status(
             )
 
         return status
-    except HTTPError as e:
-        raise HTTPException(status_code=e.response.status_code, detail=str(e))
+    except BitbucketHTTPError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
 
 
 @router.post("/repositories/{slug}/cd/{environment}/{version}")
@@ -186,10 +186,10 @@ async def trigger_cd(
         )
 
         # clear associated cache
-        cache.delete(cache_key_fns["get_continuous_deployment_config"](slug, []))
+        await cache.delete_async(cache_key_fns["get_continuous_deployment_config"](slug, []))
         # TODO clean this up; two functions only as long as we're in limbo between legacy
         # code and the FastAPI rewrite.
-        cache.delete(cache_key_fns["get_deployment_status"](slug=slug, environment=environment))
+        await cache.delete_async(cache_key_fns["get_deployment_status"](slug=slug, environment=environment))
 
         return TriggerCDReturnType(
             environment=res.environment,
@@ -199,8 +199,8 @@ async def trigger_cd(
             pullrequest=res.pullrequest,
             readonly=res.readonly,
         )
-    except HTTPError as e:
-        raise HTTPException(status_code=e.response.status_code, detail=str(e))
+    except BitbucketHTTPError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
 
 
 @router.get("/add-repository-contract", response_model=AddRepositoryContract)
@@ -212,8 +212,8 @@ async def get_add_repository_contract(
 
     try:
         return await client.get_add_repository_contract(plugin_id=plugin_id, credentials=credentials)
-    except HTTPError as e:
-        raise HTTPException(status_code=e.response.status_code, detail=str(e))
+    except BitbucketHTTPError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
 
 
 class AddRepositoryRequestBody(BaseModel):
@@ -245,10 +245,13 @@ async def add_repository(
         if not result:
             raise HTTPException(status_code=400, detail="Failed to create repository")
 
-        # clear the repositories cache
-        cache.delete_namespace("repositories")
-    except HTTPError as e:
-        raise HTTPException(status_code=e.response.status_code, detail=str(e))
+        # clear the repositories cache, of both the v1 and v2 clients
+        await cache.delete_async(
+            cache_key_fns["get_repository_catalog"](), cache_key_fns["v2:get_repository_catalog"]()
+        )
+        await cache.invalidate_tags_async(fn_tag("get_repository_permissions"))
+    except BitbucketHTTPError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
     except SccsException as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -308,24 +311,23 @@ async def verify_webhooks(
 
     target_url = sanitize_webhook_target_url(target_url)
 
-    result = []
-
-    async def verify(repo_slug):
-        try:
-            repo_subscriptions = await client.get_webhook_subscriptions(
-                plugin_id=plugin_id,
-                credentials=credentials,
-                repo_slug=repo_slug,
-            )
-            if not any(s["url"] == target_url for s in repo_subscriptions["values"]):
-                result.append(repo_slug)
-        except HTTPError as e:
-            logger.warning(f"Failed to get list of webhooks for {repo_slug}: {e}")
-            raise HTTPException(status_code=e.response.status_code, detail=str(e))
+    # cached subscriptions are read in a single round-trip, only the others are fetched
+    try:
+        subscriptions = await client.get_webhook_subscriptions_many(
+            plugin_id=plugin_id,
+            credentials=credentials,
+            repo_slugs=repositories,
+        )
+    except BitbucketHTTPError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
 
-    async with create_task_group() as tg:
-        for repo_slug in repositories:
-            tg.start_soon(verify, repo_slug)
+    result = []
+    for repo_slug in repositories:
+        if repo_slug not in subscriptions:
+            raise HTTPException(status_code=502, detail=f"Failed to get list of webhooks for {repo_slug}")
+        repo_subscriptions = subscriptions[repo_slug] or {"values": []}
+        if not any(s["url"] == target_url for s in repo_subscriptions["values"]):
+            result.append(repo_slug)
 
     return result
 
@@ -349,22 +351,19 @@ async def create_webhooks(
     # rate limit for webhooks is 1000 reqs/hour, so just keep that in mind if
     # testing this out (there are roughly 400 repos at the time of writing)
 
+    # get the list of webhooks of every repo at once
+    all_subscriptions = await _get_webhook_subscriptions_many(credentials, plugin_id, repos)
+
     async with create_task_group() as tg:
         for repo in repos:  # type: ignore
 
             async def _subscribe_if_not_set(repo):
-                # get list of webhooks for this repo
-                try:
-                    current_subscriptions = await client.get_webhook_subscriptions(
-                        plugin_id=plugin_id,
-                        credentials=credentials,
-                        repo_slug=repo.slug,
-                    )
-                except HTTPError as e:
-                    logger.warning(f"Failed to get webhook subscriptions for {repo.name}: {str(e)}")
+                if repo.slug not in all_subscriptions:
+                    logger.warning(f"Failed to get webhook subscriptions for {repo.name}.")
                     return
+                current_subscriptions = all_subscriptions[repo.slug]
                 if current_subscriptions is None:
-                    current_subscriptions = []
+                    current_subscriptions = {"values": []}
 
                 # check if the webhook is already set
                 if any(
@@ -391,7 +390,7 @@ async def create_webhooks(
                         description=settings.WEBHOOKS_DEFAULT_DESCRIPTION,
                     )
                     logger.info(f"Subscribed to default webhook for {repo.name}.")
-                except HTTPError as e:
+                except BitbucketHTTPError as e:
                     logger.warning(f"Failed to create webhook subscription for {repo.name}: {str(e)}")
                     return
                 if new_subscription is None or len(new_subscription) == 0:
@@ -422,19 +421,16 @@ async def remove_webhooks(
 
     repos = await _get_repositories(credentials, plugin_id, repo_list.repo_slugs)
 
+    all_subscriptions = await _get_webhook_subscriptions_many(credentials, plugin_id, repos)
+
     async with create_task_group() as tg:
         for repo in repos:  # type: ignore
 
             async def _remove_webhook(repo):
-                try:
-                    current_subscriptions = await client.get_webhook_subscriptions(
-                        plugin_id=plugin_id,
-                        credentials=credentials,
-                        repo_slug=repo.slug,
-                    )
-                except HTTPError as e:
-                    logger.warning(f"Failed to get webhook subscriptions for {repo.name}: {e.strerror}")
+                if repo.slug not in all_subscriptions:
+                    logger.warning(f"Failed to get webhook subscriptions for {repo.name}.")
                     return
+                current_subscriptions = all_subscriptions[repo.slug]
 
                 if current_subscriptions is None or len(current_subscriptions["values"]) == 0:
                     logger.info(f"No webhook subscriptions for {repo.name}.")
@@ -450,9 +446,9 @@ async def remove_webhooks(
                                 subscription_id=subscription["uuid"],
                             )
                             logger.info(f"Deleted webhook subscription for {repo.name}.")
-                        except HTTPError as e:
+                        except BitbucketHTTPError as e:
                             logger.warning(
-                                f"Failed to delete webhook subscription for {repo.name}: {e.strerror}"
+                                f"Failed to delete webhook subscription for {repo.name}: {e}"
                             )
                             continue
                     logger.debug(f"Webhook subscription for {repo.name} not found.")
@@ -460,6 +456,17 @@ async def remove_webhooks(
             tg.start_soon(_remove_webhook, repo)
 
 
+async def _get_webhook_subscriptions_many(credentials, plugin_id, repos) -> dict:
+    try:
+        return await client.get_webhook_subscriptions_many(
+            plugin_id=plugin_id,
+            credentials=credentials,
+            repo_slugs=[repo.slug for repo in repos],
+        )
+    except BitbucketHTTPError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+
 def sanitize_webhook_target_url(url):
     target_url = url if url is not None else urljoin(settings.WEBHOOKS_HOST, settings.WEBHOOKS_PATH)
     if settings.WEBHOOKS_PATH not in target_url:
@@ -489,7 +496,7 @@ async def _get_repositories(credentials, plugin_id, repositories):
             async with create_task_group() as tg:
                 for repo in repositories:
                     tg.start_soon(append_repo, repo)
-    except HTTPError as e:
+    except BitbucketHTTPError as e:
         logger.warning(f"Failed to get list of repositories: {e}")
         raise HTTPException(status_code=HTTPStatus.EXPECTATION_FAILED, detail=e)
     if result is None or len(result) == 0:
@@ -498,98 +505,3 @@ async def _get_repositories(credentials, plugin_id, repositories):
 
     return result
 
-
-repository_collections = {
-    "assistance": RepositoryCollection(
-        name="Assistance",
-        repositories=[
-            "assistance-integration-test",
-            "assistance-salesforce-edge-api",
-            "assistance-salesforce-event-listener",
-            "assistance-salesforce-system-api",
-            "fax-system-api",
-            "insured-eligibility-service",
-            "product-benefit-service",
-            "acocan-system-api",
-            "payment-service",
-            "holidays-service",
-        ],
-        environments=[
-            {"enabled": False, "name": "master"},
-            {"enabled": True, "name": "development"},
-            {"enabled": True, "name": "qa"},
-            {"enabled": True, "name": "acceptation"},
-            {"enabled": True, "name": "production"},
-        ],
-    ),
-    "healthcare": RepositoryCollection(
-        name="Healthcare Claims",
-        repositories=[
-            "healthcare-claims-edi-service",
-            "healthcare-claims-invoice-service",
-            "healthcare-claims-salesforce-event-listener",
-            "healthcare-claims-salesforce-system-api",
-            "healthcare-claims-service",
-            "document-fusion-service",
-            "transfert-service",
-            "sharepoint-system-api",
-            "healthcare-claims-integration-test",
-            "healthcare-claims-match-service",
-            "star-system-api",
-            "factcan-system-api",
-            "exchange-rate-service",
-            "healthcare-claims-report-service",
-        ],
-        environments=[
-            {"enabled": False, "name": "master"},
-            {"enabled": True, "name": "development"},
-            {"enabled": True, "name": "qa"},
-            {"enabled": True, "name": "acceptation"},
-            {"enabled": True, "name": "production"},
-        ],
-    ),
-    "reclamation": RepositoryCollection(
-        name="Réclamation Digitale",
-        repositories=[
-            "claims-travel-frontend-web",
-            "claims-travel-edge-api",
-            "claims-travel-orchestrator-system-api",
-            "salesforce-system-api",
-            "salesforce-edge-api",
-            "salesforce-event-listener",
-            "sharepoint-system-api",
-            "usermanager-system-api",
-            "star-edge-api",
-            "email-system-api",
-            "document-viewer",
-            "document-viewer-edge-api",
-            "salesforce-core",
-            "financial-institution-service",
-            "document-fusion-service",
-            "univers-system-api",
-            "sharepoint-edge-api",
-        ],
-        environments=[
-            {"enabled": True, "name": "master"},
-            {"enabled": False, "name": "development"},
-            {"enabled": True, "name": "qa"},
-            {"enabled": False, "name": "training"},
-            {"enabled": True, "name": "acceptation"},
-            {"enabled": True, "name": "production"},
-        ],
-    ),
-    "amf": RepositoryCollection(
-        name="Document Manage - AMF",
-        repositories=[
-            "document-manager-frontend-web",
-            "document-manager-edge-api",
-        ],
-        environments=[
-            {"name": "master", "enabled": False},
-            {"name": "development", "enabled": True},
-            {"name": "qa", "enabled": True},
-            {"name": "acceptation", "enabled": True},
-            {"name": "production", "enabled": True},
-        ],
-    ),
-}
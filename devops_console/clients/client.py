@@ -18,11 +18,18 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with devops-console-backend.  If not, see <https://www.gnu.org/licenses/>.
 
+from datetime import timedelta
+from functools import partial
+
 from .kubernetes import Kubernetes
 from .oauth2 import OAuth2
 from .sccs import Sccs
 from .sccs_v2 import SccsV2
 from ..core import settings
+from ..core.repository_collections import repository_collections
+from ..sccs.plugins.bitbucket_api import close_connections
+from ..sccs.redis import RedisCache, RedisOptions, split_nodes
+from ..sccs.warmup import Job, WarmUp, most_used_repositories
 from ..schemas import UserConfig
 
 
@@ -33,21 +40,89 @@ class CoreClient:
     sccs: Sccs
     kubernetes: Kubernetes
     oauth2: OAuth2
+    warmup: WarmUp
 
     def __new__(cls):
         if cls._instance is None:
             cls._instance = object.__new__(cls)
 
             cls.config = settings.userconfig
+            RedisCache().configure(
+                RedisOptions(
+                    mode=settings.REDIS_MODE,
+                    host=settings.REDIS_HOST,
+                    port=settings.REDIS_PORT,
+                    password=settings.REDIS_PASSWORD,
+                    sentinels=split_nodes(settings.REDIS_SENTINELS),
+                    sentinel_master=settings.REDIS_SENTINEL_MASTER,
+                    sentinel_password=settings.REDIS_SENTINEL_PASSWORD,
+                    cluster_nodes=split_nodes(settings.REDIS_CLUSTER_NODES),
+                    max_connections=settings.REDIS_MAX_CONNECTIONS,
+                    pool_timeout=settings.REDIS_POOL_TIMEOUT,
+                    socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+                    connect_timeout=settings.REDIS_CONNECT_TIMEOUT,
+                    health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+                    retries=settings.REDIS_RETRIES,
+                    retry_backoff_base=settings.REDIS_RETRY_BACKOFF_BASE,
+                    retry_backoff_cap=settings.REDIS_RETRY_BACKOFF_CAP,
+                    breaker_threshold=settings.CACHE_BREAKER_THRESHOLD,
+                    breaker_cooldown=settings.CACHE_BREAKER_COOLDOWN,
+                    )
+                )
             cls.sccs = Sccs(cls.config.sccs)
             cls.sccs_v2 = SccsV2(cls.config.sccs)
             cls.kubernetes = Kubernetes(cls.config.kubernetes, cls.sccs)
             cls.oauth2 = OAuth2(cls.config.OAuth2)
+            cls.warmup = WarmUp(
+                cls._instance.warmup_jobs,
+                concurrency=settings.CACHE_WARMUP_CONCURRENCY,
+                interval=timedelta(seconds=settings.CACHE_WARMUP_INTERVAL) or None,
+                )
 
         return cls._instance
 
     def startup_tasks(self) -> list:
-        return [self.sccs.init, self.kubernetes.init, self.oauth2.init]
+        tasks = [self.sccs.init, self.kubernetes.init, self.oauth2.init]
+        if settings.CACHE_WARMUP_ENABLED:
+            tasks.append(self.warmup.start)
+        return tasks
 
     def shutdown_tasks(self) -> list:
-        return []
+        return [self.warmup.stop, RedisCache().close, close_connections]
+
+    async def warmup_jobs(self) -> list[Job]:
+        """What the cache warm-up computes: the repositories, then the CD data of the repositories
+        in a collection or among the most used ones."""
+        plugin_id = settings.CACHE_WARMUP_PLUGIN_ID
+        slugs = {slug for collection in repository_collections.values() for slug in collection.repositories}
+        slugs.update(await most_used_repositories(settings.CACHE_WARMUP_TOP_REPOSITORIES))
+
+        # credentials=None: the admin session
+        jobs = [("repositories", partial(self.sccs.get_repositories, plugin_id, None))]
+        for slug in sorted(slugs):
+            jobs += [
+                (
+                    f"cd config of {slug}",
+                    partial(self.sccs.get_continuous_deployment_config, plugin_id, None, slug),
+                    ),
+                (
+                    f"versions available of {slug}",
+                    partial(self.sccs.get_continuous_deployment_versions_available, plugin_id, None, slug),
+                    ),
+                (
+                    f"environments available of {slug}",
+                    partial(
+                        self.sccs.get_continuous_deployment_environments_available, plugin_id, None, slug
+                        ),
+                    ),
+                (
+                    f"deployment statuses of {slug}",
+                    partial(
+                        self.sccs_v2.get_deployment_statuses,
+                        None,
+                        slug=slug,
+                        accepted_environments=None,
+                        ),
+                    ),
+                ]
+        return jobs
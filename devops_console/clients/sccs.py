@@ -1,6 +1,4 @@
 # Copyright 2020 Croix Bleue du Québec
-import atlassian
-
 from devops_console.sccs.client import SccsClient
 from devops_console.sccs.schemas.config import SccsConfig
 from devops_console.sccs.typing.cd import EnvironmentConfig
@@ -132,6 +130,17 @@ class Sccs:
             ):
         pass
 
+    @ctx_wrap
+    async def get_webhook_subscriptions_many(
+            self,
+            plugin_id,
+            credentials,
+            repo_slugs: list[str],
+            *args,
+            **kwargs
+            ):
+        pass
+
     @ctx_wrap
     async def create_webhook_subscription(self, plugin_id, credentials, *args, **kwargs):
         pass
@@ -145,7 +154,7 @@ class Sccs:
             self,
             plugin_id,
             credentials
-            ) -> atlassian.bitbucket.cloud.workspaces.Projects:
+            ) -> list[dict]:
         pass
 
     @ctx_wrap
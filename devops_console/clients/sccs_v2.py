@@ -1,16 +1,14 @@
-import contextlib
+import asyncio
 from datetime import timedelta
 
-from atlassian.bitbucket import Cloud
-from atlassian.bitbucket.cloud.repositories import Repository
 from fastapi import HTTPException
 from loguru import logger
-from requests import HTTPError, Response
 
 from devops_console.schemas.sccs import Commit, DeploymentStatus, RepositoryDescription
-from devops_console.sccs.errors import SccsException
+from devops_console.sccs.errors import BitbucketHTTPError
+from devops_console.sccs.plugins.bitbucket_api import Bitbucket
 from devops_console.sccs.plugins.cache_keys import cache_key_fns
-from devops_console.sccs.redis import cache_sync
+from devops_console.sccs.redis import cache_async, cache_async_many
 from devops_console.sccs.schemas.provision import AddRepositoryDefinition, TemplateParams
 from devops_console.sccs.schemas.config import (
     SccsConfig,
@@ -44,67 +42,88 @@ class SccsV2:
             if config.provision is not None:
                 cls.provision = ProvisionV2(config.provision)
             cls.environment_configurations = cls.config.continuous_deployment.environments
-            cls.admin_session = Cloud(
-                username=cls.config.watcher.user,
-                password=cls.config.watcher.pwd,
-            )
+            cls.admin_session = Bitbucket(cls.config.watcher.user, cls.config.watcher.pwd)
         return cls._instance
 
-    @contextlib.contextmanager
-    def session(self, credentials: Credentials | None):
+    def session(self, credentials: Credentials | None) -> Bitbucket:
         if credentials is None:
-            session = self.admin_session
-        else:
-            session = Cloud(username=credentials.user, password=credentials.apikey)
-
-        yield session
-
-        session.close()
+            return self.admin_session
+        # the connections are shared by every session (see bitbucket_api)
+        return Bitbucket(credentials.user, credentials.apikey)
 
-    def access_control(self, *, credentials: Credentials, slug: str):
-        with self.session(credentials) as session:
-            session.get("user/permissions/repositories", params=[("q", f'repository.name="{slug}"')])
+    async def access_control(self, *, credentials: Credentials, slug: str):
+        await self.session(credentials).get(
+            "user/permissions/repositories", params=[("q", f'repository.name="{slug}"')]
+        )
 
-    @cache_sync(ttl=timedelta(days=1))
-    def get_repositories(self, credentials: Credentials) -> list[RepositoryDescription]:
+    @cache_async(
+        ttl=timedelta(days=1),
+        soft_ttl=timedelta(hours=12),
+        key=cache_key_fns["v2:get_repository_catalog"],
+    )
+    async def get_repository_catalog(self) -> list[RepositoryDescription]:
+        """
+        Returns every repository of the workspace, without permissions. Shared by all the users: see
+        `get_repositories` for a user's view of it.
+        """
+        return [
+            RepositoryDescription(
+                name=repository["name"],
+                slug=repository["full_name"].split("/")[1],
+                url=repository["links"]["html"]["href"],
+            )
+            async for repository in self.session(None).repositories(
+                self.config.team, fields="next,values.name,values.full_name,values.links.html.href"
+            )
+        ]
+
+    @cache_async(
+        ttl=timedelta(days=1),
+        soft_ttl=timedelta(hours=12),
+        key=cache_key_fns["v2:get_repository_permissions"],
+        tags=["user:{credentials.user}"],
+    )
+    async def get_repository_permissions(self, credentials: Credentials) -> dict[str, str]:
+        """Returns the user's permission on each repository of the workspace they can see, by slug."""
+        permissions = {}
+        async for repository_permission in self.session(credentials).permissions(
+            fields="next,values.permission,values.repository.full_name"
+        ):
+            workspace, slug = repository_permission["repository"]["full_name"].split("/")
+            if workspace == self.config.team:
+                permissions[slug] = repository_permission["permission"]
+        return permissions
+
+    async def get_repositories(self, credentials: Credentials) -> list[RepositoryDescription]:
         if credentials is None:
             raise HTTPException(
                 status_code=403,
                 detail="You are not authorized to view this. Please provide valid credentials.",
             )
-        with self.session(credentials) as session:
-            result: list[RepositoryDescription] = []
-            for repository_permission in session._get_paged(
-                "user/permissions/repositories", params={"pagelen": 100}
-            ):
-                assert isinstance(repository_permission, dict)
-                repository = repository_permission["repository"]
-                full_name = repository["full_name"]
-
-                result.append(
-                    RepositoryDescription(
-                        name=repository["name"],
-                        slug=full_name.split("/")[1],
-                        url=repository["links"]["html"]["href"],
-                        permission=repository_permission["permission"],
-                    )
-                )
-            return result
-
-    @cache_sync(ttl=timedelta(days=1))
-    def get_repository(
+        permissions, catalog = await asyncio.gather(
+            self.get_repository_permissions(credentials), self.get_repository_catalog()
+        )
+        return [
+            repository.copy(update={"permission": permissions[repository.slug]})
+            for repository in catalog
+            if repository.slug in permissions
+        ]
+
+    async def get_repository(
         self,
         credentials: Credentials,
         *,
         slug: str,
     ) -> RepositoryDescription | None:
-        repos = self.get_repositories(credentials)
-        for repo in repos:
-            if repo.slug == slug:
-                return repo
-
-    @cache_sync(ttl=timedelta(minutes=15))
-    def get_versions(self, credentials: Credentials, *, slug: str, top: str | None) -> list[Commit]:
+        permission = (await self.get_repository_permissions(credentials)).get(slug)
+        if permission is None:
+            return None
+        for repository in await self.get_repository_catalog():
+            if repository.slug == slug:
+                return repository.copy(update={"permission": permission})
+
+    @cache_async(ttl=timedelta(minutes=15), tags=["repo:{slug}"])
+    async def get_versions(self, credentials: Credentials, *, slug: str, top: str | None) -> list[Commit]:
         """
         Returns 10 commits for the repositories reverse chronological order starting from the most
         recent, or from the commit hash given as the `top` parameter. This allows the caller to load
@@ -115,41 +134,40 @@ class SccsV2:
         retrieved in the previous call to this function.
         """
         commits = []
-        with self.session(credentials) as session:
-            repository = session.workspaces.get(self.config.team).repositories.get(slug)
-            mainbranch = repository.get_data("mainbranch", {}).get("name")
-            path = f"/commits/{mainbranch if top is None else top}"
+        session = self.session(credentials)
+        repository = await session.repository(self.config.team, slug)
+        mainbranch = (repository.get("mainbranch") or {}).get("name")
 
-            # when `top` is given, we query for one extra commit and discard the commit
-            # corresponding to `top`
-            skip_first = top is not None
+        # when `top` is given, we query for one extra commit and discard the commit
+        # corresponding to `top`
+        skip_first = top is not None
 
-            res = repository.get(path, params={"pagelen": 11 if skip_first else 10})
-
-            if not isinstance(res, Response):
-                raise HTTPException(status_code=500, detail="Nothing returned")
+        d = await session.commits(
+            self.config.team, slug, mainbranch if top is None else top, pagelen=11 if skip_first else 10
+        )
 
-            d = res.json()
+        if d is None:
+            raise HTTPException(status_code=500, detail="Nothing returned")
 
-            try:
-                values = iter(d["values"])
+        try:
+            values = iter(d["values"])
 
-                if skip_first:
-                    next(values)
+            if skip_first:
+                next(values)
 
-                for commit_data in values:
-                    commit = commit_from_api_dict(commit_data)
-                    commits.append(commit)
+            for commit_data in values:
+                commit = commit_from_api_dict(commit_data)
+                commits.append(commit)
 
-                    if len(commits) == 10:
-                        break
-            except KeyError as e:
-                logger.error(str(e))
-                raise HTTPException(status_code=500, detail=str(e))
+                if len(commits) == 10:
+                    break
+        except KeyError as e:
+            logger.error(str(e))
+            raise HTTPException(status_code=500, detail=str(e))
 
         return commits
 
-    def get_deployment_statuses(
+    async def get_deployment_statuses(
         self,
         credentials: Credentials,
         *,
@@ -165,120 +183,154 @@ class SccsV2:
                 e.name for e in self.environment_configurations if e.name in accepted_environments
             ]
 
-        deployment_statuses = []
-        # map environments to DeploymentStatuses
-        for environment in environments:
-            deployment_status = self.get_deployment_status(
-                credentials=credentials, slug=slug, environment=environment
-            )
-
-            if deployment_status is None:
-                continue
-
-            deployment_statuses.append(deployment_status)
+        # map environments to DeploymentStatuses (cached ones are read in a single round-trip)
+        deployment_statuses = await self.get_deployment_status_many(
+            credentials, slug=slug, environments=environments
+        )
 
-        return deployment_statuses
+        return [deployment_statuses[e] for e in environments if deployment_statuses.get(e) is not None]
 
-    @cache_sync(ttl=timedelta(hours=1), key=cache_key_fns["get_deployment_status"])
-    def get_deployment_status(
+    @cache_async(
+        ttl=timedelta(hours=1),
+        key=cache_key_fns["get_deployment_status"],
+        tags=["repo:{slug}"],
+        negative_ttl=timedelta(minutes=5),
+    )
+    async def get_deployment_status(
         self,
         credentials: Credentials,
         *,
         slug: str,
         environment: str,
     ) -> DeploymentStatus | None:
-        try:
-            environment_configuration = next(
-                (e for e in self.environment_configurations if e.name == environment)
+        environment_configuration = self.get_environment_configuration(environment)
+        if environment_configuration is None:
+            return
+
+        return await self.make_deployment_status(
+            credentials,
+            slug=slug,
+            environment_configuration=environment_configuration,
+        )
+
+    @cache_async_many(
+        ttl=timedelta(hours=1),
+        key=cache_key_fns["get_deployment_status"],
+        batch_arg="environments",
+        item_arg="environment",
+        tags=["fn:get_deployment_status", "repo:{slug}"],
+        negative_ttl=timedelta(minutes=5),
+    )
+    async def get_deployment_status_many(
+        self,
+        credentials: Credentials,
+        *,
+        slug: str,
+        environments: list[str],
+    ) -> dict[str, DeploymentStatus | None]:
+        """`get_deployment_status` for several environments, sharing its cache entries."""
+        environment_configurations = {e: self.get_environment_configuration(e) for e in environments}
+        configured = {e: c for e, c in environment_configurations.items() if c is not None}
+
+        statuses = await asyncio.gather(
+            *(
+                self.make_deployment_status(credentials, slug=slug, environment_configuration=configuration)
+                for configuration in configured.values()
             )
+        )
+        return dict(zip(configured, statuses))
+
+    def get_environment_configuration(self, environment: str) -> EnvironmentConfiguration | None:
+        try:
+            return next((e for e in self.environment_configurations if e.name == environment))
         except StopIteration:
             logger.warning(
                 f'"{environment}" was not found in configured environments. Possible values: {[e.name for e in self.environment_configurations]}'
             )
-            return
 
-        with self.session(credentials) as session:
-            repository = session.workspaces.get(self.config.team).repositories.get(slug)
+    async def make_deployment_status(
+        self,
+        credentials: Credentials,
+        *,
+        slug: str,
+        environment_configuration: EnvironmentConfiguration,
+    ) -> DeploymentStatus | None:
+        session = self.session(credentials)
 
-            commit_hash = self.get_deployment_commit_hash(
-                repository=repository, environment_configuration=environment_configuration
+        async def get_pullrequest_url() -> str | None:
+            if not environment_configuration.trigger.get("pullrequest", False):
+                return None
+            return await self.get_pullrequest_url(
+                session, slug=slug, branch_name=environment_configuration.branch
             )
 
-            if commit_hash is None:
-                return
+        commit_hash, pullrequest = await asyncio.gather(
+            self.get_deployment_commit_hash(
+                session, slug=slug, environment_configuration=environment_configuration
+            ),
+            get_pullrequest_url(),
+        )
 
-            try:
-                commit = self.get_commit(credentials, slug=slug, commit_hash=commit_hash)
-            except Exception:
-                return
+        if commit_hash is None:
+            return
 
-            readonly = environment_configuration.trigger.get("enabled", True) and False
+        try:
+            commit = await self.get_commit(credentials, slug=slug, commit_hash=commit_hash)
+        except Exception:
+            return
 
-            pullrequest = (
-                self.get_pullrequest_url(repository=repository, branch_name=environment_configuration.branch)
-                if environment_configuration.trigger.get("pullrequest", False)
-                else None
-            )
+        readonly = environment_configuration.trigger.get("enabled", True) and False
 
-            return DeploymentStatus(
-                environment=environment_configuration.name,
-                commit=commit,
-                readonly=readonly,
-                pullrequest=pullrequest,
-            )
+        return DeploymentStatus(
+            environment=environment_configuration.name,
+            commit=commit,
+            readonly=readonly,
+            pullrequest=pullrequest,
+        )
 
-    def get_pullrequest_url(self, *, repository: Repository, branch_name: str) -> str | None:
-        for pr in repository.pullrequests.each():
+    async def get_pullrequest_url(self, session: Bitbucket, *, slug: str, branch_name: str) -> str | None:
+        async for pr in session.pullrequests(self.config.team, slug):
             if (
-                pr.destination_branch == branch_name
-                and pr.title is not None
-                and self.config.continuous_deployment.pullrequest.tag in pr.title
+                pr["destination"]["branch"]["name"] == branch_name
+                and pr.get("title") is not None
+                and self.config.continuous_deployment.pullrequest.tag in pr["title"]
             ):
-                link = pr.get_link("html")
-                return link["href"] if type(link) is dict else link
+                return pr["links"]["html"]["href"]
 
-    def get_deployment_commit_hash(
+    async def get_deployment_commit_hash(
         self,
+        session: Bitbucket,
         *,
-        repository: Repository,
+        slug: str,
         environment_configuration: EnvironmentConfiguration,
     ) -> str | None:
         try:
-            branch = repository.branches.get(environment_configuration.branch)
-        except HTTPError:
+            branch = await session.branch(self.config.team, slug, environment_configuration.branch)
+        except BitbucketHTTPError:
             return
 
         version_file_name = environment_configuration.version.get("file")
         deployment_commit_hash: str
         if version_file_name is not None:
-            response = repository.get(f"src/{branch.hash}/{version_file_name}", not_json_response=True)
-            if response is None:
-                raise SccsException(
-                    f"failed to get version from {version_file_name} for {repository.name} on branch {branch.name}"
-                )
-            if isinstance(response, bytes):
-                deployment_commit_hash = response.decode("utf-8").strip()
-            else:
-                raise TypeError("response is not an instance of `bytes`")
+            response = await session.src(self.config.team, slug, branch["target"]["hash"], version_file_name)
+            deployment_commit_hash = response.decode("utf-8").strip()
         elif environment_configuration.version.get("git", False):  # TODO this is unclear
-            deployment_commit_hash = branch.hash  # main branch
+            deployment_commit_hash = branch["target"]["hash"]  # main branch
         else:
             raise NotImplementedError()
 
         return deployment_commit_hash
 
-    def get_commit(self, credentials: Credentials, *, slug: str, commit_hash: str) -> Commit:
-        with self.session(credentials) as session:
-            repository = session.workspaces.get(self.config.team).repositories.get(slug)
-            try:
-                commit_dict = repository.get(f"/commit/{commit_hash}")
-            except HTTPError as e:
-                logger.warning(e)
-                raise
+    async def get_commit(self, credentials: Credentials, *, slug: str, commit_hash: str) -> Commit:
+        try:
+            commit_dict = await self.session(credentials).commit(self.config.team, slug, commit_hash)
+        except BitbucketHTTPError as e:
+            logger.warning(e)
+            raise
 
-            return commit_from_api_dict(commit_dict)
+        return commit_from_api_dict(commit_dict)
 
-    def add_repository(
+    async def add_repository(
         self,
         credentials: Credentials,
         *,
@@ -286,28 +338,29 @@ class SccsV2:
         template_name: str,
         template_params: TemplateParams,
     ):
-        with self.session(credentials) as session:
-            # Check permissions
+        session = self.session(credentials)
+        # Check permissions
 
-            # Use admin account ?
+        # Use admin account ?
 
-            # Update storage definitions/templates/configs...
+        # Update storage definitions/templates/configs...
 
-            # Prepare provision
+        # Prepare provision
 
-            # Retrieve relevant definitions
+        # Retrieve relevant definitions
 
-            # Create repository
-            try:
-                session.workspaces.get(self.config.team).repositories.create(
-                    repo_slug=slug,
-                    project_key=project_key,
-                    is_private=is_private,
-                    fork_policy=fork_policy,
-                )
-            except HTTPError as e:
-                logger.warning(e)
-                raise
+        # Create repository (private, without public forks: the configuration storage isn't read yet)
+        try:
+            await session.create_repository(
+                self.config.team,
+                repository_definition.name,
+                project={"key": repository_definition.project.key},
+                is_private=True,
+                fork_policy="no_public_forks",
+            )
+        except BitbucketHTTPError as e:
+            logger.warning(e)
+            raise
 
 
 def commit_from_api_dict(commit_dict: dict) -> Commit:
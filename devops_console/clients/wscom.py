@@ -25,11 +25,11 @@ from anyio import (
     Event,
     )
 from fastapi import WebSocket
-from requests import HTTPError
 from starlette.websockets import WebSocketDisconnect
 from websockets.exceptions import ConnectionClosed
 
 from devops_console.schemas.legacy.ws import WsResponse
+from devops_console.sccs.errors import BitbucketHTTPError
 
 
 class ConnectionManager:
@@ -170,9 +170,9 @@ async def wscom_generic_handler(websocket: WebSocket, handlers: dict):
                         path,
                         body
                         )
-        except (WebSocketDisconnect, HTTPError) as e:
+        except (WebSocketDisconnect, BitbucketHTTPError) as e:
             cancel_all_watchers()
-            if isinstance(e, HTTPError):
+            if isinstance(e, BitbucketHTTPError):
                 logging.error(e)
         finally:
             tg.cancel_scope.cancel()
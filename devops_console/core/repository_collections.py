@@ -0,0 +1,97 @@
+"""Repositories shown together in the UI (and kept warm in the cache)."""
+from devops_console.schemas.sccs import RepositoryCollection
+
+repository_collections = {
+    "assistance": RepositoryCollection(
+        name="Assistance",
+        repositories=[
+            "assistance-integration-test",
+            "assistance-salesforce-edge-api",
+            "assistance-salesforce-event-listener",
+            "assistance-salesforce-system-api",
+            "fax-system-api",
+            "insured-eligibility-service",
+            "product-benefit-service",
+            "acocan-system-api",
+            "payment-service",
+            "holidays-service",
+        ],
+        environments=[
+            {"enabled": False, "name": "master"},
+            {"enabled": True, "name": "development"},
+            {"enabled": True, "name": "qa"},
+            {"enabled": True, "name": "acceptation"},
+            {"enabled": True, "name": "production"},
+        ],
+    ),
+    "healthcare": RepositoryCollection(
+        name="Healthcare Claims",
+        repositories=[
+            "healthcare-claims-edi-service",
+            "healthcare-claims-invoice-service",
+            "healthcare-claims-salesforce-event-listener",
+            "healthcare-claims-salesforce-system-api",
+            "healthcare-claims-service",
+            "document-fusion-service",
+            "transfert-service",
+            "sharepoint-system-api",
+            "healthcare-claims-integration-test",
+            "healthcare-claims-match-service",
+            "star-system-api",
+            "factcan-system-api",
+            "exchange-rate-service",
+            "healthcare-claims-report-service",
+        ],
+        environments=[
+            {"enabled": False, "name": "master"},
+            {"enabled": True, "name": "development"},
+            {"enabled": True, "name": "qa"},
+            {"enabled": True, "name": "acceptation"},
+            {"enabled": True, "name": "production"},
+        ],
+    ),
+    "reclamation": RepositoryCollection(
+        name="Réclamation Digitale",
+        repositories=[
+            "claims-travel-frontend-web",
+            "claims-travel-edge-api",
+            "claims-travel-orchestrator-system-api",
+            "salesforce-system-api",
+            "salesforce-edge-api",
+            "salesforce-event-listener",
+            "sharepoint-system-api",
+            "usermanager-system-api",
+            "star-edge-api",
+            "email-system-api",
+            "document-viewer",
+            "document-viewer-edge-api",
+            "salesforce-core",
+            "financial-institution-service",
+            "document-fusion-service",
+            "univers-system-api",
+            "sharepoint-edge-api",
+        ],
+        environments=[
+            {"enabled": True, "name": "master"},
+            {"enabled": False, "name": "development"},
+            {"enabled": True, "name": "qa"},
+            {"enabled": False, "name": "training"},
+            {"enabled": True, "name": "acceptation"},
+            {"enabled": True, "name": "production"},
+        ],
+    ),
+    "amf": RepositoryCollection(
+        name="Document Manage - AMF",
+        repositories=[
+            "document-manager-frontend-web",
+            "document-manager-edge-api",
+        ],
+        environments=[
+            {"name": "master", "enabled": False},
+            {"name": "development", "enabled": True},
+            {"name": "qa", "enabled": True},
+            {"name": "acceptation", "enabled": True},
+            {"name": "production", "enabled": True},
+        ],
+    ),
+}
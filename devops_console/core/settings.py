@@ -60,6 +60,36 @@ class Settings(BaseSettings):
 
     DATABASE_URI: str = Field(default="sqlite://", env="DATABASE_URI")
 
+    # cache warm-up: repository collections and the most used repositories are kept warm.
+    # The interval is in seconds, 0 to only warm up at startup.
+    CACHE_WARMUP_ENABLED: bool = Field(default=True, env="CACHE_WARMUP_ENABLED")
+    CACHE_WARMUP_INTERVAL: int = Field(default=6 * 3600, env="CACHE_WARMUP_INTERVAL")
+    CACHE_WARMUP_CONCURRENCY: int = Field(default=4, env="CACHE_WARMUP_CONCURRENCY")
+    CACHE_WARMUP_TOP_REPOSITORIES: int = Field(default=50, env="CACHE_WARMUP_TOP_REPOSITORIES")
+    CACHE_WARMUP_PLUGIN_ID: str = Field(default="cbq", env="CACHE_WARMUP_PLUGIN_ID")
+
+    # redis connection (see sccs.redis.RedisOptions). Timeouts and backoffs are in seconds.
+    # REDIS_MODE: standalone, sentinel or cluster; nodes are comma separated "host:port"
+    REDIS_MODE: str = Field(default="standalone", env="REDIS_MODE")
+    REDIS_SENTINELS: str = Field(default="", env="REDIS_SENTINELS")
+    REDIS_SENTINEL_MASTER: str = Field(default="mymaster", env="REDIS_SENTINEL_MASTER")
+    REDIS_SENTINEL_PASSWORD: str | None = Field(default=None, env="REDIS_SENTINEL_PASSWORD")
+    REDIS_CLUSTER_NODES: str = Field(default="", env="REDIS_CLUSTER_NODES")
+    REDIS_HOST: str = Field(default="localhost", env="REDIS_HOST")
+    REDIS_PORT: int = Field(default=6379, env="REDIS_PORT")
+    REDIS_PASSWORD: str | None = Field(default=None, env="REDIS_PASSWORD")
+    REDIS_MAX_CONNECTIONS: int = Field(default=50, env="REDIS_MAX_CONNECTIONS")
+    REDIS_POOL_TIMEOUT: float = Field(default=5.0, env="REDIS_POOL_TIMEOUT")
+    REDIS_SOCKET_TIMEOUT: float = Field(default=5.0, env="REDIS_SOCKET_TIMEOUT")
+    REDIS_CONNECT_TIMEOUT: float = Field(default=2.0, env="REDIS_CONNECT_TIMEOUT")
+    REDIS_HEALTH_CHECK_INTERVAL: int = Field(default=30, env="REDIS_HEALTH_CHECK_INTERVAL")
+    REDIS_RETRIES: int = Field(default=2, env="REDIS_RETRIES")
+    REDIS_RETRY_BACKOFF_BASE: float = Field(default=0.05, env="REDIS_RETRY_BACKOFF_BASE")
+    REDIS_RETRY_BACKOFF_CAP: float = Field(default=0.5, env="REDIS_RETRY_BACKOFF_CAP")
+    # the cache is bypassed for CACHE_BREAKER_COOLDOWN seconds after CACHE_BREAKER_THRESHOLD failures in a row
+    CACHE_BREAKER_THRESHOLD: int = Field(default=5, env="CACHE_BREAKER_THRESHOLD")
+    CACHE_BREAKER_COOLDOWN: float = Field(default=30.0, env="CACHE_BREAKER_COOLDOWN")
+
     SECRET_KEY: str = Field(default=secrets.token_urlsafe(32), env="SECRET_KEY")
     ACCESS_TOKEN_TTL: int = Field(default=60 * 24 * 7, env="ACCESS_TOKEN_TTL")
     ALGORITHM = "HS256"
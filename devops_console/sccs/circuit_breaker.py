@@ -0,0 +1,76 @@
+"""
+Circuit breaker
+
+Stops calling something that keeps failing. After `threshold` consecutive failures the breaker
+opens and `allow` returns False for `cooldown` seconds; then a single trial call is let through
+(half-open): its success closes the breaker, its failure opens it again. A trial whose outcome is
+never recorded (e.g. answered by the local cache) doesn't hold the breaker half-open: another one
+is let through after `cooldown` seconds.
+
+Used by the cache decorators, which call the upstream method directly while the breaker is open.
+"""
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0):
+        """
+        Args:
+            threshold: consecutive failures opening the breaker (0: never opens)
+            cooldown: seconds the breaker stays open before letting a trial call through
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        # when the last trial call was let through
+        self._trial_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                return HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        """Whether the call may go through. Once the cool-down is over, only the first caller gets
+        True until the trial call is recorded, or until another cool-down is over."""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            now = time.monotonic()
+            if self._state == OPEN and now - self._opened_at >= self.cooldown:
+                self._state = HALF_OPEN
+                self._trial_at = now
+                return True
+            if self._state == HALF_OPEN and now - self._trial_at >= self.cooldown:
+                self._trial_at = now
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._state = CLOSED
+
+    def record_failure(self) -> bool:
+        """Returns whether this failure opened the breaker."""
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or (self.threshold and self._failures >= self.threshold):
+                opened = self._state != OPEN
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                return opened
+            return False
+
+    def reset(self):
+        self.record_success()
@@ -50,19 +50,18 @@ class SccsClient(object):
 
     def __init__(self):
         """Initialize plugins and internal modules"""
-        self.scheduler = Scheduler()
+        self.scheduler = Scheduler(debounce=Context.NOTIFY_DEBOUNCE)
         self.provision: Provision
 
     @classmethod
     async def create(cls, config: SccsConfig):
         self = SccsClient()
 
-        # Initialize the cache
-        try:
-            RedisCache().init()
-        except Exception:
-            logging.error("Unable to initialize Redis cache. Exiting...")
-            sys.exit(1)
+        # Initialize the cache (if redis is down, it starts on its fallback store and reconnects later)
+        RedisCache().init()
+        RedisCache().start_invalidation_listener()
+        if RedisCache().degraded:
+            logging.warning("Redis is unavailable, caching locally until it comes back")
 
         if config.provision is not None:
             self.provision = Provision(config=config.provision)
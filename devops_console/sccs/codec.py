@@ -0,0 +1,298 @@
+"""
+Cache codecs
+
+Turn cached values into bytes and back. `VersionedCodec` (the default) writes a small header
+followed by an orjson payload for pydantic models, dataclasses and plain data, falling back to
+pickle for everything else, and compresses large payloads.
+
+Every value is tagged with the schema of the types it contains (field names and types of each
+model). When a deploy changes a model, only the entries containing that model fail to decode
+(`IncompatibleValue`) and the cache treats them as misses.
+
+Layout: MAGIC (2 bytes) | payload format (1 byte) | compression (1 byte) | payload
+"""
+import base64
+import dataclasses
+import hashlib
+import importlib
+import json
+import pickle
+import zlib
+from datetime import date, datetime
+from enum import Enum
+from functools import lru_cache
+from importlib import metadata
+from typing import Any
+
+import dill
+import orjson
+from pydantic import BaseModel
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+MAGIC = b"\xdc\x01"  # can't be mistaken for a pickle, which starts with b"\x80"
+
+FORMAT_JSON = 1
+FORMAT_PICKLE = 2
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+
+_TAG = "__c__"
+_SCALARS = frozenset((str, int, float, bool, type(None)))
+
+
+class IncompatibleValue(Exception):
+    """The cached value can't be decoded by this version of the code."""
+
+
+class Codec:
+    def encode(self, value: Any) -> bytes:
+        raise NotImplementedError()
+
+    def decode(self, data: bytes) -> Any:
+        raise NotImplementedError()
+
+
+class PickleCodec(Codec):
+    """The original format: pickle, or dill for what pickle can't handle."""
+
+    def encode(self, value: Any) -> bytes:
+        try:
+            return pickle.dumps(value)
+        except AttributeError:
+            return dill.dumps(value)  # slower than pickle, but can handle more types
+
+    def decode(self, data: bytes) -> Any:
+        try:
+            return pickle.loads(data)
+        except (pickle.UnpicklingError, AttributeError, TypeError):
+            pass
+        try:
+            return dill.loads(data)
+        except Exception as e:
+            raise IncompatibleValue(str(e)) from e
+
+
+class VersionedCodec(Codec):
+    def __init__(self, compression_threshold: int = 4096, compression: str | None = "zstd"):
+        """
+        Args:
+            compression_threshold: payloads larger than this (in bytes) are compressed
+            compression: "zstd" (falls back to zlib when zstandard isn't installed), "zlib" or None
+        """
+        self.compression_threshold = compression_threshold
+        if compression == "zstd" and zstandard is None:
+            compression = "zlib"
+        self.compression = compression
+        self._pickle = PickleCodec()
+
+    def encode(self, value: Any) -> bytes:
+        try:
+            types = _TypeTable()
+            tree = _to_tree(value, types)
+            fmt = FORMAT_JSON
+            payload = orjson.dumps({"t": types.entries, "v": tree})
+        except _Unsupported:
+            fmt = FORMAT_PICKLE
+            payload = _pickle_tag() + self._pickle.encode(value)
+
+        compression = COMPRESSION_NONE
+        if self.compression is not None and len(payload) > self.compression_threshold:
+            if self.compression == "zstd":
+                compression, payload = COMPRESSION_ZSTD, zstandard.ZstdCompressor().compress(payload)
+            else:
+                compression, payload = COMPRESSION_ZLIB, zlib.compress(payload, 1)
+
+        return MAGIC + bytes((fmt, compression)) + payload
+
+    def decode(self, data: bytes) -> Any:
+        if not data.startswith(MAGIC):
+            # written before the versioned format existed
+            return self._pickle.decode(data)
+
+        fmt, compression = data[2], data[3]
+        payload = data[4:]
+
+        if compression == COMPRESSION_ZSTD:
+            if zstandard is None:
+                raise IncompatibleValue("zstandard is not installed")
+            payload = zstandard.ZstdDecompressor().decompress(payload)
+        elif compression == COMPRESSION_ZLIB:
+            payload = zlib.decompress(payload)
+        elif compression != COMPRESSION_NONE:
+            raise IncompatibleValue(f"unknown compression {compression}")
+
+        if fmt == FORMAT_JSON:
+            document = orjson.loads(payload)
+            types = [_resolve(path, digest) for path, digest in document["t"]]
+            return _from_tree(document["v"], types)
+        elif fmt == FORMAT_PICKLE:
+            tag = _pickle_tag()
+            if not payload.startswith(tag):
+                raise IncompatibleValue("pickled by another version of the application")
+            return self._pickle.decode(payload[len(tag):])
+
+        raise IncompatibleValue(f"unknown payload format {fmt}")
+
+
+class _Unsupported(Exception):
+    pass
+
+
+class _TypeTable:
+    def __init__(self):
+        self.entries: list[tuple[str, str]] = []
+        self._index: dict[type, int] = {}
+
+    def add(self, cls: type) -> int:
+        i = self._index.get(cls)
+        if i is None:
+            i = self._index[cls] = len(self.entries)
+            self.entries.append((f"{cls.__module__}:{cls.__qualname__}", schema_digest(cls)))
+        return i
+
+
+def _to_tree(v, types: _TypeTable):
+    t = type(v)
+    if t in _SCALARS:
+        return v
+    if t is list:
+        if len(v) > 1 and isinstance(v[0], BaseModel) and all(type(i) is type(v[0]) for i in v):
+            return _models_to_tree(v, types)
+        return [_to_tree(i, types) for i in v]
+    if t is dict:
+        if all(type(k) is str for k in v) and _TAG not in v:
+            return {k: _to_tree(i, types) for k, i in v.items()}
+        return {_TAG: "dict", "v": [[_to_tree(k, types), _to_tree(i, types)] for k, i in v.items()]}
+    if isinstance(v, BaseModel):
+        fields = {name: i if type(i) in _SCALARS else _to_tree(i, types) for name, i in v.__dict__.items()}
+        return {_TAG: "m", "t": types.add(t), "v": fields}
+    if isinstance(v, Enum):
+        return {_TAG: "e", "t": types.add(t), "v": _to_tree(v.value, types)}
+    if dataclasses.is_dataclass(v):
+        fields = {f.name: _to_tree(getattr(v, f.name), types) for f in dataclasses.fields(v)}
+        return {_TAG: "dc", "t": types.add(t), "v": fields}
+    if t is tuple:
+        return {_TAG: "tuple", "v": [_to_tree(i, types) for i in v]}
+    if t is bytes:
+        return {_TAG: "bytes", "v": base64.b64encode(v).decode()}
+    if t is datetime:
+        return {_TAG: "datetime", "v": v.isoformat()}
+    if t is date:
+        return {_TAG: "date", "v": v.isoformat()}
+    raise _Unsupported(t)
+
+
+def _models_to_tree(models: list[BaseModel], types: _TypeTable):
+    """Lists of models of the same type (the common case) are stored as rows of field values."""
+    names = list(models[0].__dict__)
+    rows = [
+        [i if type(i) in _SCALARS else _to_tree(i, types) for i in m.__dict__.values()]
+        for m in models
+        ]
+    return {_TAG: "ml", "t": types.add(type(models[0])), "f": names, "v": rows}
+
+
+def _new_model(cls: type[BaseModel], fields: dict) -> BaseModel:
+    # like BaseModel.construct(), without re-applying the defaults: every field is in the payload
+    m = cls.__new__(cls)
+    object.__setattr__(m, "__dict__", fields)
+    object.__setattr__(m, "__fields_set__", set(fields))
+    return m
+
+
+def _models_from_tree(cls: type[BaseModel], names: list[str], rows: list[list], types: list[type]):
+    new, setattr_ = cls.__new__, object.__setattr__
+    fields_set = set(names)
+    models = []
+    for row in rows:
+        for i in row:
+            if type(i) not in _SCALARS:
+                row = [i if type(i) in _SCALARS else _from_tree(i, types) for i in row]
+                break
+        m = new(cls)
+        setattr_(m, "__dict__", dict(zip(names, row)))
+        setattr_(m, "__fields_set__", fields_set.copy())
+        models.append(m)
+    return models
+
+
+def _from_tree(v, types: list[type]):
+    t = type(v)
+    if t is list:
+        return [_from_tree(i, types) for i in v]
+    if t is not dict:
+        return v
+    tag = v.get(_TAG)
+    if tag is None:
+        return {k: _from_tree(i, types) for k, i in v.items()}
+    if tag == "ml":
+        return _models_from_tree(types[v["t"]], v["f"], v["v"], types)
+    if tag == "m":
+        fields = {k: i if type(i) in _SCALARS else _from_tree(i, types) for k, i in v["v"].items()}
+        # the schema digest already guarantees the fields match: no need to validate again
+        return _new_model(types[v["t"]], fields)
+    if tag == "dc":
+        return types[v["t"]](**{k: _from_tree(i, types) for k, i in v["v"].items()})
+    if tag == "e":
+        return types[v["t"]](_from_tree(v["v"], types))
+    if tag == "dict":
+        return {_from_tree(k, types): _from_tree(i, types) for k, i in v["v"]}
+    if tag == "tuple":
+        return tuple(_from_tree(i, types) for i in v["v"])
+    if tag == "bytes":
+        return base64.b64decode(v["v"])
+    if tag == "datetime":
+        return datetime.fromisoformat(v["v"])
+    if tag == "date":
+        return date.fromisoformat(v["v"])
+    raise IncompatibleValue(f"unknown tag {tag}")
+
+
+@lru_cache(maxsize=None)
+def schema_digest(cls: type) -> str:
+    """Fingerprint of what a type looks like in the cache; changes whenever its fields do."""
+    if issubclass(cls, BaseModel):
+        shape = [(name, repr(f.outer_type_), f.required) for name, f in cls.__fields__.items()]
+    elif issubclass(cls, Enum):
+        shape = [repr(m.value) for m in cls]
+    elif dataclasses.is_dataclass(cls):
+        shape = [(f.name, repr(f.type)) for f in dataclasses.fields(cls)]
+    else:
+        shape = []
+    # bumped when the meaning of the values changes but not the fields
+    version = getattr(cls, "__schema_version__", None)
+    if version is not None:
+        shape = [version, shape]
+    encoded = json.dumps([cls.__module__, cls.__qualname__, shape]).encode()
+    return hashlib.blake2b(encoded, digest_size=8).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _resolve(path: str, digest: str) -> type:
+    module_name, _, qualname = path.partition(":")
+    try:
+        obj = importlib.import_module(module_name)
+        for attr in qualname.split("."):
+            obj = getattr(obj, attr)
+    except (ImportError, AttributeError) as e:
+        raise IncompatibleValue(f"{path} no longer exists") from e
+    if schema_digest(obj) != digest:
+        raise IncompatibleValue(f"{path} has changed")
+    return obj
+
+
+@lru_cache(maxsize=None)
+def _pickle_tag() -> bytes:
+    """Pickled classes can't be fingerprinted, so pickled values are only valid for the
+    application version that wrote them."""
+    try:
+        version = metadata.version("devops-console")
+    except metadata.PackageNotFoundError:
+        version = "dev"
+    return version.encode() + b"\x00"
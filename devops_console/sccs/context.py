@@ -1,8 +1,12 @@
 # Copyright 2021-2022 Croix Bleue du Québec
+import functools
+import os
+
 from anyio import sleep, Event
 from anyio.streams.memory import MemoryObjectSendStream
 
 from .plugin import SccsApi
+from .warmup import record_repository_usage_async
 
 
 # This file is part of python-devops-sccs.
@@ -29,6 +33,15 @@ class Context:
     UUID_WATCH_CONTINUOUS_DEPLOYMENT_ENVIRONMENTS_AVAILABLE = "7f7cd008-3350-47b7-80ce-9472e3a649c1"
     UUID_WATCH_REPOSITORIES = "865eb6e0-ded6-4cae-834b-603a22293086"
 
+    # seconds Scheduler.notify waits for a burst of notifications to end, by watch type
+    NOTIFY_DEBOUNCE = {
+        # a merge sends pullrequest:fulfilled, repo:push and a few repo:commit_status_* together
+        UUID_WATCH_CONTINOUS_DEPLOYMENT_CONFIG: float(
+            os.environ.get('WATCHER_NOTIFY_DEBOUNCE_CD_CONFIG', 10)
+            ),
+        UUID_WATCH_REPOSITORIES: float(os.environ.get('WATCHER_NOTIFY_DEBOUNCE_REPOSITORIES', 2)),
+        }
+
     def __init__(self, session_id, session, plugin: SccsApi, client):
         self.session_id = session_id
         self.session = session
@@ -50,6 +63,7 @@ class Context:
     async def get_continuous_deployment_config(self, repo_slug, environments=None):
         if environments is None:
             environments = []
+        await record_repository_usage_async(repo_slug)
         return await self.plugin.get_continuous_deployment_config(
             self.session, repo_slug, environments
             )
@@ -69,6 +83,7 @@ class Context:
             poll_interval: int,
             send_stream: MemoryObjectSendStream,
             cancel_event: Event,
+            since: int | None = None,
             ):
         await self._client.scheduler.watch(
             (Context.UUID_WATCH_REPOSITORIES, self.session_id),
@@ -77,6 +92,7 @@ class Context:
             cancel_event,
             self.plugin.get_repositories,
             args=(None,),
+            since=since,
             )
 
     async def watch_continuous_deployment_config(
@@ -86,7 +102,9 @@ class Context:
             cancel_event: Event,
             repo_slug: str,
             environments: list,
+            since: int | None = None,
             ):
+        await record_repository_usage_async(repo_slug)
         await self._client.scheduler.watch(
             (Context.UUID_WATCH_CONTINOUS_DEPLOYMENT_CONFIG, repo_slug),
             poll_interval,
@@ -94,7 +112,10 @@ class Context:
             cancel_event,
             self.plugin.get_continuous_deployment_config,
             args=(None, repo_slug, environments),
-            event_filter=lambda e: not environments or e.value.environment in environments
+            event_filter=lambda e: not environments or e.value.environment in environments,
+            repo_slug=repo_slug,
+            since=since,
+            patcher=functools.partial(self.plugin.patch_continuous_deployment_config, repo_slug),
             )
 
     async def watch_continuous_deployment_versions_available(
@@ -103,6 +124,7 @@ class Context:
             send_stream: MemoryObjectSendStream,
             cancel_event: Event,
             repo_slug: str,
+            since: int | None = None,
             ):
         # await self.accesscontrol(repo_name, Action.WATCH_CONTINUOUS_DEPLOYMENT_VERSIONS_AVAILABLE)
 
@@ -113,6 +135,8 @@ class Context:
             cancel_event,
             self.plugin.get_continuous_deployment_versions_available,
             args=(None, repo_slug),
+            repo_slug=repo_slug,
+            since=since,
             )
 
     async def watch_continuous_deployment_environments_available(
@@ -121,6 +145,7 @@ class Context:
             send_stream: MemoryObjectSendStream,
             cancel_event: Event,
             repo_slug,
+            since: int | None = None,
             ):
         # await self.accesscontrol(
         #     repo_name, Action.WATCH_CONTINUOUS_DEPLOYMENT_ENVIRONMENTS_AVAILABLE
@@ -133,6 +158,8 @@ class Context:
             cancel_event,
             self.plugin.get_continuous_deployment_environments_available,
             args=(None, repo_slug),
+            repo_slug=repo_slug,
+            since=since,
             )
 
     async def trigger_continuous_deployment(self, repo_slug, environment, version):
@@ -186,6 +213,9 @@ class Context:
     async def get_webhook_subscriptions(self, repo_slug: str):
         return await self.plugin.get_webhook_subscriptions(self.session, repo_slug)
 
+    async def get_webhook_subscriptions_many(self, repo_slugs: list[str]):
+        return await self.plugin.get_webhook_subscriptions_many(self.session, repo_slugs)
+
     async def create_webhook_subscription(self, repo_slug, url, active, events, description):
         return await self.plugin.create_webhook_subscription_for_repo(
             self.session, repo_slug, url, active, events, description
@@ -77,3 +77,12 @@ class AuthorSyntax(SccsException):
 
 class AccessForbidden(SccsException):
     pass
+
+
+class BitbucketHTTPError(SccsException):
+    """An error response of the Bitbucket API (see plugins.bitbucket_api)."""
+
+    def __init__(self, status_code: int, body: bytes = b"", message: str | None = None):
+        super().__init__(message or f"Bitbucket answered {status_code}")
+        self.status_code = status_code
+        self.body = body
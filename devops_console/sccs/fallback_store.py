@@ -0,0 +1,248 @@
+"""
+Embedded stand-in for redis
+
+Used by RedisCache while redis is unreachable, so that the decorated functions keep caching (per
+replica) instead of failing. Stores what the cache stores in redis: encoded values with a ttl,
+their tags and a few sorted sets. Values are kept in memory (LRU, bounded in bytes); with a `path`,
+the large ones are written to a SQLite file instead.
+
+Everything written or deleted is kept until redis is back and `snapshot` is replayed on it.
+"""
+import fnmatch
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+
+@dataclass
+class _Entry:
+    value: bytes | None  # None: in the file
+    size: int
+    expires_at: float
+    tags: tuple[str, ...] = ()
+
+
+@dataclass
+class Snapshot:
+    """What happened while redis was away, in the order it must be replayed in."""
+    cleared: bool = False
+    deleted_prefixes: list[str] = field(default_factory=list)
+    invalidated_tags: list[str] = field(default_factory=list)
+    deleted_keys: list[str] = field(default_factory=list)
+    # key, value, remaining ttl (seconds), tags
+    entries: list[tuple[str, bytes, float, tuple[str, ...]]] = field(default_factory=list)
+    scores: dict[str, dict[str, float]] = field(default_factory=dict)
+
+    def __bool__(self):
+        return bool(
+            self.cleared or self.deleted_prefixes or self.invalidated_tags or self.deleted_keys
+            or self.entries or self.scores
+            )
+
+
+class FallbackStore:
+    def __init__(
+            self,
+            max_bytes: int = 128 * 1024 * 1024,
+            path: str | None = None,
+            spill_threshold: int = 64 * 1024,
+            max_file_bytes: int = 1024 * 1024 * 1024,
+            ):
+        """
+        Args:
+            max_bytes: size of the values kept in memory
+            path: SQLite file for the values larger than `spill_threshold` (None: memory only)
+            max_file_bytes: size of the values kept in the file
+        """
+        self.max_bytes = max_bytes
+        self.path = path
+        self.spill_threshold = spill_threshold
+        self.max_file_bytes = max_file_bytes
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._memory_bytes = 0
+        self._file_bytes = 0
+        self._scores: dict[str, dict[str, float]] = {}
+        self._deleted_keys: set[str] = set()
+        self._deleted_prefixes: list[str] = []
+        self._invalidated_tags: set[str] = set()
+        self._cleared = False
+        self._lock = threading.RLock()
+        self._db: sqlite3.Connection | None = None
+
+    def get(self, key: str) -> tuple[bytes | None, int]:
+        """The value and its remaining ttl in milliseconds, like GET and PTTL."""
+        with self._lock:
+            entry = self._live(key)
+            if entry is None:
+                return None, -2
+            self._entries.move_to_end(key)
+            value = entry.value if entry.value is not None else self._read(key)
+            return value, int((entry.expires_at - time.time()) * 1000)
+
+    def set(self, key: str, value: bytes, ttl: timedelta | int, tags: tuple[str, ...] = ()):
+        ttl_seconds = ttl.total_seconds() if isinstance(ttl, timedelta) else ttl
+        with self._lock:
+            self._pop(key)
+            self._deleted_keys.discard(key)
+            spill = self.path is not None and len(value) > self.spill_threshold
+            if spill:
+                if len(value) > self.max_file_bytes:
+                    return
+                self._write(key, value)
+                self._file_bytes += len(value)
+            elif len(value) > self.max_bytes:
+                return
+            else:
+                self._memory_bytes += len(value)
+            self._entries[key] = _Entry(
+                None if spill else value, len(value), time.time() + ttl_seconds, tuple(tags)
+                )
+            self._evict()
+
+    def exists(self, key: str) -> bool:
+        with self._lock:
+            return self._live(key) is not None
+
+    def delete(self, *keys: str) -> int:
+        with self._lock:
+            self._deleted_keys.update(keys)
+            return sum(self._pop(key) for key in keys)
+
+    def delete_prefix(self, prefix: str) -> int:
+        with self._lock:
+            if prefix == "":
+                self._cleared = True
+                self._deleted_prefixes.clear()
+                self._invalidated_tags.clear()
+                self._deleted_keys.clear()
+            else:
+                self._deleted_prefixes.append(prefix)
+            keys = [key for key in self._entries if key.startswith(prefix)]
+            for key in keys:
+                self._pop(key)
+            for name in [name for name in self._scores if name.startswith(prefix)]:
+                del self._scores[name]
+            return len(keys)
+
+    def keys(self, match: str = "*") -> list[str]:
+        with self._lock:
+            return [
+                key for key in list(self._entries)
+                if fnmatch.fnmatchcase(key, match) and self._live(key) is not None
+                ]
+
+    def tagged(self, *tags: str) -> list[str]:
+        tags = set(tags)
+        with self._lock:
+            return [
+                key for key, entry in list(self._entries.items())
+                if tags.intersection(entry.tags) and self._live(key) is not None
+                ]
+
+    def invalidate_tags(self, *tags: str) -> int:
+        with self._lock:
+            self._invalidated_tags.update(tags)
+            keys = self.tagged(*tags)
+            for key in keys:
+                self._pop(key)
+            return len(keys)
+
+    def increment_score(self, name: str, member: str, amount: float = 1):
+        with self._lock:
+            scores = self._scores.setdefault(name, {})
+            scores[member] = scores.get(member, 0) + amount
+
+    def top(self, name: str, n: int) -> list[str]:
+        with self._lock:
+            scores = self._scores.get(name, {})
+            return sorted(scores, key=scores.get, reverse=True)[:n]
+
+    def snapshot(self) -> Snapshot:
+        now = time.time()
+        with self._lock:
+            entries = []
+            for key, entry in self._entries.items():
+                if entry.expires_at > now:
+                    value = entry.value if entry.value is not None else self._read(key)
+                    entries.append((key, value, entry.expires_at - now, entry.tags))
+            return Snapshot(
+                cleared=self._cleared,
+                deleted_prefixes=list(self._deleted_prefixes),
+                invalidated_tags=sorted(self._invalidated_tags),
+                deleted_keys=sorted(self._deleted_keys),
+                entries=entries,
+                scores={name: dict(scores) for name, scores in self._scores.items()},
+                )
+
+    def clear(self):
+        """Forget everything (once replayed on redis)."""
+        with self._lock:
+            self._entries.clear()
+            self._memory_bytes = self._file_bytes = 0
+            self._scores.clear()
+            self._deleted_keys.clear()
+            self._deleted_prefixes.clear()
+            self._invalidated_tags.clear()
+            self._cleared = False
+            if self._db is not None:
+                self._db.execute("DELETE FROM entries")
+                self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "memory_bytes": self._memory_bytes,
+                "file_bytes": self._file_bytes,
+                "path": self.path,
+                }
+
+    def _live(self, key: str) -> _Entry | None:
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= time.time():
+            self._pop(key)
+            return None
+        return entry
+
+    def _pop(self, key: str) -> int:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return 0
+        if entry.value is None:
+            self._file_bytes -= entry.size
+            self._connection().execute("DELETE FROM entries WHERE key = ?", (key,))
+        else:
+            self._memory_bytes -= entry.size
+        return 1
+
+    def _evict(self):
+        for key in list(self._entries):
+            if self._memory_bytes <= self.max_bytes and self._file_bytes <= self.max_file_bytes:
+                return
+            entry = self._entries[key]
+            if entry.value is None and self._file_bytes > self.max_file_bytes:
+                self._pop(key)
+            elif entry.value is not None and self._memory_bytes > self.max_bytes:
+                self._pop(key)
+
+    def _read(self, key: str) -> bytes | None:
+        row = self._connection().execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _write(self, key: str, value: bytes):
+        db = self._connection()
+        db.execute("INSERT OR REPLACE INTO entries (key, value) VALUES (?, ?)", (key, value))
+        db.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None:
+            # only used under the lock, from whichever thread holds it
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB)")
+            # what a previous process left behind isn't indexed: start empty
+            self._db.execute("DELETE FROM entries")
+            self._db.commit()
+        return self._db
@@ -0,0 +1,104 @@
+"""
+In-process front cache for RedisCache
+
+Keeps recently used, already deserialized values in memory so that hot keys don't cost a network
+round-trip and an unpickle on every read. Entries are bounded by count and by (serialized) size
+and expire after their own TTL, which is never longer than the TTL of the value in redis.
+"""
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Any
+
+
+@dataclass
+class _Entry:
+    value: Any
+    size: int
+    expires_at: float
+
+
+class LocalCache:
+    """Thread-safe LRU with per-entry TTL.
+
+    Values are shared between callers: they must be treated as read-only.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 64 * 1024 * 1024,
+                 max_ttl: timedelta = timedelta(minutes=5)):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_ttl = max_ttl
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None) -> Any:
+        if not self.enabled:
+            return default
+        key = _normalize(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry.expires_at <= time.monotonic():
+                self._pop(key)
+                return default
+            self._entries.move_to_end(key)
+            return entry.value
+
+    def set(self, key, value, size: int, ttl: timedelta | int | None = None):
+        if not self.enabled or size > self.max_bytes:
+            return
+        key = _normalize(key)
+        ttl_seconds = self.max_ttl.total_seconds()
+        if ttl is not None:
+            ttl_seconds = min(ttl_seconds, ttl.total_seconds() if isinstance(ttl, timedelta) else ttl)
+        if ttl_seconds <= 0:
+            return
+
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = _Entry(value, size, time.monotonic() + ttl_seconds)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def delete(self, *keys) -> int:
+        n = 0
+        with self._lock:
+            for key in keys:
+                n += self._pop(_normalize(key))
+        return n
+
+    def delete_prefix(self, prefix: str) -> int:
+        with self._lock:
+            keys = [k for k in self._entries if k.startswith(prefix)]
+            for key in keys:
+                self._pop(key)
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _pop(self, key: str) -> int:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return 0
+        self._bytes -= entry.size
+        return 1
+
+
+def _normalize(key) -> str:
+    return key.decode() if isinstance(key, bytes) else str(key)
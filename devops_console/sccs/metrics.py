@@ -0,0 +1,155 @@
+"""
+In-process metrics
+
+A minimal registry of counters, gauges and histograms with labels, rendered in the Prometheus text
+exposition format. Values are per process: each replica exposes its own.
+"""
+import bisect
+import math
+import threading
+from dataclasses import dataclass, field
+
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = tuple(256 * 4 ** i for i in range(9))  # 256B .. 16MiB
+
+Labels = tuple[tuple[str, str], ...]
+
+
+@dataclass
+class Histogram:
+    buckets: tuple[float, ...]
+    counts: list[int] = field(default_factory=list)
+    sum: float = 0.0
+    count: int = 0
+
+    def __post_init__(self):
+        if not self.counts:
+            self.counts = [0] * len(self.buckets)
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "avg": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            }
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket containing the q-th quantile (inf when above the last one)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return math.inf
+
+
+@dataclass
+class _Metric:
+    name: str
+    kind: str
+    help: str
+    buckets: tuple[float, ...] = ()
+    samples: dict[Labels, float | Histogram] = field(default_factory=dict)
+
+
+class Metrics:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str):
+        self._describe(name, "counter", help)
+
+    def gauge(self, name: str, help: str):
+        self._describe(name, "gauge", help)
+
+    def histogram(self, name: str, help: str, buckets: tuple[float, ...] = TIME_BUCKETS):
+        self._describe(name, "histogram", help, buckets)
+
+    def _describe(self, name: str, kind: str, help: str, buckets: tuple[float, ...] = ()):
+        with self._lock:
+            self._metrics.setdefault(name, _Metric(name, kind, help, buckets))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        metric = self._metrics[name]
+        key = _labels(labels)
+        with self._lock:
+            metric.samples[key] = metric.samples.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        metric = self._metrics[name]
+        with self._lock:
+            metric.samples[_labels(labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        metric = self._metrics[name]
+        key = _labels(labels)
+        with self._lock:
+            histogram = metric.samples.get(key)
+            if histogram is None:
+                histogram = metric.samples[key] = Histogram(metric.buckets)
+            histogram.observe(value)
+
+    def samples(self, name: str) -> dict[Labels, float | Histogram]:
+        with self._lock:
+            return dict(self._metrics[name].samples)
+
+    def reset(self):
+        with self._lock:
+            for metric in self._metrics.values():
+                metric.samples.clear()
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for metric in self._metrics.values():
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+                for labels, sample in metric.samples.items():
+                    if isinstance(sample, Histogram):
+                        cumulative = 0
+                        for bound, n in zip(sample.buckets, sample.counts):
+                            cumulative += n
+                            le = labels + (("le", _number(bound)),)
+                            lines.append(f"{metric.name}_bucket{_format(le)} {cumulative}")
+                        le = labels + (("le", "+Inf"),)
+                        lines.append(f"{metric.name}_bucket{_format(le)} {sample.count}")
+                        lines.append(f"{metric.name}_sum{_format(labels)} {_number(sample.sum)}")
+                        lines.append(f"{metric.name}_count{_format(labels)} {sample.count}")
+                    else:
+                        lines.append(f"{metric.name}{_format(labels)} {_number(sample)}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for k, v in labels
+        )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _number(v: float) -> str:
+    if v == math.inf:
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) and not v.is_integer() else str(int(v))
+
+
+metrics = Metrics()
@@ -291,6 +291,23 @@ class SccsApi(ABC):
         """
         raise NotImplementedError()
 
+    def patch_continuous_deployment_config(
+            self, repo_slug: str, configs: list[EnvironmentConfig], event_key: str, payload: dict
+            ) -> tuple[list[EnvironmentConfig], bool]:
+        """Apply a webhook event to the continuous deployment configuration, without calling the
+        source code control system. Plugins should override this when their webhooks say enough.
+
+        Args:
+            repo_slug(str): the repository name
+            configs(list(typing.cd.EnvironmentConfig)): the current configuration
+            event_key(str): the webhook event (eg: repo:push)
+            payload(dict): the webhook payload
+
+        Returns:
+            the patched configuration, and whether it is complete (False: it has to be fetched again)
+        """
+        return configs, False
+
     @abstractmethod
     async def get_continuous_deployment_environments_available(
             self, session, repository
@@ -409,6 +426,14 @@ class SccsApi(ABC):
     async def get_webhook_subscriptions(self, session, repo_slug: str):
         raise NotImplementedError()
 
+    async def get_webhook_subscriptions_many(self, session, repo_slugs: list[str]) -> dict:
+        """Webhook subscriptions of several repositories, by slug. Plugins should override this when
+        they can do better than one call per repository."""
+        return {
+            repo_slug: await self.get_webhook_subscriptions(session, repo_slug)
+            for repo_slug in repo_slugs
+            }
+
     @abstractmethod
     async def create_webhook_subscription_for_repo(
             self,
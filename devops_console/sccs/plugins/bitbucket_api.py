@@ -0,0 +1,263 @@
+# Copyright 2021-2022 Croix Bleue du Québec
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Bitbucket Cloud API client
+
+Async client for the endpoints used by the bitbucketcloud plugin and SccsV2. Before it, every call
+went through atlassian-python-api (blocking requests, run on the default thread pool with
+run_async): each call held a thread, and each session had connections of its own. Instead:
+- the connections are pooled per event loop and shared by every client (i.e. every user), and kept
+  alive between calls; at most `MAX_CONNECTIONS` are open at once
+- the responses are parsed with orjson
+- the paginated endpoints are async iterators, following the `next` links
+
+    bitbucket = Bitbucket(username, app_password)
+    async for repository in bitbucket.repositories("workspace"):
+        ...
+
+Error responses are raised as `BitbucketHTTPError`s, with their status code: the cache decorators
+cache the 404s (see negative_ttl) and the API endpoints answer with the same status.
+"""
+import asyncio
+import base64
+import os
+import time
+from typing import Any, AsyncIterator
+from urllib.parse import quote
+
+import aiohttp
+import orjson
+
+from ..errors import BitbucketHTTPError
+from ..metrics import metrics
+
+API_URL = os.environ.get('BITBUCKET_API_URL', "https://api.bitbucket.org/2.0/")
+MAX_CONNECTIONS = int(os.environ.get('BITBUCKET_MAX_CONNECTIONS', 64))
+# seconds
+TIMEOUT = float(os.environ.get('BITBUCKET_TIMEOUT', 30))
+KEEPALIVE = float(os.environ.get('BITBUCKET_KEEPALIVE', 60))
+
+metrics.counter("bitbucket_requests_total", "Requests to the Bitbucket API, by method and status")
+metrics.histogram("bitbucket_request_seconds", "Duration of the requests to the Bitbucket API")
+
+_pool: aiohttp.ClientSession | None = None
+_pool_loop: asyncio.AbstractEventLoop | None = None
+
+
+def _connections() -> aiohttp.ClientSession:
+    """The connection pool of the running event loop."""
+    global _pool, _pool_loop
+    loop = asyncio.get_running_loop()
+    if _pool is None or _pool.closed or _pool_loop is not loop:
+        _pool = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS, keepalive_timeout=KEEPALIVE),
+            timeout=aiohttp.ClientTimeout(total=TIMEOUT),
+            json_serialize=lambda value: orjson.dumps(value).decode(),
+            raise_for_status=False,
+            )
+        _pool_loop = loop
+    return _pool
+
+
+async def close_connections():
+    """Close the connection pool (on shutdown)."""
+    global _pool
+    if _pool is not None and _pool_loop is asyncio.get_running_loop():
+        await _pool.close()
+    _pool = None
+
+
+def _http_error(method: str, url: str, status: int, reason: str | None, body: bytes) -> BitbucketHTTPError:
+    try:
+        message = orjson.loads(body)["error"]["message"]
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        message = reason
+    return BitbucketHTTPError(status, body, f"{status} {message}: {method} {url}")
+
+
+class Bitbucket:
+    def __init__(self, username: str, password: str, url: str = API_URL):
+        """
+        Args:
+            username: the user (or the watcher user)
+            password: an app password
+            url: the root of the API
+        """
+        self.username = username
+        self.password = password
+        self.url = url if url.endswith("/") else f"{url}/"
+        credentials = base64.b64encode(f"{username}:{password}".encode()).decode()
+        self._headers = {"Authorization": f"Basic {credentials}"}
+
+    async def request(
+            self, method: str, path: str, params=None, json=None, data=None, raw: bool = False
+            ) -> Any:
+        """
+        Args:
+            path: relative to the root of the API, or an absolute url (e.g. a `next` link)
+            raw: return the body as is, instead of parsing it
+
+        Returns:
+            the parsed response (None if there is none), or the body if `raw`
+        """
+        url = path if path.startswith(("http://", "https://")) else self.url + path.lstrip("/")
+        start = time.monotonic()
+        async with _connections().request(
+                method, url, params=params, json=json, data=data, headers=self._headers
+                ) as response:
+            body = await response.read()
+        metrics.inc("bitbucket_requests_total", method=method, status=response.status)
+        metrics.observe("bitbucket_request_seconds", time.monotonic() - start)
+        if response.status >= 400:
+            raise _http_error(method, url, response.status, response.reason, body)
+        if raw:
+            return body
+        return orjson.loads(body) if body else None
+
+    async def get(self, path: str, params=None) -> Any:
+        return await self.request("GET", path, params=params)
+
+    async def paged(self, path: str, params: dict | None = None, page_numbers: bool = False) -> AsyncIterator:
+        """
+        The values of every page, fetched as they are consumed.
+
+        Args:
+            page_numbers: go through the pages by number, instead of by their `next` link (the
+                pipelines don't always have one, see https://jira.atlassian.com/browse/BCLOUD-13806)
+        """
+        params = dict(params or {})
+        if page_numbers:
+            params["page"] = 1
+        while True:
+            page = await self.get(path, params=params) or {}
+            values = page.get("values") or []
+            if not values:
+                return
+            for value in values:
+                yield value
+            if page_numbers:
+                params["page"] += 1
+            else:
+                # the link has the parameters
+                path, params = page.get("next"), None
+                if path is None:
+                    return
+
+    # Permissions
+
+    def permissions(self, **params) -> AsyncIterator[dict]:
+        """The user's permission on each repository they can see."""
+        return self.paged("user/permissions/repositories", {"pagelen": 100, **params})
+
+    async def repository_permission(self, workspace: str, repo_slug: str, username: str) -> dict:
+        return await self.get(f"{_repository(workspace, repo_slug)}/permissions-config/users/{username}")
+
+    # Workspaces
+
+    def projects(self, workspace: str, **params) -> AsyncIterator[dict]:
+        return self.paged(f"workspaces/{workspace}/projects", {"pagelen": 100, **params})
+
+    # Repositories
+
+    def repositories(self, workspace: str, **params) -> AsyncIterator[dict]:
+        return self.paged(f"repositories/{workspace}", {"pagelen": 100, **params})
+
+    async def repository(self, workspace: str, repo_slug: str) -> dict:
+        return await self.get(_repository(workspace, repo_slug))
+
+    async def create_repository(self, workspace: str, repo_slug: str, **definition) -> dict:
+        return await self.request("POST", _repository(workspace, repo_slug), json=definition)
+
+    # Branches
+
+    async def branch(self, workspace: str, repo_slug: str, name: str) -> dict:
+        return await self.get(f"{_repository(workspace, repo_slug)}/refs/branches/{quote(name)}")
+
+    async def create_branch(self, workspace: str, repo_slug: str, name: str, commit_hash: str) -> dict:
+        return await self.request(
+            "POST",
+            f"{_repository(workspace, repo_slug)}/refs/branches",
+            json={"name": name, "target": {"hash": commit_hash}},
+            )
+
+    async def delete_branch(self, workspace: str, repo_slug: str, name: str):
+        await self.request("DELETE", f"{_repository(workspace, repo_slug)}/refs/branches/{quote(name)}")
+
+    # Source
+
+    async def src(self, workspace: str, repo_slug: str, commit: str, path: str) -> bytes:
+        """The content of a file."""
+        return await self.request(
+            "GET", f"{_repository(workspace, repo_slug)}/src/{commit}/{quote(path)}", raw=True
+            )
+
+    async def commit_files(self, workspace: str, repo_slug: str, files: dict[str, str], **fields):
+        """Commit `files` (path -> content), e.g. with a message, an author and a branch."""
+        await self.request("POST", f"{_repository(workspace, repo_slug)}/src", data={**files, **fields})
+
+    # Commits
+
+    async def commits(self, workspace: str, repo_slug: str, revision: str, **params) -> dict:
+        """One page of the commits reachable from `revision`, most recent first."""
+        return await self.get(f"{_repository(workspace, repo_slug)}/commits/{quote(revision)}", params=params)
+
+    async def commit(self, workspace: str, repo_slug: str, commit_hash: str) -> dict:
+        return await self.get(f"{_repository(workspace, repo_slug)}/commit/{commit_hash}")
+
+    # Pipelines
+
+    def pipelines(self, workspace: str, repo_slug: str, **params) -> AsyncIterator[dict]:
+        return self.paged(f"{_repository(workspace, repo_slug)}/pipelines/", params, page_numbers=True)
+
+    # Pull requests
+
+    def pullrequests(self, workspace: str, repo_slug: str, **params) -> AsyncIterator[dict]:
+        """The open pull requests, unless a state is given."""
+        return self.paged(f"{_repository(workspace, repo_slug)}/pullrequests", {"pagelen": 50, **params})
+
+    async def create_pullrequest(
+            self,
+            workspace: str,
+            repo_slug: str,
+            title: str,
+            source_branch: str,
+            destination_branch: str,
+            close_source_branch: bool = False,
+            ) -> dict:
+        return await self.request(
+            "POST",
+            f"{_repository(workspace, repo_slug)}/pullrequests",
+            json={
+                "title": title,
+                "source": {"branch": {"name": source_branch}},
+                "destination": {"branch": {"name": destination_branch}},
+                "close_source_branch": close_source_branch,
+                },
+            )
+
+    # Webhooks
+
+    def hooks(self, workspace: str, repo_slug: str) -> AsyncIterator[dict]:
+        return self.paged(f"{_repository(workspace, repo_slug)}/hooks", {"pagelen": 100})
+
+    async def create_hook(self, workspace: str, repo_slug: str, **hook) -> dict:
+        return await self.request("POST", f"{_repository(workspace, repo_slug)}/hooks", json=hook)
+
+    async def delete_hook(self, workspace: str, repo_slug: str, uid: str):
+        await self.request("DELETE", f"{_repository(workspace, repo_slug)}/hooks/{uid}")
+
+
+def _repository(workspace: str, repo_slug: str) -> str:
+    return f"repositories/{workspace}/{repo_slug}"
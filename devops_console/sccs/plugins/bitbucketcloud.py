@@ -14,34 +14,52 @@
 
 from __future__ import annotations
 
+import asyncio
 import inspect
 import logging
+import re
+import time
 from datetime import timedelta
 
-from atlassian.bitbucket import Cloud
-from atlassian.bitbucket.cloud.repositories import Repository
-from atlassian.bitbucket.cloud.repositories.pipelines import Pipeline
-from atlassian.bitbucket.cloud.repositories.refs import Branch
-from atlassian.bitbucket.cloud.workspaces import Projects, Workspace
-from atlassian.rest_client import AtlassianRestAPI
-from requests import HTTPError
+from anyio import create_task_group
 
 from devops_console.schemas import WebhookEvent
 from devops_console.sccs.schemas.config import EnvironmentConfiguration, PluginConfig
+from .bitbucket_api import Bitbucket
 from .cache_keys import cache_key_fns
 from ..accesscontrol import Action, Permission
 from ..client import register_plugin, SccsClient
-from ..errors import SccsException, TriggerCdEnvUnsupported
+from ..errors import AccessForbidden, BitbucketHTTPError, SccsException, TriggerCdEnvUnsupported
 from ..plugin import SccsApi, StoredSession
 from ..provision import Provision
-from ..redis import cache_async
+from ..redis import cache_async, cache_async_many
 from ..typing import cd as typing_cd, repositories as typing_repo
 from ..typing.credentials import Credentials
 from ..utils import cd as utils_cd
 from ..utils.aioify import run_async
+from ..utils.digest import stable_hash
 
 PLUGIN_NAME = "bitbucketcloud"
 
+# commit message of trigger_continuous_deployment, which writes the version file
+_DEPLOY_MESSAGE = re.compile(r"deploy version (\S+)")
+
+# how often accesscontrol may fetch a user's permissions again, bypassing the cache, for a repository
+# missing from them (it's a crawl of every repository the user can see)
+PERMISSIONS_REFETCH_INTERVAL = timedelta(minutes=1)
+# username -> when accesscontrol last fetched their permissions again (time.monotonic())
+_permissions_refetched: dict[str, float] = {}
+
+
+
+def _may_refetch_permissions(username: str) -> bool:
+    now = time.monotonic()
+    last = _permissions_refetched.get(username)
+    if last is not None and now - last < PERMISSIONS_REFETCH_INTERVAL.total_seconds():
+        return False
+    # before fetching: the concurrent checks don't fetch too
+    _permissions_refetched[username] = now
+    return True
 
 class BitbucketCloud(SccsApi):
     async def init(self, core: SccsClient, config: PluginConfig):
@@ -65,11 +83,7 @@ class BitbucketCloud(SccsApi):
                 author=f"Admin User <{config.watcher.email}>",
                 apikey=config.watcher.pwd,
             )
-            self.admin_session = Cloud(
-                username=self.watcher_user.user,
-                password=self.watcher_user.apikey,
-                cloud=True,
-            )
+            self.admin_session = Bitbucket(self.watcher_user.user, self.watcher_user.apikey)
         except KeyError:
             logging.error("Watcher credentials are missing from the configuration file.")
             raise
@@ -85,13 +99,13 @@ class BitbucketCloud(SccsApi):
     async def cleanup(self):
         pass
 
-    def get_session_id(self, credentials: Credentials | Cloud | None) -> int:
+    def get_session_id(self, credentials: Credentials | Bitbucket | None) -> int:
         if credentials is None:
-            return hash((self.admin_session.username, self.admin_session.password))
-        elif isinstance(credentials, Cloud):
-            return hash((credentials.username, credentials.password))
+            return stable_hash((self.admin_session.username, self.admin_session.password))
+        elif isinstance(credentials, Bitbucket):
+            return stable_hash((credentials.username, credentials.password))
         elif isinstance(credentials, Credentials):
-            return hash((credentials.user, credentials.apikey))
+            return stable_hash((credentials.user, credentials.apikey))
 
         raise SccsException("Invalid credentials")
 
@@ -105,7 +119,7 @@ class BitbucketCloud(SccsApi):
         stored = StoredSession(
             id=session_id,
             shared_sessions=1,
-            session=Cloud(username=credentials.user, password=credentials.apikey, cloud=True)
+            session=Bitbucket(credentials.user, credentials.apikey)
             if credentials is not None
             else self.admin_session,
             credentials=credentials if credentials is not None else self.watcher_user,
@@ -132,7 +146,7 @@ class BitbucketCloud(SccsApi):
                 pass
 
     async def get_stored_session(
-        self, session_id: int | None, session: Cloud | None = None
+        self, session_id: int | None, session: Bitbucket | None = None
     ) -> StoredSession | None:
         if session_id is None:
             if session is not None:
@@ -143,7 +157,7 @@ class BitbucketCloud(SccsApi):
         return self.local_sessions.get(session_id)
 
     @staticmethod
-    def __log_session(session: Cloud | None):
+    def __log_session(session: Bitbucket | None):
         """
         helper function for keeping track of who calls what.
         """
@@ -155,58 +169,78 @@ class BitbucketCloud(SccsApi):
     def __new__(cls):
         return super().__new__(cls)
 
-    @cache_async(ttl=timedelta(weeks=1))
-    async def accesscontrol(self, session: Cloud, repo_slug: str, action: int = 0):
+    async def accesscontrol(self, session: Bitbucket, repo_slug: str, action: int = 0):
         """see plugin.py"""
-        # will raise an HTTPError if access is forbidden
+        # will raise a BitbucketHTTPError if the credentials are invalid
         try:
-            await run_async(
-                session.get,
-                "user/permissions/repositories",
-                params=[("q", f'repository.name="{repo_slug}"')],
-            )  # type: ignore
-        except HTTPError as e:
+            permissions = await self.get_repository_permissions(session)
+            if repo_slug not in permissions and _may_refetch_permissions(session.username):
+                # the cached permissions may predate the repository (or the user's access to it)
+                permissions = await self.get_repository_permissions(session, fetch=True)
+        except BitbucketHTTPError as e:
             logging.error(f"Access denied: {e}")
             raise
+        if repo_slug not in permissions:
+            logging.error(f"Access denied: {session.username} has no access to {repo_slug}")
+            raise AccessForbidden(f"Access to {repo_slug} is forbidden")
 
-    async def passthrough(self, session: Cloud, request):
+    async def passthrough(self, session: Bitbucket, request):
         return await super().passthrough(session, request)
 
-    @cache_async(ttl=timedelta(days=1), key="repositories")
-    async def get_repositories(self, session: Cloud | None) -> list[typing_repo.Repository]:
+    @cache_async(
+        ttl=timedelta(days=1),
+        soft_ttl=timedelta(hours=12),
+        key=cache_key_fns["get_repository_catalog"],
+        write_behind=True,
+    )
+    async def get_repository_catalog(self) -> list[typing_repo.Repository]:
+        """
+        Every repository of the workspace, without permissions. Shared by all the sessions: see
+        get_repositories for a user's view of it.
+        """
+        return [
+            typing_repo.Repository(
+                key=stable_hash(repository["name"]),
+                name=repository["name"],
+                slug=repository["full_name"].split("/")[1],
+                url=repository["links"]["html"]["href"],
+            )
+            async for repository in self.admin_session.repositories(
+                self.team, fields="next,values.name,values.full_name,values.links.html.href"
+            )
+        ]
+
+    @cache_async(
+        ttl=timedelta(days=1),
+        soft_ttl=timedelta(hours=12),
+        key=cache_key_fns["get_repository_permissions"],
+        tags=["user:{session.username}"],
+    )
+    async def get_repository_permissions(self, session: Bitbucket) -> dict[str, str]:
+        """The user's permission on each repository of the workspace they can see, by slug."""
+        permissions = {}
+        async for repository_permission in session.permissions(
+            fields="next,values.permission,values.repository.full_name"
+        ):
+            workspace, slug = repository_permission["repository"]["full_name"].split("/")
+            if workspace == self.team:
+                permissions[slug] = repository_permission["permission"]
+        return permissions
+
+    async def get_repositories(self, session: Bitbucket | None) -> list[typing_repo.Repository]:
         """see plugin.py"""
         if session is None:
             session = self.admin_session
 
-        def get_repos_sync():
-            result: list[typing_repo.Repository] = []
-            for repository_permission in session._get_paged(
-                "user/permissions/repositories", params={"pagelen": 100}
-            ):
-                assert isinstance(repository_permission, dict)
-                repository = repository_permission["repository"]
-                full_name = repository["full_name"]
-
-                result.append(
-                    typing_repo.Repository(
-                        key=hash(repository_permission["repository"]["name"]),
-                        name=repository["name"],
-                        slug=full_name.split("/")[1],
-                        url=repository["links"]["html"]["href"],
-                        permission=repository_permission["permission"],
-                    )
-                )
-            return result
-
-        return await run_async(get_repos_sync)
+        permissions = await self.get_repository_permissions(session)
+        return [
+            repository.copy(update={"permission": permissions[repository.slug]})
+            for repository in await self.get_repository_catalog()
+            if repository.slug in permissions
+        ]
 
-    @cache_async(ttl=timedelta(days=1))
-    async def api_workspace(self, session: Cloud) -> Workspace:
-        return await run_async(session.workspaces.get, self.team)
-
-    @cache_async(ttl=timedelta(days=1))
     async def get_repository(
-        self, session: Cloud, repo_slug: str, by="slug"
+        self, session: Bitbucket, repo_slug: str, by="slug"
     ) -> typing_repo.Repository | None:
         """see plugin.py"""
         repos = await self.get_repositories(session)
@@ -217,17 +251,9 @@ class BitbucketCloud(SccsApi):
                 return repo
         return None
 
-    async def get_api_repository(self, session: Cloud, repo_slug: str) -> Repository | None:
-        """Returns an unmodified Repository object as returned by the API"""
-        await self.accesscontrol(session, repo_slug)
-
-        workspace = await self.api_workspace(session)
-
-        return await run_async(workspace.repositories.get, repo_slug)
-
     async def add_repository(
         self,
-        session: Cloud,
+        session: Bitbucket,
         provision: Provision,
         repo_definition: dict,
         template: str,
@@ -239,11 +265,13 @@ class BitbucketCloud(SccsApi):
 
     @cache_async(
         ttl=timedelta(days=1),
+        soft_ttl=timedelta(hours=12),
         key=cache_key_fns["get_continuous_deployment_config"],
+        tags=["repo:{repo_slug}"],
     )
     async def get_continuous_deployment_config(
         self,
-        session: Cloud | None,
+        session: Bitbucket | None,
         repo_slug: str,
         environments=None,
     ) -> list[typing_cd.EnvironmentConfig]:
@@ -255,40 +283,45 @@ class BitbucketCloud(SccsApi):
 
         session = self.admin_session
 
-        repo = await self.get_api_repository(session, repo_slug)
-        if repo is None:
-            return []
-
-        def get_deploys_sync():
-            deploys = []
-            # Get supported branches
-            for idx, branch_name in enumerate(self.cd_branches_accepted):
-                try:
-                    if len(environments) == 0 or self.cd_environments[idx].name in environments:
-                        b = repo.branches.get(branch_name)
-                        deploys.append((b, idx))
-                except (KeyError, ValueError, HTTPError):
-                    pass
-
-            return sorted(deploys, key=lambda d: d[1])
+        await self.accesscontrol(session, repo_slug)
 
-        deploys = await run_async(get_deploys_sync)
+        async def get_branch(index: int) -> tuple[dict, int] | None:
+            try:
+                return await session.branch(self.team, repo_slug, self.cd_branches_accepted[index]), index
+            except BitbucketHTTPError:
+                return None
+
+        # Get supported branches (concurrently, in the order of the environments)
+        deploys = [
+            deploy
+            for deploy in await asyncio.gather(
+                *(
+                    get_branch(index)
+                    for index, env in enumerate(self.cd_environments)
+                    if len(environments) == 0 or env.name in environments
+                )
+            )
+            if deploy is not None
+        ]
 
         if len(deploys) == 0:
             logging.warning(f"Continuous deployment not supported for {repo_slug}")
             return []
 
-        results = []
-
-        for branch, index in deploys:
-            cfg = await self.get_continuous_deployment_config_by_branch(
-                repo, branch, self.cd_environments[index]
+        results = await asyncio.gather(
+            *(
+                self.get_continuous_deployment_config_by_branch(
+                    repo_slug, branch, self.cd_environments[index]
+                )
+                for branch, index in deploys
             )
-            results.append(cfg[1])
+        )
 
-        return results
+        return [cfg for _, cfg in results]
 
-    @cache_async(ttl=timedelta(days=1))
+    @cache_async(
+        ttl=timedelta(days=1), soft_ttl=timedelta(hours=12), write_behind=True, tags=["repo:{repo_slug}"]
+    )
     async def get_continuous_deployment_versions_available(self, repo_slug: str) -> list[typing_cd.Available]:
         """
         Get the list of version available to deploy
@@ -297,76 +330,60 @@ class BitbucketCloud(SccsApi):
 
         versions: list[typing_cd.Available] = []
 
-        repo = await self.get_api_repository(session, repo_slug)
-        if repo is None:
-            return versions
-
-        # noinspection PyProtectedMember
-        def pl_gen():
-            # NB: there is a `each()` method, but it doesn't have a pagelen parameter; so we have to do it manually
-            for pl in repo.pipelines._get_paged(
-                None,
-                trailing=True,
-                paging_workaround=True,
-                params={"q": "target.ref_name=master", "sort": "-created_on", "pagelen": 100},
-            ):
-                yield Pipeline(
-                    AtlassianRestAPI.url_joiner(repo.pipelines.url, pl["uuid"]),
-                    pl,
-                    **repo.pipelines._new_session_args,
-                )
-
-        def get_versions_sync():
-            for pipeline in pl_gen():
-                target = pipeline.get_data("target")
-                state = pipeline.get_data("state")
-                if target is None or state is None or target["type"] != "pipeline_ref_target":
-                    continue
-                ref_name = target["ref_name"]
-                try:
-                    result_name = state["result"]["name"]
-                except KeyError:
-                    logging.warning(f"Unexpected pipeline state: {state['name']}")
-                    # TODO handle this error. Typically we see this exception when state["name"] ==
-                    # "IN_PROGESS" which could be useful information to pass along to the caller
-                    # although it falls outside the mandate of the current function.
-                    continue
-                if ref_name in self.cd_versions_available and result_name == "SUCCESSFUL":
-                    available = typing_cd.Available(
-                        key=hash((repo_slug, pipeline.build_number)),
-                        build=str(pipeline.build_number),
-                        version=target["commit"]["hash"],
-                    )
-                    versions.append(available)
+        await self.accesscontrol(session, repo_slug)
 
-            return versions
+        async for pipeline in session.pipelines(
+            self.team, repo_slug, q="target.ref_name=master", sort="-created_on", pagelen=100
+        ):
+            target = pipeline.get("target")
+            state = pipeline.get("state")
+            if target is None or state is None or target["type"] != "pipeline_ref_target":
+                continue
+            ref_name = target["ref_name"]
+            try:
+                result_name = state["result"]["name"]
+            except KeyError:
+                logging.warning(f"Unexpected pipeline state: {state['name']}")
+                # TODO handle this error. Typically we see this exception when state["name"] ==
+                # "IN_PROGESS" which could be useful information to pass along to the caller
+                # although it falls outside the mandate of the current function.
+                continue
+            if ref_name in self.cd_versions_available and result_name == "SUCCESSFUL":
+                available = typing_cd.Available(
+                    key=stable_hash((repo_slug, pipeline["build_number"])),
+                    build=str(pipeline["build_number"]),
+                    version=target["commit"]["hash"],
+                )
+                versions.append(available)
 
-        return await run_async(get_versions_sync)
+        return versions
 
-    @cache_async(ttl=timedelta(days=1))
+    @cache_async(ttl=timedelta(days=1), soft_ttl=timedelta(hours=12), tags=["repo:{repo_slug}"])
     async def get_continuous_deployment_environments_available(
-        self, session: Cloud | None, repo_slug: str
+        self, session: Bitbucket | None, repo_slug: str
     ) -> list[typing_cd.EnvironmentConfig]:
         session = self.admin_session
 
-        envs: list[typing_cd.EnvironmentConfig] = []
-
-        repo = await self.get_api_repository(session, repo_slug)
-        if repo is None:
-            return envs
+        await self.accesscontrol(session, repo_slug)
 
-        for environment in self.cd_environments:
+        async def get_environment(
+            environment: EnvironmentConfiguration,
+        ) -> typing_cd.EnvironmentConfig | None:
             try:
-                branch = await run_async(repo.branches.get, environment.branch)
-                (_, cfg) = await self.get_continuous_deployment_config_by_branch(repo, branch, environment)
+                branch = await session.branch(self.team, repo_slug, environment.branch)
+                (_, cfg) = await self.get_continuous_deployment_config_by_branch(
+                    repo_slug, branch, environment
+                )
             except Exception:
-                continue
-            envs.append(cfg)
+                return None
+            return cfg
 
-        return envs
+        envs = await asyncio.gather(*map(get_environment, self.cd_environments))
+
+        return [cfg for cfg in envs if cfg is not None]
 
     async def trigger_continuous_deployment(
-        self, session: Cloud, repo_slug: str, environment: str, version: str
+        self, session: Bitbucket, repo_slug: str, environment: str, version: str
     ) -> typing_cd.EnvironmentConfig:
         """
         Trigger a deployment in a specific environment
@@ -404,10 +421,6 @@ class BitbucketCloud(SccsApi):
 
         utils_cd.trigger_prepare(continuous_deployment, versions_available, repo_slug, environment, version)
 
-        repo = await self.get_api_repository(session, repo_slug)
-        if repo is None:
-            raise TriggerCdEnvUnsupported(repo_slug, environment)
-
         # noinspection PyUnboundLocalVariable
         branch_name = (
             cd_environment_config.branch
@@ -418,27 +431,27 @@ class BitbucketCloud(SccsApi):
         if cd_environment_config.trigger.get("pullrequest", False):
             # Continuous Deployment is done with a PR.
             # We need to check if there is already one open (the version requested doesn't matter)
-            def check_pr_sync():
-                for pullrequest in repo.pullrequests.each():
-                    if (
-                        pullrequest.destination_branch == branch_name
-                        and pullrequest.title is not None
-                        and self.cd_pullrequest_tag in pullrequest.title
-                    ):
-                        raise SccsException(
-                            f'A continuous deployment request is already open. link: {pullrequest.get_link("html")}'
-                        )
-
-            await run_async(check_pr_sync)
+            async for pullrequest in session.pullrequests(self.team, repo_slug):
+                if (
+                    pullrequest["destination"]["branch"]["name"] == branch_name
+                    and pullrequest.get("title") is not None
+                    and self.cd_pullrequest_tag in pullrequest["title"]
+                ):
+                    raise SccsException(
+                        "A continuous deployment request is already open. "
+                        f'link: {pullrequest["links"]["html"]["href"]}'
+                    )
 
-            deploy_branch = await run_async(repo.branches.get, branch_name)
+            deploy_branch = await session.branch(self.team, repo_slug, branch_name)
 
             try:
                 # If the branch already exists, we should remove it.
-                await run_async(repo.branches.delete, path=f"{deploy_branch_name}")
-            except HTTPError:
+                await session.delete_branch(self.team, repo_slug, deploy_branch_name)
+            except BitbucketHTTPError:
                 pass
-            await run_async(repo.branches.create, deploy_branch_name, deploy_branch.hash)
+            await session.create_branch(
+                self.team, repo_slug, deploy_branch_name, deploy_branch["target"]["hash"]
+            )
         else:
             deploy_branch = None
 
@@ -452,24 +465,20 @@ class BitbucketCloud(SccsApi):
         #     )
         post_branch_name = branch_name if deploy_branch is None else deploy_branch_name
         logging.info(f"TRIGGER CD: POST {version} to version.txt for {repo_slug} on {post_branch_name}")
-        await run_async(
-            repo.post,
-            "src",
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-            data={
-                f'/{cd_environment_config.version["file"]}': f"{version}\n",
-                "message": f"deploy version {version}",
-                "author": (await self.get_session_author(session)),
-                "branch": post_branch_name,
-            },
-            files=[],
-            # see https://github.com/atlassian-api/atlassian-python-api/issues/1045#issue-1368184335
+        await session.commit_files(
+            self.team,
+            repo_slug,
+            {f'/{cd_environment_config.version["file"]}': f"{version}\n"},
+            message=f"deploy version {version}",
+            author=(await self.get_session_author(session)),
+            branch=post_branch_name,
         )
 
         if deploy_branch is not None:
             # Continuous Deployment is done with a PR.
-            pr = await run_async(
-                repo.pullrequests.create,
+            pr = await session.create_pullrequest(
+                self.team,
+                repo_slug,
                 title=f"Upgrade {environment} {self.cd_pullrequest_tag}",
                 source_branch=deploy_branch_name,
                 destination_branch=branch_name,
@@ -477,7 +486,7 @@ class BitbucketCloud(SccsApi):
             )
 
             # race condition start here
-            continuous_deployment.pullrequest = pr.get_link("html")
+            continuous_deployment.pullrequest = pr["links"]["html"]["href"]
         else:
             # Continuous Deployment done
             continuous_deployment.version = version
@@ -485,21 +494,94 @@ class BitbucketCloud(SccsApi):
         # Return the new configuration (new version or PR in progress)
         return continuous_deployment
 
+    def patch_continuous_deployment_config(
+        self, repo_slug: str, configs: list[typing_cd.EnvironmentConfig], event_key: str, payload: dict
+    ) -> tuple[list[typing_cd.EnvironmentConfig], bool]:
+        """
+        Apply a push (head commit, and the version when it can be told from the payload) or a pull
+        request (link set or cleared) to the environments of its branch. Commit statuses don't
+        change the configuration.
+        """
+        environments = {env.branch: env for env in self.cd_environments}
+        configs = list(configs)
+        index = {config.key: i for i, config in enumerate(configs)}
+
+        def patch(branch: str, **changes) -> bool:
+            i = index.get(stable_hash((repo_slug, branch)))
+            if i is None:
+                return False  # not watched
+            configs[i] = configs[i].copy(update=changes)
+            return True
+
+        try:
+            if event_key == "repo:push":
+                complete = True
+                for change in payload["push"]["changes"]:
+                    new = change.get("new")
+                    if new is None:
+                        # branch deleted
+                        complete = complete and (change.get("old") or {}).get("name") not in environments
+                        continue
+                    env = environments.get(new["name"]) if new["type"] == "branch" else None
+                    if env is None:
+                        continue
+                    target = new["target"]
+                    user = target["author"].get("user") or {}
+                    author = user.get("display_name") or target["author"]["raw"]
+                    changes = {"author": author, "date": target["date"]}
+                    commits = change.get("commits") or []
+                    if env.version.get("file") is None:
+                        if env.version.get("git", False):
+                            changes["version"] = target["hash"]
+                    elif len(commits) == 1 and not change.get("truncated"):
+                        deployed = _DEPLOY_MESSAGE.fullmatch(commits[0]["message"].strip())
+                        if deployed:
+                            changes["version"] = deployed.group(1)
+                    if patch(new["name"], **changes) and "version" not in changes:
+                        # the version file may have changed
+                        complete = False
+                return configs, complete
+
+            if event_key.startswith("pullrequest:"):
+                pullrequest = payload["pullrequest"]
+                branch = pullrequest["destination"]["branch"]["name"]
+                env = environments.get(branch)
+                if (
+                    env is None
+                    or not env.trigger.get("pullrequest", False)
+                    or self.cd_pullrequest_tag not in (pullrequest.get("title") or "")
+                ):
+                    return configs, True
+                link = pullrequest["links"]["html"]["href"]
+                if event_key in ("pullrequest:created", "pullrequest:updated"):
+                    patch(branch, pullrequest=link)
+                elif event_key in ("pullrequest:fulfilled", "pullrequest:rejected"):
+                    i = index.get(stable_hash((repo_slug, branch)))
+                    if i is not None and configs[i].pullrequest == link:
+                        patch(branch, pullrequest=None)
+                return configs, True
+
+            if event_key.startswith("repo:commit_status_"):
+                return configs, True
+        except (KeyError, TypeError, AttributeError) as e:
+            logging.warning(f"Can't apply {event_key} to the CD configuration of {repo_slug}: {e}")
+        return configs, False
+
     async def bridge_repository_to_namespace(
-        self, session: Cloud, repo_slug: str, environment: str, untrustable: bool
+        self, session: Bitbucket, repo_slug: str, environment: str, untrustable: bool
     ):
         return await super().bridge_repository_to_namespace(session, repo_slug, environment, untrustable)
 
-    async def compliance(self, session: Cloud, remediation: bool, report: bool) -> dict | None:
+    async def compliance(self, session: Bitbucket, remediation: bool, report: bool) -> dict | None:
         return await super().compliance(session, remediation, report)
 
-    async def compliance_report(self, session: Cloud) -> dict:
+    async def compliance_report(self, session: Bitbucket) -> dict:
         return await super().compliance_report(session)
 
-    async def compliance_repository(self, session: Cloud, repository, remediation, report) -> dict | None:
+    async def compliance_repository(self, session: Bitbucket, repository, remediation, report) -> dict | None:
         return await super().compliance_repository(session, repository, remediation, report)
 
-    async def compliance_report_repository(self, session: Cloud, repository) -> dict:
+    async def compliance_report_repository(self, session: Bitbucket, repository) -> dict:
         return await super().compliance_report_repository(session, repository)
 
     ###########################################################
@@ -522,7 +604,7 @@ class BitbucketCloud(SccsApi):
         """
         trigger_config = config.trigger
         env = typing_cd.EnvironmentConfig(
-            key=hash((repository, branch)),
+            key=stable_hash((repository, branch)),
             version=version,
             environment=config.name,
             author=author,
@@ -533,125 +615,139 @@ class BitbucketCloud(SccsApi):
         return env
 
     async def get_continuous_deployment_config_by_branch(
-        self, repo: Repository, branch: Branch, config: EnvironmentConfiguration
+        self, repo_slug: str, branch: dict, config: EnvironmentConfiguration
     ) -> tuple[str, typing_cd.EnvironmentConfig]:
         """
         Get environment configuration for a specific branch
         """
-        # Get version
-        version_file = config.version.get("file")
-        commit_hash = branch.hash
-        version: str
-        if version_file is not None:
-            res: bytes | None = await run_async(
-                repo.get, path=f"src/{commit_hash}/{version_file}", not_json_response=True
-            )  # type: ignore
-            if res is not None:
-                version = res.decode("utf-8").strip()
+        session = self.admin_session
+        commit_hash = branch["target"]["hash"]
+
+        async def get_version() -> str:
+            version_file = config.version.get("file")
+            if version_file is not None:
+                res = await session.src(self.team, repo_slug, commit_hash, version_file)
+                return res.decode("utf-8").strip()
+            elif config.version.get("git", False):
+                return commit_hash  # basically only the master branch
             else:
-                raise SccsException(
-                    f"failed to get version from {version_file} for {repo.name} on branch {branch}"
-                )
-        elif config.version.get("git", False):
-            version = commit_hash  # basically only the master branch
-        else:
-            raise NotImplementedError()
+                raise NotImplementedError()
 
-        pullrequest_link = None
-
-        if config.trigger.get("pullrequest", False):
+        async def get_pullrequest_link() -> str | None:
+            if not config.trigger.get("pullrequest", False):
+                return None
             # Continuous Deployment is done with a PR.
-            def pr_sync():
-                nonlocal pullrequest_link
-                for pullrequest in repo.pullrequests.each():
-                    if pullrequest.destination_branch == config.branch and self.cd_pullrequest_tag in (
-                        pullrequest.title or ""
-                    ):
-                        link = pullrequest.get_link("html")
-                        pullrequest_link = link["href"] if type(link) is dict else link
-                        break
-
-            await run_async(pr_sync)
+            async for pullrequest in session.pullrequests(self.team, repo_slug):
+                if pullrequest["destination"]["branch"]["name"] == config.branch and (
+                    self.cd_pullrequest_tag in (pullrequest.get("title") or "")
+                ):
+                    return pullrequest["links"]["html"]["href"]
+            return None
+
+        version, pullrequest_link = await asyncio.gather(get_version(), get_pullrequest_link())
 
         try:
-            author = branch.data["target"]["author"]["user"]["display_name"]
+            author = branch["target"]["author"]["user"]["display_name"]
         except KeyError:
-            author = branch.data["target"]["author"]["raw"]
+            author = branch["target"]["author"]["raw"]
 
-        date = branch.data["target"]["date"]
+        date = branch["target"]["date"]
 
         return (
-            branch.name,
+            branch["name"],
             BitbucketCloud.create_continuous_deployment_config_by_branch(
-                repo.slug, version, branch.name, author, date, config, pullrequest_link
+                repo_slug, version, branch["name"], author, date, config, pullrequest_link
             ),
         )
 
-    @cache_async(ttl=timedelta(days=1))
-    async def get_repository_permission(self, session: Cloud, repo_slug: str) -> str | None:
+    @cache_async(
+        ttl=timedelta(days=1),
+        tags=["repo:{repo_slug}", "user:{session.username}"],
+        negative_ttl=timedelta(minutes=5),
+    )
+    async def get_repository_permission(self, session: Bitbucket, repo_slug: str) -> str | None:
         # get repository permissions for user
 
         try:
-            user_permissions = await run_async(
-                session.get,
-                f"repositories/{self.team}/{repo_slug}/permissions-config/users/{session.username}",
-            )
+            user_permissions = await session.repository_permission(self.team, repo_slug, session.username)
             return user_permissions.get("permission")
-        except HTTPError as e:
+        except BitbucketHTTPError as e:
             logging.warning(f"Error getting repository permissions: {e}")
             return None
 
     @cache_async(ttl=timedelta(days=1))
-    async def get_projects(self, session: Cloud) -> Projects:
+    async def get_projects(self, session: Bitbucket) -> list[dict]:
         """Return a list of projects"""
-        return await run_async(session.get, f"/workspaces/{self.team}/projects")
+        return [project async for project in session.projects(self.team)]
 
-    @cache_async(ttl=timedelta(days=1))
-    async def get_webhook_subscriptions(self, session: Cloud, repo_slug: str):
-        repo = await self.get_api_repository(session, repo_slug)
-        if repo is None:
-            return None
-        return await run_async(repo.get, "hooks")
+    @cache_async(
+        ttl=timedelta(days=1),
+        key=cache_key_fns["get_webhook_subscriptions"],
+        tags=["repo:{repo_slug}"],
+        negative_ttl=timedelta(minutes=5),
+    )
+    async def get_webhook_subscriptions(self, session: Bitbucket, repo_slug: str):
+        return await self._get_webhook_subscriptions(session, repo_slug)
+
+    @cache_async_many(
+        ttl=timedelta(days=1),
+        key=cache_key_fns["get_webhook_subscriptions"],
+        batch_arg="repo_slugs",
+        item_arg="repo_slug",
+        tags=["fn:get_webhook_subscriptions", "repo:{repo_slug}"],
+        negative_ttl=timedelta(minutes=5),
+    )
+    async def get_webhook_subscriptions_many(
+        self, session: Bitbucket, repo_slugs: list[str]
+    ) -> dict[str, dict]:
+        """see plugin.py"""
+        results = {}
+
+        async def get(repo_slug):
+            try:
+                results[repo_slug] = await self._get_webhook_subscriptions(session, repo_slug)
+            except BitbucketHTTPError as e:
+                logging.warning(f"Failed to get list of webhooks for {repo_slug}: {e}")
+
+        async with create_task_group() as tg:
+            for repo_slug in repo_slugs:
+                tg.start_soon(get, repo_slug)
+
+        return results
+
+    async def _get_webhook_subscriptions(self, session: Bitbucket, repo_slug: str):
+        await self.accesscontrol(session, repo_slug)
+        return {"values": [hook async for hook in session.hooks(self.team, repo_slug)]}
 
     async def create_webhook_subscription_for_repo(
         self,
-        session: Cloud,
+        session: Bitbucket,
         repo_slug: str,
         url: str,
         active: bool,
         events: list[WebhookEvent],
         description: str,
     ):
-        repo = await self.get_api_repository(session, repo_slug)
-        if repo is None:
-            return None
+        await self.accesscontrol(session, repo_slug)
 
-        return await run_async(
-            repo.post,
-            path="hooks",
-            json={
-                "url": url,
-                "active": active,
-                "events": events,
-                "description": description,
-            },
+        return await session.create_hook(
+            self.team,
+            repo_slug,
+            url=url,
+            active=active,
+            events=events,
+            description=description,
         )
 
-    async def delete_webhook_subscription(self, session: Cloud, repo_slug, subscription_id) -> None:
-        repo = await self.get_api_repository(session, repo_slug)
-        if repo is None:
-            return None
+    async def delete_webhook_subscription(self, session: Bitbucket, repo_slug, subscription_id) -> None:
+        await self.accesscontrol(session, repo_slug)
 
-        await run_async(
-            repo.request,
-            method="DELETE",
-            path=f"hooks/{subscription_id}",
-        )
+        await session.delete_hook(self.team, repo_slug, subscription_id)
 
-    async def delete_repository(self, session: Cloud, repo_slug: str):
+    async def delete_repository(self, session: Bitbucket, repo_slug: str):
         return await super().delete_repository(session, repo_slug)
 
-    async def get_session_author(self, session: Cloud) -> str:
+    async def get_session_author(self, session: Bitbucket) -> str:
         stored_session = await self.get_stored_session(None, session)
         if stored_session is not None:
             return stored_session.credentials.author
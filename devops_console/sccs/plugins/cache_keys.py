@@ -2,11 +2,18 @@ import json
 import re
 from typing import Callable
 
+from devops_console.sccs.plugins.bitbucket_api import Bitbucket
+from devops_console.sccs.typing.credentials import Credentials
+from devops_console.sccs.utils.digest import stable_digest, stable_hash
+
 
 class CacheKeyFn:
     """Functions to return cache keys based on the arguments passed to the functions found
     in SccsApi (or in a plugin).
-    If a method is in SccsApi, but not here, it probably doesn't need a cache key function"""
+    If a method is in SccsApi, but not here, it probably doesn't need a cache key function
+
+    `hash_tag` is a format string filled with the arguments (e.g. "repo:{repo_slug}"); the keys
+    sharing a hash tag are stored in the same redis cluster slot (see `hash_tagged`)."""
 
     def __init__(
             self,
@@ -14,6 +21,7 @@ class CacheKeyFn:
             arg_names: list[str] = None,
             kwarg_names: list[str] = None,
             namespace: str = None,
+            hash_tag: str = None,
             ):
         if arg_names is None:
             arg_names = []
@@ -23,13 +31,20 @@ class CacheKeyFn:
         self.arg_names = arg_names
         self.kwarg_names = kwarg_names
         self.namespace = namespace
+        self.hash_tag = hash_tag
 
     @classmethod
     def from_fn(cls, fn, arg_names: list[str], kwarg_names: list[str], namespace: str = None):
         return cls(fn.__name__, arg_names, kwarg_names)
 
     def __call__(self, *args, **kwargs):
-        key = CacheKeyFn.make_default_key(self.name, *args, **kwargs)
+        hash_tag = None
+        if self.hash_tag is not None:
+            try:
+                hash_tag = self.hash_tag.format(**dict(zip(self.arg_names, args)), **kwargs)
+            except (AttributeError, KeyError, IndexError):
+                pass
+        key = CacheKeyFn.make_default_key(self.name, *args, hash_tag=hash_tag, **kwargs)
 
         if self.namespace is not None:
             key = CacheKeyFn.prepend_namespace(self.namespace, key)
@@ -70,14 +85,18 @@ class CacheKeyFn:
         return self(*key_fn_args, **key_fn_kwargs)
 
     @staticmethod
-    def make_default_key(name: str, *args: tuple, hash_it=False, **kwargs: dict):
-        key = name
+    def make_default_key(name: str, *args: tuple, hash_it=False, hash_tag: str = None, **kwargs: dict):
+        key = hash_tagged(name, hash_tag)
 
         hasargs = len(args) > 0 or len(kwargs) > 0
 
         def stringify(v) -> str:
             if isinstance(v, str):
                 return v
+            elif isinstance(v, Credentials):
+                return credentials_id(v.user, v.apikey)
+            elif isinstance(v, Bitbucket):
+                return credentials_id(v.username, v.password)
             elif isinstance(v, (int, float, complex, bytes, bool)):
                 return str(v)
             else:
@@ -95,20 +114,46 @@ class CacheKeyFn:
             key += ', '.join([f'{k}={stringify(v)}' for k, v in kwargs.items()])
             key += ')'
 
-        return key if not hash_it else hash(key)
+        return key if not hash_it else stable_hash(key)
 
     @staticmethod
     def prepend_namespace(namespace: str, key: str):
         return f"{namespace}::{key}"
 
 
+def hash_tagged(key: str, hash_tag: str | None) -> str:
+    """Prefix `key` with a redis cluster hash tag: only the part between the first braces of a key
+    is hashed, so keys with the same hash tag land in the same slot and can be used together in
+    multi-key commands and scripts."""
+    if not hash_tag:
+        return key
+    return f"{{{hash_tag}}}{key}"
+
+
+def credentials_id(user: str, secret: str) -> str:
+    """Identifies a set of credentials in cache keys without writing the secret in them."""
+    return f"{user}:{stable_digest([user, secret])}"
+
+
 cache_key_fns = {
     "get_continuous_deployment_config": CacheKeyFn(
         "get_continuous_deployment_config",
         ["repo_slug", "environments"],
+        hash_tag="repo:{repo_slug}",
         ),
     "get_deployment_status": CacheKeyFn(
         name="get_deployment_status",
-        kwarg_names=["slug", "environment"]
-        )
+        kwarg_names=["slug", "environment"],
+        hash_tag="repo:{slug}",
+        ),
+    "get_webhook_subscriptions": CacheKeyFn(
+        "get_webhook_subscriptions",
+        ["repo_slug"],
+        hash_tag="repo:{repo_slug}",
+        ),
+    # the plugin and SccsV2 have methods of the same name, caching different types
+    "get_repository_catalog": CacheKeyFn("repository_catalog"),
+    "get_repository_permissions": CacheKeyFn("repository_permissions", ["session"]),
+    "v2:get_repository_catalog": CacheKeyFn("v2:repository_catalog"),
+    "v2:get_repository_permissions": CacheKeyFn("v2:repository_permissions", ["credentials"]),
     }
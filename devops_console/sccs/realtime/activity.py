@@ -0,0 +1,101 @@
+# Copyright 2021-2022 Croix Bleue du Québec
+# This file is part of python-devops-sccs.
+# python-devops-sccs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# python-devops-sccs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# You should have received a copy of the GNU Lesser General Public License
+# along with python-devops-sccs.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Watcher activity tiers
+
+A repository being deployed right now should be polled more often than one untouched for a year.
+Each watcher is put in a tier, re-evaluated every `Tiers.check_interval` seconds by its leader:
+- hot: a webhook was received for its repository, or its values changed, in the last `hot_window`
+- cold: nothing of the sort in the last `cold_window`, and at most `cold_max_subscribers`
+  subscribers (across replicas)
+- warm: everything else
+The watcher's interval (e.g. `Intervals`) is multiplied by the factor of its tier, within
+[`min_interval`, `max_interval`].
+
+Webhooks can be received by any replica: the time of the last one per repository is kept in redis
+(in memory while redis is unreachable).
+"""
+import logging
+import os
+import time
+from dataclasses import dataclass
+
+from redis.exceptions import RedisError
+
+from ..redis import RedisCache
+
+HOT = "hot"
+WARM = "warm"
+COLD = "cold"
+
+cache = RedisCache()
+
+_local_webhooks: dict[str, float] = {}
+
+
+def _webhooks_key() -> str:
+    return f"{cache.prefix}activity:webhooks"
+
+
+@dataclass
+class Tiers:
+    hot_window: float = float(os.environ.get('WATCHER_HOT_WINDOW', 15 * 60))
+    cold_window: float = float(os.environ.get('WATCHER_COLD_WINDOW', 24 * 3600))
+    cold_max_subscribers: int = int(os.environ.get('WATCHER_COLD_MAX_SUBSCRIBERS', 1))
+    hot_factor: float = float(os.environ.get('WATCHER_HOT_FACTOR', 1 / 12))
+    cold_factor: float = float(os.environ.get('WATCHER_COLD_FACTOR', 4))
+    min_interval: float = float(os.environ.get('WATCHER_MIN_INTERVAL', 60))
+    max_interval: float = float(os.environ.get('WATCHER_MAX_INTERVAL', 6 * 3600))
+    check_interval: float = float(os.environ.get('WATCHER_TIER_CHECK_INTERVAL', 60))
+
+    def tier(self, last_webhook: float | None, last_change: float | None, subscribers: int) -> str:
+        now = time.time()
+        last_activity = max(last_webhook or 0, last_change or 0)
+        if now - last_activity <= self.hot_window:
+            return HOT
+        if now - last_activity > self.cold_window and subscribers <= self.cold_max_subscribers:
+            return COLD
+        return WARM
+
+    def interval(self, tier: str, base: float) -> float:
+        factor = {HOT: self.hot_factor, WARM: 1, COLD: self.cold_factor}[tier]
+        return min(self.max_interval, max(self.min_interval, base * factor))
+
+
+tiers = Tiers()
+
+
+async def record_webhook(repo_slug: str):
+    now = time.time()
+    _local_webhooks[repo_slug] = now
+    if cache.degraded or cache.aredis is None:
+        return
+    try:
+        async with cache.aredis.pipeline(transaction=False) as pipe:
+            pipe.zadd(_webhooks_key(), {repo_slug: now})
+            # the repositories without a webhook for a while are cold anyway
+            pipe.zremrangebyscore(_webhooks_key(), "-inf", now - tiers.cold_window)
+            await pipe.execute()
+    except RedisError as e:
+        logging.warning(f"Can't record the webhook activity of {repo_slug}: {e}")
+
+
+async def last_webhook(repo_slug: str) -> float | None:
+    """When the last webhook for `repo_slug` was received, by any replica."""
+    if cache.degraded or cache.aredis is None:
+        return _local_webhooks.get(repo_slug)
+    try:
+        return await cache.aredis.zscore(_webhooks_key(), repo_slug)
+    except RedisError:
+        return _local_webhooks.get(repo_slug)
@@ -0,0 +1,191 @@
+# Copyright 2021-2022 Croix Bleue du Québec
+# This file is part of python-devops-sccs.
+# python-devops-sccs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# python-devops-sccs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# You should have received a copy of the GNU Lesser General Public License
+# along with python-devops-sccs.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Watcher leadership across replicas
+
+Every replica keeps its own watchers, but only one of them per watcher identity polls: the holder
+of the watcher's `Lease`. It publishes the events it computes on the watcher's channel and the
+other replicas (followers) relay them to their local subscribers. Followers forward refresh
+requests (e.g. from webhooks) to the leader on the same channel, and take over once the lease
+expires.
+
+While redis is unreachable every replica leads its own watchers, as before.
+"""
+import asyncio
+import logging
+import os
+from typing import Callable
+
+from redis.exceptions import ConnectionError as RedisConnectionError, LockError, RedisError
+from redis.exceptions import TimeoutError as RedisTimeoutError
+
+from ..metrics import metrics
+from ..redis import RedisCache
+
+# seconds a leader keeps its lease without renewing it; renewed every third of it
+LEASE_TTL = float(os.environ.get('WATCHER_LEASE_TTL', 30))
+# seconds the relay waits for messages before applying new (un)subscriptions
+_RELAY_POLL = 0.1
+
+_UNAVAILABLE = (RedisConnectionError, RedisTimeoutError)
+
+cache = RedisCache()
+
+metrics.counter("watcher_relayed_events_total", "Watcher events received from the leader on another replica")
+
+
+def lease_name(watcher_id: str) -> str:
+    return f"{cache.prefix}watcher:lease:{watcher_id}"
+
+
+def channel_of(watcher_id: str) -> str:
+    return f"{cache.prefix}watcher:channel:{watcher_id}"
+
+
+class Lease:
+    def __init__(self, name: str, ttl: float = LEASE_TTL):
+        self.name = name
+        self.ttl = ttl
+        self._lock = None
+
+    @property
+    def held(self) -> bool:
+        """Whether this replica holds the lease in redis (False while leading without redis)."""
+        return self._lock is not None
+
+    async def acquire(self) -> bool:
+        """Take the lease, or renew it if it is already held. Returns whether this replica leads:
+        always while redis is unreachable."""
+        if cache.degraded or cache.aredis is None:
+            return True
+        try:
+            if self._lock is not None:
+                await self._lock.reacquire()
+                return True
+            lock = cache.aredis.lock(self.name, timeout=self.ttl, blocking=False)
+            if await lock.acquire():
+                self._lock = lock
+                return True
+            return False
+        except LockError:
+            # expired and taken over by another replica
+            self._lock = None
+            return False
+        except _UNAVAILABLE as e:
+            logging.warning(f"Watcher lease {self.name} unavailable, leading locally: {e}")
+            return True
+
+    async def release(self):
+        if self._lock is None:
+            return
+        lock, self._lock = self._lock, None
+        try:
+            await lock.release()
+        except (LockError, RedisError):
+            pass  # it expires on its own
+
+
+class Relay:
+    """Pub/sub for the watchers of a replica, over a single redis connection. Messages are dicts,
+    encoded with the cache codec."""
+
+    def __init__(self):
+        self._handlers: dict[str, list[Callable[[dict], None]]] = {}
+        self._subscribed: dict[str, asyncio.Event] = {}
+        self._task: asyncio.Task | None = None
+
+    async def join(self, channel: str, handler: Callable[[dict], None], timeout: float = 1.0):
+        """Call `handler` with the messages published on `channel` (by other replicas too). Waits
+        (up to `timeout`) for the subscription to be active."""
+        self._handlers.setdefault(channel, []).append(handler)
+        subscribed = self._subscribed.setdefault(channel, asyncio.Event())
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._listen())
+        try:
+            await asyncio.wait_for(subscribed.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Watcher relay: {channel} not subscribed yet")
+
+    def leave(self, channel: str, handler: Callable[[dict], None]):
+        handlers = self._handlers.get(channel, [])
+        if handler in handlers:
+            handlers.remove(handler)
+        if not handlers:
+            self._handlers.pop(channel, None)
+            self._subscribed.pop(channel, None)
+
+    async def publish(self, channel: str, message: dict) -> int:
+        """Returns how many replicas received the message."""
+        if cache.degraded or cache.aredis is None:
+            return 0
+        try:
+            return await cache.aredis.publish(channel, cache.codec.encode(message))
+        except RedisError as e:
+            logging.warning(f"Watcher relay: can't publish on {channel}: {e}")
+            return 0
+
+    async def listeners(self, channel: str) -> int:
+        """How many replicas are subscribed to `channel`."""
+        if cache.degraded or cache.aredis is None:
+            return 0
+        try:
+            return sum(n for _, n in await cache.aredis.pubsub_numsub(channel))
+        except RedisError:
+            return 0
+
+    async def _listen(self):
+        while self._handlers:
+            try:
+                async with cache.aredis.pubsub() as pubsub:
+                    subscribed = set()
+                    while self._handlers:
+                        wanted = set(self._handlers)
+                        if wanted - subscribed:
+                            await pubsub.subscribe(*(wanted - subscribed))
+                        if subscribed - wanted:
+                            await pubsub.unsubscribe(*(subscribed - wanted))
+                        subscribed = wanted
+                        for channel in subscribed:
+                            if channel in self._subscribed:
+                                self._subscribed[channel].set()
+                        message = await pubsub.get_message(
+                            ignore_subscribe_messages=True, timeout=_RELAY_POLL
+                            )
+                        if message is not None:
+                            self._deliver(message["channel"], message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # anything published meanwhile is lost: the leader's next poll catches up
+                logging.warning(f"Watcher relay error: {e}")
+                for subscribed in self._subscribed.values():
+                    subscribed.clear()
+                await asyncio.sleep(1.0)
+
+    def _deliver(self, channel: bytes | str, data: bytes):
+        channel = channel.decode() if isinstance(channel, bytes) else channel
+        handlers = self._handlers.get(channel)
+        if not handlers:
+            return
+        try:
+            message = cache.codec.decode(data)
+        except Exception as e:
+            logging.warning(f"Watcher relay: invalid message on {channel}: {e}")
+            return
+        for handler in list(handlers):
+            handler(message)
+
+
+relay = Relay()
@@ -0,0 +1,239 @@
+# Copyright 2021-2022 Croix Bleue du Québec
+# This file is part of python-devops-sccs.
+# python-devops-sccs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# python-devops-sccs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# You should have received a copy of the GNU Lesser General Public License
+# along with python-devops-sccs.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Poll scheduler
+
+Decides when the watchers led by this replica poll, instead of each watcher sleeping on its own.
+All of them go through one queue per process, which:
+- limits how many polls run at once (`concurrency`) and how many start per hour (`budget`, a
+  token bucket allowing bursts of a minute's worth of polls)
+- spreads the polls with `jitter` (a fraction of the interval), and spreads the first poll of the
+  watchers that already have values (replayed from their snapshot, e.g. after a restart or a
+  leader change) over `startup_spread` seconds
+- serves the interactive refreshes (Scheduler.notify, watchers without any value yet) before the
+  background polls, in the order they were requested
+
+    async with poller.turn(watcher):
+        ...  # poll
+"""
+import asyncio
+import contextlib
+import heapq
+import itertools
+import os
+import random
+import time
+from dataclasses import dataclass, field
+
+from ..metrics import metrics
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+metrics.counter("watcher_polls_total", "Watcher polls started, by priority")
+metrics.histogram("watcher_poll_wait_seconds", "Time between a poll being due and it starting")
+metrics.gauge("watcher_polls_running", "Watcher polls running on this replica")
+
+
+@dataclass(eq=False)
+class _Entry:
+    interval: float
+    due: float
+    priority: str = BACKGROUND
+    granted: asyncio.Event = field(default_factory=asyncio.Event)
+    running: bool = False
+    # requested again while running
+    again: bool = False
+    # bumped on every reschedule: older queue items are stale
+    version: int = 0
+
+
+class PollScheduler:
+    def __init__(
+            self,
+            concurrency: int = int(os.environ.get('WATCHER_POLL_CONCURRENCY', 8)),
+            budget: int = int(os.environ.get('WATCHER_POLL_BUDGET', 3600)),
+            jitter: float = float(os.environ.get('WATCHER_POLL_JITTER', 0.1)),
+            startup_spread: float = float(os.environ.get('WATCHER_POLL_STARTUP_SPREAD', 30)),
+            ):
+        """
+        Args:
+            concurrency: polls running at once
+            budget: polls started per hour (0: unlimited)
+            jitter: intervals vary by up to this fraction, both ways
+            startup_spread: seconds over which the first polls of the watchers with values are spread
+        """
+        self.concurrency = concurrency
+        self.budget = budget
+        self.jitter = jitter
+        self.startup_spread = startup_spread
+        self._entries: dict[object, _Entry] = {}
+        self._interactive: list = []
+        self._background: list = []
+        self._order = itertools.count()
+        self._running = 0
+        self._tokens = self._burst
+        self._refilled_at = time.monotonic()
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def register(self, watcher, interval: float, has_values: bool):
+        """Schedule the polls of `watcher`, every `interval` seconds. Without values, the first poll
+        is interactive."""
+        entry = self._entries[watcher] = _Entry(interval, time.monotonic())
+        if has_values:
+            entry.due += random.uniform(0, self.startup_spread)
+            self._push(entry)
+        else:
+            self._request(entry)
+        self._start()
+
+    def unregister(self, watcher):
+        entry = self._entries.pop(watcher, None)
+        if entry is not None:
+            entry.version += 1
+            self._release(entry)
+
+    def reschedule(self, watcher, interval: float):
+        """Poll `watcher` every `interval` seconds from now on, moving its next background poll
+        accordingly."""
+        entry = self._entries.get(watcher)
+        if entry is None or entry.interval == interval:
+            return
+        previous, entry.interval = entry.interval, interval
+        if entry.priority == BACKGROUND and not (entry.running or entry.granted.is_set()):
+            # the same fraction of the interval (and of its jitter) left to wait
+            now = time.monotonic()
+            entry.due = now + max(0.0, entry.due - now) * interval / previous
+            self._push(entry)
+
+    def request(self, watcher):
+        """Poll `watcher` as soon as possible, before the background polls."""
+        entry = self._entries.get(watcher)
+        if entry is None:
+            return
+        if entry.running or entry.granted.is_set():
+            entry.again = True
+        elif entry.priority != INTERACTIVE:
+            self._request(entry)
+
+    @contextlib.asynccontextmanager
+    async def turn(self, watcher):
+        """Wait for the next poll of `watcher`."""
+        entry = self._entries[watcher]
+        try:
+            await entry.granted.wait()
+        except BaseException:
+            self._release(entry)
+            raise
+        entry.granted.clear()
+        try:
+            yield
+        finally:
+            self._release(entry)
+            if watcher in self._entries:
+                if entry.again:
+                    entry.again = False
+                    self._request(entry)
+                else:
+                    entry.priority = BACKGROUND
+                    jitter = random.uniform(1 - self.jitter, 1 + self.jitter)
+                    entry.due = time.monotonic() + entry.interval * jitter
+                    self._push(entry)
+
+    def stats(self) -> dict:
+        return {
+            "watchers": len(self._entries),
+            "running": self._running,
+            "tokens": self._tokens,
+            }
+
+    @property
+    def _burst(self) -> float:
+        return max(1.0, self.budget / 60)
+
+    def _request(self, entry: _Entry):
+        entry.priority = INTERACTIVE
+        entry.due = time.monotonic()
+        self._push(entry)
+
+    def _push(self, entry: _Entry):
+        entry.version += 1
+        queue = self._interactive if entry.priority == INTERACTIVE else self._background
+        heapq.heappush(queue, (entry.due, next(self._order), entry.version, entry))
+        self._wake.set()
+
+    def _release(self, entry: _Entry):
+        if entry.running:
+            entry.running = False
+            self._running -= 1
+            metrics.set("watcher_polls_running", self._running)
+            self._wake.set()
+
+    def _start(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            if self._task is not None and self._task.get_loop() is not loop:
+                self._wake = asyncio.Event()
+            self._task = loop.create_task(self._dispatch())
+
+    def _next(self, now: float) -> _Entry | None:
+        """The next entry due (interactive ones first), removed from its queue."""
+        for queue in (self._interactive, self._background):
+            while queue:
+                due, _, version, entry = queue[0]
+                if version != entry.version:
+                    heapq.heappop(queue)  # rescheduled or unregistered since
+                    continue
+                if due > now:
+                    break
+                heapq.heappop(queue)
+                return entry
+        return None
+
+    def _refill(self, now: float):
+        if self.budget:
+            self._tokens = min(self._burst, self._tokens + (now - self._refilled_at) * self.budget / 3600)
+        self._refilled_at = now
+
+    async def _dispatch(self):
+        while self._entries:
+            self._wake.clear()
+            now = time.monotonic()
+            self._refill(now)
+            delay = None
+            while self._running < self.concurrency:
+                if self.budget and self._tokens < 1:
+                    delay = (1 - self._tokens) * 3600 / self.budget
+                    break
+                entry = self._next(now)
+                if entry is None:
+                    break
+                if self.budget:
+                    self._tokens -= 1
+                self._running += 1
+                entry.running = True
+                entry.granted.set()
+                metrics.inc("watcher_polls_total", priority=entry.priority)
+                metrics.observe("watcher_poll_wait_seconds", now - entry.due)
+                metrics.set("watcher_polls_running", self._running)
+            if delay is None and self._running < self.concurrency:
+                pending = [q[0][0] for q in (self._interactive, self._background) if q]
+                if pending:
+                    delay = max(0.0, min(pending) - now)
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), delay)
+
+
+poller = PollScheduler()
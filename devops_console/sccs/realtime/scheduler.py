@@ -1,16 +1,25 @@
 # Copyright 2021 Croix Bleue du Québec
+import asyncio
+import functools
 import logging
+import os
+import time
+from dataclasses import dataclass
 from typing import Any, Callable
 
 from anyio import (
-    create_memory_object_stream,
     create_task_group,
     Event, Lock, TASK_STATUS_IGNORED, get_cancelled_exc_class,
     )
 from anyio.abc import TaskStatus
 from anyio.streams.memory import MemoryObjectSendStream
 
+from .leadership import channel_of, relay
+from .subscription import Subscription
 from .watcher import Watcher
+from ..metrics import metrics
+from ..typing.event import EventType
+from ..utils.digest import stable_digest
 
 
 # This file is part of python-devops-sccs.
@@ -25,6 +34,21 @@ from .watcher import Watcher
 # You should have received a copy of the GNU Lesser General Public License
 # along with python-devops-sccs.  If not, see <https://www.gnu.org/licenses/>.
 
+# seconds a notification waits for the rest of its burst (e.g. the webhooks of a merge), by default
+NOTIFY_DEBOUNCE = float(os.environ.get('WATCHER_NOTIFY_DEBOUNCE', 5))
+# a continuous stream of notifications still refreshes every this many windows
+_MAX_DEBOUNCE_WINDOWS = 4
+
+metrics.counter("watcher_notifications_total", "Scheduler.notify calls")
+metrics.counter("watcher_notifications_coalesced_total", "Notifications merged into a pending refresh")
+
+
+@dataclass(eq=False)
+class _Burst:
+    first: float
+    last: float
+    task: asyncio.Task | None = None
+
 
 class Scheduler(object):
     """
@@ -32,9 +56,16 @@ class Scheduler(object):
     Exists solely to support the legacy API.
     """
 
-    def __init__(self):
+    def __init__(self, debounce: dict[str, float] | None = None):
+        """
+        Args:
+            debounce: seconds `notify` waits for a burst of notifications to end, by watch type
+                (the first item of the watcher identity); NOTIFY_DEBOUNCE for the others
+        """
         self.watchers = {}
         self.lock = Lock()
+        self.debounce = debounce or {}
+        self._bursts: dict[str, _Burst] = {}
 
     async def watch(
             self,
@@ -46,42 +77,60 @@ class Scheduler(object):
             args: tuple = (),
             kwargs: dict = None,
             event_filter: Callable[[Any], bool] = lambda _: True,
+            repo_slug: str | None = None,
+            since: int | None = None,
+            patcher: Callable[[list, str, dict], tuple[list, bool]] | None = None,
             ):
+        """
+        Args:
+            since: sequence number of the last event seen, to resume a watch from (see
+                Watcher.replay)
+            patcher: see Watcher
+        """
         if kwargs is None:
             kwargs = {}
 
-        wid = hash(identity)
+        wid = stable_digest(identity)
 
         async with self.lock:
             w = self.watchers.get(wid)
             if w is None:
-                w = Watcher(wid, poll_interval, func, args, kwargs)
+                w = Watcher(
+                    wid, poll_interval, func, args, kwargs,
+                    repo_slug=repo_slug, patcher=patcher, notify=functools.partial(self.notify, identity),
+                    )
                 self.watchers[wid] = w
 
         async def process_watcher_events(
-                receive_stream,
+                subscription: Subscription,
                 task_status: TaskStatus = TASK_STATUS_IGNORED
                 ):
             task_status.started()
-            async with receive_stream:
-                async for event in receive_stream:
+            try:
+                async for event in subscription:
                     if isinstance(event, Watcher.CloseClientOnException):
                         raise event.get_exception()
-                    if event_filter(event):
+                    if event.type == EventType.INFO or event_filter(event):
                         await send_stream.send(event)
+            finally:
+                subscription.close()
 
         async with create_task_group() as tg:
+            subscription = Subscription(since=since)
             try:
-                w_send_stream, w_receive_stream = create_memory_object_stream()
-                await tg.start(process_watcher_events, w_receive_stream)
-                tg.start_soon(w.subscribe, w_send_stream)
+                await tg.start(process_watcher_events, subscription)
+                tg.start_soon(w.subscribe, subscription)
                 await cancel_event.wait()
-                await w.unsubscribe(w_send_stream)
+                await w.unsubscribe(subscription)
             except Exception:
-                await w.unsubscribe(w_send_stream)
+                await w.unsubscribe(subscription)
                 raise
             except get_cancelled_exc_class():
-                await w.stop()
+                if subscription.disconnected:
+                    # too slow: the other subscribers keep the watcher
+                    await w.unsubscribe(subscription)
+                else:
+                    await w.stop()
                 raise
             finally:
                 if not w.has_subscribers():
@@ -95,11 +144,61 @@ class Scheduler(object):
     async def notify(self, identity: tuple):
         """
         Notify watcher to update is content due to an outside event
+
+        Trailing-edge debounce: the watcher is refreshed (bypassing the cache) once no other
+        notification came for its debounce window, so a burst of webhooks makes one upstream call.
         """
-        wid = hash(identity)
+        wid = stable_digest(identity)
+        window = self.debounce.get(identity[0], NOTIFY_DEBOUNCE)
+        metrics.inc("watcher_notifications_total")
+        if window <= 0:
+            await self._refresh(wid)
+            return
+
+        now = time.monotonic()
+        loop = asyncio.get_running_loop()
+        burst = self._bursts.get(wid)
+        if burst is not None and not burst.task.done() and burst.task.get_loop() is loop:
+            burst.last = now
+            metrics.inc("watcher_notifications_coalesced_total")
+            return
+        burst = self._bursts[wid] = _Burst(now, now)
+        burst.task = loop.create_task(self._refresh_after_burst(wid, window, burst))
+
+    async def _refresh_after_burst(self, wid: str, window: float, burst: _Burst):
+        try:
+            while True:
+                deadline = min(burst.last + window, burst.first + window * _MAX_DEBOUNCE_WINDOWS)
+                delay = deadline - time.monotonic()
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+        finally:
+            if self._bursts.get(wid) is burst:
+                # the notifications from now on are the next burst
+                del self._bursts[wid]
+        try:
+            await self._refresh(wid)
+        except Exception as e:
+            logging.warning(f"Can't refresh watcher {wid}: {e}")
+
+    async def patch(self, identity: tuple, event_key: str, payload: dict):
+        """
+        Apply a webhook payload to the watcher's values (see Watcher.patch)
+        """
+        wid = stable_digest(identity)
         async with self.lock:
-            try:
-                w = self.watchers[wid]
-                w.refresh(True)
-            except KeyError:
-                pass
+            w = self.watchers.get(wid)
+        if w is not None:
+            await w.patch(event_key, payload)
+        else:
+            await relay.publish(channel_of(wid), {"patch": [event_key, payload]})
+
+    async def _refresh(self, wid: str):
+        async with self.lock:
+            w = self.watchers.get(wid)
+        if w is not None:
+            await w.request_refresh(True)
+        else:
+            # the watcher may only exist on other replicas
+            await relay.publish(channel_of(wid), {"refresh": True})
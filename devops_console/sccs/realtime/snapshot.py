@@ -0,0 +1,227 @@
+# Copyright 2021-2022 Croix Bleue du Québec
+# This file is part of python-devops-sccs.
+# python-devops-sccs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# python-devops-sccs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# You should have received a copy of the GNU Lesser General Public License
+# along with python-devops-sccs.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Watcher snapshots
+
+The last values of a watcher, indexed by item key, and the changes between two polls. Computing
+the changes is O(n): each item is compared by its fingerprint (a digest of its content).
+
+Every change gets a sequence number, so that a subscriber can resume from the last one it saw: it
+gets the changes it missed from the event log, or the whole snapshot if it is too far behind. A
+new history (e.g. the snapshot expired) starts from the current time in milliseconds, above any
+sequence number of the previous one.
+
+The leader keeps the snapshot in memory and writes it to redis for the other replicas, as keys
+sharing a hash tag:
+  <name>:values        hash, item key -> encoded item
+  <name>:fingerprints  hash, item key -> fingerprint
+  <name>:order         the item keys in order (the order of the items is meaningful, e.g. it is the
+                       order of the environments on the frontend)
+  <name>:seq           sequence number of the last change
+  <name>:log           stream of the last `log_length` changes, with their sequence number as id
+Each poll only writes the items that changed.
+"""
+import hashlib
+import logging
+import os
+import time
+from datetime import timedelta
+
+import orjson
+from redis.exceptions import RedisError
+
+from ..codec import IncompatibleValue
+from ..redis import RedisCache
+from ..typing import WatcherType
+from ..typing.event import Event, EventType
+
+# longer than the poll intervals: a snapshot expires once nobody watches it anymore
+SNAPSHOT_TTL = timedelta(seconds=int(os.environ.get('WATCHER_SNAPSHOT_TTL', 6 * 3600)))
+# changes kept per watcher for the subscribers resuming a watch (approximately: trimmed lazily)
+LOG_LENGTH = int(os.environ.get('WATCHER_LOG_LENGTH', 1000))
+
+cache = RedisCache()
+
+
+def fingerprint(value: WatcherType) -> bytes:
+    try:
+        content = orjson.dumps(value.dict(), option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+        content = cache.codec.encode(value)
+    return hashlib.blake2b(content, digest_size=8).digest()
+
+
+def _new_history() -> int:
+    return time.time_ns() // 1_000_000
+
+
+class Snapshot:
+    def __init__(self, name: str, ttl: timedelta = SNAPSHOT_TTL, log_length: int = LOG_LENGTH):
+        """
+        Args:
+            name: prefix of the redis keys, should contain a hash tag
+        """
+        self.values_key = f"{name}:values"
+        self.fingerprints_key = f"{name}:fingerprints"
+        self.order_key = f"{name}:order"
+        self.seq_key = f"{name}:seq"
+        self.log_key = f"{name}:log"
+        self.ttl = ttl
+        self.log_length = log_length
+        # item key -> item, in order
+        self.values: dict[int, WatcherType] = {}
+        self.fingerprints: dict[int, bytes] = {}
+        # sequence number of the last change (0: no history yet)
+        self.seq = 0
+        # whether redis has the snapshot in memory, up to the changes of the next write
+        self._synced = False
+
+    def events(self) -> list[Event]:
+        """The current values, as ADDED events."""
+        return [
+            Event(_type=EventType.ADDED, value=value, key=key, seq=self.seq)
+            for key, value in self.values.items()
+            ]
+
+    async def events_since(self, seq: int) -> list[Event] | None:
+        """The changes after `seq`, or None when they aren't all in the log anymore (or when there
+        are more of them than items in the snapshot)."""
+        if seq == self.seq:
+            return []
+        if not 0 < seq < self.seq or cache.degraded or cache.aredis is None:
+            return None
+        try:
+            entries = await cache.aredis.xrange(
+                self.log_key, min=f"{seq + 1}-0", max=f"{self.seq}-0", count=len(self.values) + 1
+                )
+            events = [cache.codec.decode(fields[b"event"]) for _, fields in entries]
+        except (RedisError, IncompatibleValue, KeyError) as e:
+            logging.warning(f"Can't read the watcher log {self.log_key}: {e}")
+            return None
+        if len(events) > len(self.values) or not events:
+            return None  # the snapshot is shorter
+        if events[0].seq != seq + 1 or events[-1].seq != self.seq:
+            return None  # trimmed, or from another history
+        return events
+
+    async def load(self):
+        """Replace the snapshot in memory by the one in redis (kept as is if redis is unreachable)."""
+        if cache.degraded or cache.aredis is None:
+            return
+        try:
+            async with cache.aredis.pipeline(transaction=False) as pipe:
+                pipe.get(self.order_key)
+                pipe.hgetall(self.values_key)
+                pipe.hgetall(self.fingerprints_key)
+                pipe.get(self.seq_key)
+                order, values, fingerprints, seq = await pipe.execute()
+        except RedisError as e:
+            logging.warning(f"Can't load the watcher snapshot {self.values_key}: {e}")
+            self._synced = False
+            return
+
+        try:
+            keys = orjson.loads(order or b"[]")
+            self.values = {key: cache.codec.decode(values[b"%d" % key]) for key in keys}
+            self.fingerprints = {key: fingerprints[b"%d" % key] for key in self.values}
+            self.seq = int(seq or 0)
+            # without an order, whatever is left of the hashes is overwritten
+            self._synced = order is not None and seq is not None
+        except (IncompatibleValue, KeyError, ValueError) as e:
+            # written by another version (or partially): start over, everything will be ADDED
+            logging.warning(f"Discarding the watcher snapshot {self.values_key}: {e}")
+            self.values, self.fingerprints = {}, {}
+            self.seq = 0
+            self._synced = False
+
+    async def update(self, values: list[WatcherType]) -> list[Event]:
+        """Replace the snapshot by `values`, returning the changes (with their sequence number):
+        DELETED events first, then the ADDED and MODIFIED ones in the order of `values`."""
+        fingerprints = {value.key: fingerprint(value) for value in values}
+        new_values = {value.key: value for value in values}
+
+        events = [
+            Event(_type=EventType.DELETED, value=value, key=key)
+            for key, value in self.values.items() if key not in new_values
+            ]
+        changed = []
+        for key, value in new_values.items():
+            previous = self.fingerprints.get(key)
+            if previous is None:
+                events.append(Event(_type=EventType.ADDED, value=value, key=key))
+            elif previous != fingerprints[key]:
+                events.append(Event(_type=EventType.MODIFIED, value=value, key=key))
+            else:
+                continue
+            changed.append(key)
+
+        if not self.seq:
+            self.seq = _new_history()
+        for event in events:
+            self.seq += 1
+            event.seq = self.seq
+
+        deleted = [key for key in self.values if key not in new_values]
+        reordered = list(new_values) != list(self.values)
+        self.values, self.fingerprints = new_values, fingerprints
+        await self._write(changed, deleted, reordered, events)
+        return events
+
+    async def delete(self):
+        self.values, self.fingerprints = {}, {}
+        self.seq = 0
+        if cache.degraded or cache.aredis is None:
+            return
+        try:
+            await cache.aredis.unlink(*self._keys)
+        except RedisError as e:
+            logging.warning(f"Can't delete the watcher snapshot {self.values_key}: {e}")
+
+    @property
+    def _keys(self) -> tuple[str, ...]:
+        return self.values_key, self.fingerprints_key, self.order_key, self.seq_key, self.log_key
+
+    async def _write(self, changed: list[int], deleted: list[int], reordered: bool, events: list[Event]):
+        if cache.degraded or cache.aredis is None:
+            self._synced = False
+            return
+        try:
+            async with cache.aredis.pipeline(transaction=False) as pipe:
+                if not self._synced:
+                    # rewritten from scratch; the subscribers resuming from before get the snapshot
+                    pipe.unlink(*self._keys)
+                    changed, deleted, reordered = list(self.values), [], True
+                if changed:
+                    encoded = {key: cache.codec.encode(self.values[key]) for key in changed}
+                    pipe.hset(self.values_key, mapping=encoded)
+                    pipe.hset(self.fingerprints_key, mapping={key: self.fingerprints[key] for key in changed})
+                if deleted:
+                    pipe.hdel(self.values_key, *deleted)
+                    pipe.hdel(self.fingerprints_key, *deleted)
+                if reordered:
+                    pipe.set(self.order_key, orjson.dumps(list(self.values)))
+                for event in events:
+                    pipe.xadd(
+                        self.log_key, {"event": cache.codec.encode(event)}, id=f"{event.seq}-0",
+                        maxlen=self.log_length, approximate=True,
+                        )
+                pipe.set(self.seq_key, self.seq)
+                for key in self._keys:
+                    pipe.expire(key, self.ttl)
+                await pipe.execute()
+            self._synced = True
+        except RedisError as e:
+            # the other replicas see a stale snapshot until the next successful write
+            logging.warning(f"Can't write the watcher snapshot {self.values_key}: {e}")
+            self._synced = False
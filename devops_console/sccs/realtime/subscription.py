@@ -0,0 +1,207 @@
+# Copyright 2021-2022 Croix Bleue du Québec
+# This file is part of python-devops-sccs.
+# python-devops-sccs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# python-devops-sccs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# You should have received a copy of the GNU Lesser General Public License
+# along with python-devops-sccs.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Watcher subscriptions
+
+The events of a watcher go to each of its subscribers through a `Subscription`: a bounded queue
+that never blocks the watcher, so a slow client (e.g. a websocket on a bad connection) doesn't
+delay the other subscribers, nor the polls.
+
+When more than `max_size` events are pending, the queue is coalesced by item key: only the latest
+state of each item is kept (e.g. ADDED then MODIFIED becomes one ADDED, with the latest value). The
+queue then holds at most one event per item of the watcher, until the subscriber catches up.
+
+A subscriber whose oldest pending event is more than `max_lag` seconds old is disconnected: its
+pending events are dropped and it gets a `SlowSubscriber` error instead.
+
+A subscription also remembers the sequence number of the last event queued (see snapshot), and skips
+the events it already has: a subscriber resuming a watch passes the last one it saw as `since`.
+"""
+import collections
+import contextlib
+import os
+import time
+
+import anyio
+
+from ..errors import SccsException
+from ..metrics import metrics
+from ..typing.event import Event, EventType
+
+DEPTH_BUCKETS = (1, 10, 100, 1000, 10_000)
+
+metrics.histogram("watcher_subscriber_queue_depth", "Events pending for a subscriber", DEPTH_BUCKETS)
+metrics.counter("watcher_events_coalesced_total", "Pending events replaced by a later one for the same item")
+metrics.counter("watcher_subscribers_disconnected_total", "Subscribers disconnected for being too slow")
+
+
+class SlowSubscriber(SccsException):
+    def __init__(self, lag: float):
+        super().__init__(f"Disconnected: {lag:.0f}s behind the watcher")
+
+
+def _coalesce(previous: Event, event: Event) -> Event:
+    """The event leading a subscriber from before `previous` to after `event`."""
+    if previous.type == EventType.ADDED and event.type == EventType.MODIFIED:
+        # the subscriber hasn't seen the item yet
+        return Event(_type=EventType.ADDED, value=event.value, key=event.key, seq=event.seq)
+    if previous.type == EventType.DELETED and event.type == EventType.ADDED:
+        # the subscriber still has the previous version of the item
+        return Event(_type=EventType.MODIFIED, value=event.value, key=event.key, seq=event.seq)
+    return event
+
+
+class Subscription:
+    def __init__(
+            self,
+            max_size: int = int(os.environ.get('WATCHER_SUBSCRIBER_QUEUE_SIZE', 1000)),
+            max_lag: float = float(os.environ.get('WATCHER_SUBSCRIBER_MAX_LAG', 300)),
+            since: int | None = None,
+            ):
+        """
+        Args:
+            max_size: pending events above which they are coalesced by item key
+            max_lag: seconds an event can wait before the subscriber is disconnected
+            since: sequence number of the last event the subscriber saw, when it resumes a watch
+        """
+        self.max_size = max_size
+        self.max_lag = max_lag
+        self.since = since
+        # sequence number of the last event queued
+        self.seq = since
+        # events put during a replay
+        self._held: list | None = None
+        # (enqueued at, event), by item key once coalesced (by a unique object before that, or for
+        # anything that isn't an Event)
+        self._pending: collections.OrderedDict = collections.OrderedDict()
+        self._coalescing = False
+        self._ready = anyio.Event()
+        self._error: Exception | None = None
+        self.closed = False
+
+    def __len__(self):
+        return len(self._pending)
+
+    @property
+    def disconnected(self) -> bool:
+        """Whether the subscriber was disconnected for being too slow."""
+        return self._error is not None
+
+    @property
+    def lag(self) -> float:
+        """Seconds the oldest pending event has been waiting."""
+        if not self._pending:
+            return 0.0
+        enqueued_at, _ = next(iter(self._pending.values()))
+        return time.monotonic() - enqueued_at
+
+    def put(self, event) -> bool:
+        """Queue `event` without waiting, unless the subscriber already has it. Returns False once
+        the subscription is closed (e.g. the subscriber was too slow)."""
+        if self.closed:
+            return False
+        if self._held is not None:
+            self._held.append(event)
+            return True
+        if isinstance(event, Event) and event.seq is not None:
+            if self.seq is not None and event.seq <= self.seq:
+                return True
+            self.seq = event.seq
+        return self._enqueue(event)
+
+    @contextlib.contextmanager
+    def replaying(self):
+        """Hold the events put meanwhile, to queue them after the replayed ones (see `replay`)."""
+        self._held = []
+        try:
+            yield
+        finally:
+            held, self._held = self._held, None
+            for event in held:
+                self.put(event)
+
+    def replay(self, events: list, seq: int | None):
+        """Queue `events` (e.g. a snapshot, all at the same sequence number), bringing the
+        subscriber to `seq`."""
+        for event in events:
+            if not self._enqueue(event):
+                return
+        self.seq = seq
+
+    def _enqueue(self, event) -> bool:
+        if self.closed:
+            return False
+        if self.lag > self.max_lag:
+            self._disconnect()
+            return False
+
+        now = time.monotonic()
+        if self._coalescing and isinstance(event, Event):
+            previous = self._pending.get(event.key)
+            if previous is not None:
+                enqueued_at, previous_event = previous
+                # keeps its place (and its age) in the queue
+                self._pending[event.key] = (enqueued_at, _coalesce(previous_event, event))
+                metrics.inc("watcher_events_coalesced_total")
+            else:
+                self._pending[event.key] = (now, event)
+        else:
+            self._pending[object()] = (now, event)
+            if not self._coalescing and len(self._pending) > self.max_size:
+                self._coalesce()
+        metrics.observe("watcher_subscriber_queue_depth", len(self._pending))
+        self._ready.set()
+        return True
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """The next event, until the subscription is closed (and drained)."""
+        while not self._pending:
+            if self._error is not None:
+                raise self._error
+            if self.closed:
+                raise StopAsyncIteration
+            await self._ready.wait()
+            self._ready = anyio.Event()
+        _, (_, event) = self._pending.popitem(last=False)
+        if not self._pending:
+            # caught up: back to a plain queue
+            self._coalescing = False
+        return event
+
+    def _coalesce(self):
+        pending, self._pending = self._pending, collections.OrderedDict()
+        self._coalescing = True
+        for enqueued_at, event in pending.values():
+            if not isinstance(event, Event):
+                self._pending[object()] = (enqueued_at, event)
+            elif event.key in self._pending:
+                first_enqueued_at, previous = self._pending[event.key]
+                self._pending[event.key] = (first_enqueued_at, _coalesce(previous, event))
+                metrics.inc("watcher_events_coalesced_total")
+            else:
+                self._pending[event.key] = (enqueued_at, event)
+
+    def _disconnect(self):
+        self._error = SlowSubscriber(self.lag)
+        self._pending.clear()
+        self._coalescing = False
+        metrics.inc("watcher_subscribers_disconnected_total")
+        self.close()
@@ -1,20 +1,3 @@
-"""
-Watcher module
-
-Provide a way to poll an API and to stream results as events (ADD, MODIFY, DELETE)
-"""
-import logging
-from typing import Callable
-
-import anyio
-from anyio import get_cancelled_exc_class, BrokenResourceError
-from anyio.streams.memory import MemoryObjectSendStream
-
-from ..errors import SccsException
-from ..redis import RedisCache
-from ..typing import WatcherType
-from ..typing.event import Event, EventType
-
 # Copyright 2021-2022 Croix Bleue du Québec
 # This file is part of python-devops-sccs.
 # python-devops-sccs is free software: you can redistribute it and/or modify
@@ -28,10 +11,46 @@ from ..typing.event import Event, EventType
 # You should have received a copy of the GNU Lesser General Public License
 # along with python-devops-sccs.  If not, see <https://www.gnu.org/licenses/>.
 
-_sentinel = object()
+"""
+Watcher module
+
+Provide a way to poll an API and to stream results as events (ADD, MODIFY, DELETE), to each
+subscriber through its own bounded queue (see subscription)
+
+With several replicas, only the leader of a watcher (see leadership) polls; the others relay its
+events to their subscribers.
+"""
+import functools
+import logging
+import time
+import uuid
+from typing import Awaitable, Callable
+
+import anyio
+from anyio import get_cancelled_exc_class, WouldBlock
+from anyio.streams.memory import MemoryObjectReceiveStream, MemoryObjectSendStream
+from redis import RedisError
+
+from .activity import last_webhook, tiers
+from .leadership import Lease, channel_of, lease_name, relay
+from .polling import poller
+from .snapshot import Snapshot
+from .subscription import Subscription
+from ..errors import SccsException
+from ..metrics import metrics
+from ..redis import RedisCache
+from ..typing import WatcherType
+from ..typing.event import Event, EventType
+from ..utils.digest import stable_hash
+
+# messages from the other replicas waiting to be handled, per watcher
+_INBOX_SIZE = 100
 
 cache = RedisCache()
 
+metrics.gauge("watchers_leading", "Watchers polling on this replica (the others relay the leader's events)")
+metrics.gauge("watchers_by_tier", "Watchers led by this replica, by activity tier")
+
 
 class WatcherCancelled(Exception):
     pass
@@ -47,41 +66,65 @@ class Watcher:
 
     def __init__(
             self,
-            watcher_id: int,
+            watcher_id: str,
             poll_interval: int,
             func: Callable,
             args: tuple,
             kwargs: dict,
+            repo_slug: str | None = None,
+            patcher: Callable[[list, str, dict], tuple[list, bool]] | None = None,
+            notify: Callable[[], Awaitable] | None = None,
             ):
+        """
+        Args:
+            poll_interval: base interval, adapted to the activity of the watcher (see activity)
+            repo_slug: the repository watched, if any (its webhooks make the watcher hot)
+            patcher: applies a webhook (event key, payload) to the values, returning the new values
+                and whether they are complete (see SccsApi.patch_continuous_deployment_config)
+            notify: requests a debounced refresh (see Scheduler.notify), when a webhook can't be
+                applied; without it, the watcher refreshes right away
+        """
         self.poll_interval = poll_interval
-        self.poll_event = anyio.Event()
+        self.repo_slug = repo_slug
+        self.patcher = patcher
+        self.notify = notify
+        self.tier = None
+        # when the values last changed (time.time())
+        self.last_change = None
         self.bypass_func_cache = False
+        # webhooks applied so far (see patch), telling which polls they overtook
+        self.patches = 0
         self.func = lambda: func(*args, fetch=self.bypass_func_cache, **kwargs)
+        # the key of the function's cached values, if it's cached (see cache_async)
+        self.func_cache_key = func.cache_key(*args, **kwargs) if hasattr(func, "cache_key") else None
         self.key = f"watcher:{func.__name__}:{watcher_id}"
+        self.snapshot = Snapshot(f"{cache.prefix}watcher:{func.__name__}:{{{watcher_id}}}")
         self.streams = set()
         self.streams_accepted = True
         self.watch_tg = None
         self.is_watching = False
+        # distinguishes this watcher from its copies on the other replicas
+        self.origin = uuid.uuid4().hex
+        self.lease = Lease(lease_name(watcher_id))
+        self.channel = channel_of(watcher_id)
+        self.is_leader = False
 
     def has_subscribers(self):
         return len(self.streams) > 0
 
-    async def subscribe(self, send_stream: MemoryObjectSendStream):
+    async def subscribe(self, subscription: Subscription):
         if not self.streams_accepted:
             raise SccsException("Watcher is not accepting new streams")
-        self.streams.add(send_stream)
+        self.streams.add(subscription)
 
         if len(self.streams) == 1:
             await self.start()
         elif len(self.streams) > 0:
-            for event in self.get_watcher_cache_values_as_events():
-                await send_stream.send(event)
+            await self.replay(subscription)
 
-    async def unsubscribe(self, send_stream: MemoryObjectSendStream):
-        try:
-            self.streams.remove(send_stream)
-        except ValueError:
-            pass
+    async def unsubscribe(self, subscription: Subscription):
+        self.streams.discard(subscription)
+        subscription.close()
 
         if len(self.streams) == 0:
             await self.stop()
@@ -91,8 +134,7 @@ class Watcher:
             async with anyio.create_task_group() as tg:
                 self.watch_tg = tg
                 try:
-                    tg.start_soon(self.watch_for_and_send_events)
-                    tg.start_soon(self.timed_refresh)
+                    tg.start_soon(self.lead_or_follow)
                 except Exception as e:
                     self.streams_accepted = False
                     await self.dispatch_event(self.CloseClientOnException(e))
@@ -103,91 +145,215 @@ class Watcher:
     async def stop(self):
         if self.watch_tg is not None:
             self.watch_tg.cancel_scope.cancel()
-            cache.delete(self.key)
             self.watch_tg = None
             self.streams_accepted = True
             self.streams.clear()
 
+    async def lead_or_follow(self):
+        inbox_send, inbox = anyio.create_memory_object_stream(_INBOX_SIZE)
+        handler = functools.partial(self._received, inbox_send)
+        await relay.join(self.channel, handler)
+        try:
+            # the first subscribers start from what the leader (maybe another replica) has seen so far
+            for subscription in list(self.streams):
+                await self.replay(subscription)
+            while True:
+                if await self.lease.acquire():
+                    await self.lead(inbox)
+                else:
+                    await self.follow(inbox)
+        finally:
+            with anyio.CancelScope(shield=True):
+                relay.leave(self.channel, handler)
+                if self.lease.held:
+                    await self.lease.release()
+                    # otherwise a follower takes over from the cached values
+                    if not await relay.listeners(self.channel):
+                        await self.snapshot.delete()
+
+    async def lead(self, inbox: MemoryObjectReceiveStream):
+        """Poll until the lease is lost."""
+        logging.debug(f"Leading {self.key}")
+        # start from the last values seen by the previous leader
+        await self.snapshot.load()
+        self.is_leader = True
+        metrics.inc("watchers_leading")
+        poller.register(self, self.poll_interval, has_values=bool(self.snapshot.values))
+        try:
+            async with anyio.create_task_group() as tg:
+                tg.start_soon(self.watch_for_and_send_events)
+                tg.start_soon(self._serve_refresh_requests, inbox)
+                tg.start_soon(self._adapt_interval)
+                await anyio.sleep(self.lease.ttl / 3)
+                while await self.lease.acquire():
+                    await anyio.sleep(self.lease.ttl / 3)
+                tg.cancel_scope.cancel()
+        finally:
+            poller.unregister(self)
+            self.is_leader = False
+            metrics.inc("watchers_leading", -1)
+            if self.tier is not None:
+                metrics.inc("watchers_by_tier", -1, tier=self.tier)
+                self.tier = None
+        logging.debug(f"Lost the lead of {self.key}")
+
+    async def _adapt_interval(self):
+        """Move the watcher between the activity tiers, adjusting its poll interval."""
+        while True:
+            # the other replicas subscribed to the channel have subscribers of their own
+            subscribers = len(self.streams) + max(0, await relay.listeners(self.channel) - 1)
+            webhook = await last_webhook(self.repo_slug) if self.repo_slug else None
+            tier = tiers.tier(webhook, self.last_change, subscribers)
+            if tier != self.tier:
+                logging.debug(f"{self.key} is {tier}")
+                if self.tier is not None:
+                    metrics.inc("watchers_by_tier", -1, tier=self.tier)
+                metrics.inc("watchers_by_tier", tier=tier)
+                self.tier = tier
+                poller.reschedule(self, tiers.interval(tier, self.poll_interval))
+            await anyio.sleep(tiers.check_interval)
+
+    async def follow(self, inbox: MemoryObjectReceiveStream):
+        """Relay the leader's events for a while (then check whether its lease has expired)."""
+        with anyio.move_on_after(self.lease.ttl / 3):
+            async for message in inbox:
+                for event in message.get("events", ()):
+                    await self.dispatch_event(event)
+                metrics.inc("watcher_relayed_events_total", len(message.get("events", ())))
+
+    async def _serve_refresh_requests(self, inbox: MemoryObjectReceiveStream):
+        async for message in inbox:
+            if "refresh" in message:
+                self.refresh(message["refresh"])
+            elif "patch" in message:
+                await self.patch(*message["patch"])
+
+    def _received(self, inbox: MemoryObjectSendStream, message: dict):
+        if message.get("origin") == self.origin:
+            return
+        try:
+            inbox.send_nowait(message)
+        except WouldBlock:
+            logging.warning(f"{self.key}: dropping a message from another replica, the inbox is full")
+
     async def watch_for_and_send_events(self):
-        async for event in self.watch():
+        while True:
+            await self.emit(await self.poll())
+
+    async def emit(self, events: list[Event]):
+        """Send the leader's events to the subscribers, on every replica."""
+        if events:
+            await relay.publish(self.channel, {"origin": self.origin, "events": events})
+        for event in events:
             await self.dispatch_event(event)
 
     async def dispatch_event(self, event):
-        for send_stream in self.streams:
-            try:
-                await send_stream.send(event)
-            except BrokenResourceError:
-                self.streams.remove(send_stream)
-                raise
-
-    def get_watcher_cache_values_as_events(self) -> list[Event]:
-        values: list[WatcherType] = cache.get(self.key)
-        if values is None:
-            return []
-        return list(
-            map(lambda value: Event(_type=EventType.ADDED, value=value, key=value.key), values)
-            )
+        """Queue `event` for every subscriber, without waiting for any of them."""
+        for subscription in list(self.streams):
+            if not subscription.put(event):
+                # closed, or disconnected for being too slow
+                self.streams.discard(subscription)
+
+    async def get_watcher_cache_values_as_events(self) -> list[Event]:
+        if not self.is_leader:
+            # only the leader's snapshot is up to date
+            await self.snapshot.load()
+        return self.snapshot.events()
+
+    async def replay(self, subscription: Subscription):
+        """Bring a new subscriber up to date: the changes since `subscription.since` when it resumes
+        and they are still in the log, or else the current values (after an INFO event telling a
+        resuming subscriber to start over)."""
+        with subscription.replaying():
+            events = await self.get_watcher_cache_values_as_events()
+            if subscription.since is not None:
+                missed = await self.snapshot.events_since(subscription.since)
+                if missed is not None:
+                    events = missed
+                else:
+                    reset = Event(_type=EventType.INFO, key=0, value={"reset": True}, seq=self.snapshot.seq)
+                    events.insert(0, reset)
+            subscription.replay(events, self.snapshot.seq)
 
     async def watch(self):
         while True:
-            await self.poll_event.wait()
-            self.poll_event = anyio.Event()
-
-            try:
-                values = await self.func()
-                # !!! Reset the bypass cache flag
-                self.bypass_func_cache = False
-            except Exception:
-                raise
-
-            values = standardize_watcher_values(values)
-            events = []
-            # Remove old values (those in cache but not in the new list)
-            # !!! Important to retain the ordering of elements in the list because it's the only source
-            # of truth for environment ordering on the frontend (e.g. master -> dev -> qa -> prod) in
-            # the case of get_continuous_deployment_config calls)...
-            cached_values: list[WatcherType] = cache.get(self.key, [])
-            keys_to_delete = await get_keys_to_delete(values, cached_values)
-            for key in keys_to_delete:
-                value = next((v for v in cached_values if v.key == key), None)
-                event = Event(
-                    _type=EventType.DELETED,
-                    value=value,
-                    key=key
-                    )
-                events.append(event)
-
-            # Add/update new values
-            for value in values:
-                cache_value = next((v for v in cached_values if v.key == value.key), _sentinel)
-                if cache_value is _sentinel:  # new value
-                    _type = EventType.ADDED
-                elif cache_value != value:  # modified value
-                    _type = EventType.MODIFIED
-                else:  # no change
-                    continue
-
-                event = Event(key=value.key, _type=_type, value=value)
-
-                events.append(event)
-
-            # Update the cache
-            cache.set(self.key, values)
-            for event in events:
+            for event in await self.poll():
                 yield event
 
+    async def poll(self) -> list[Event]:
+        """Wait for the poll scheduler to give this watcher its turn, then return the changes since
+        the previous poll (none when a webhook was applied meanwhile: it polls again, see patch)."""
+        async with poller.turn(self):
+            patches = self.patches
+            values = self.func()
+            # !!! Reset the bypass cache flag (before a refresh during the call can set it again)
+            self.bypass_func_cache = False
+            values = await values
+            if self.patches != patches:
+                # fetched before a webhook was applied: the values (and those it may have cached)
+                # are behind the patched snapshot
+                self.refresh(True)
+                return []
+
+        # !!! The ordering of the values is kept: it's the only source of truth for the environment
+        # ordering on the frontend (e.g. master -> dev -> qa -> prod) in the case of
+        # get_continuous_deployment_config calls
+        events = await self.snapshot.update(standardize_watcher_values(values))
+        if events:
+            self.last_change = time.time()
+        return events
+
     def refresh(self, fetch: bool = False):
         """
         Force a refresh (notify the watch to refresh as soon as possible); and optionally bypass the
         function's cache.
         """
-        self.bypass_func_cache = fetch
-        self.poll_event.set()
-
-    async def timed_refresh(self):
-        while True:
-            self.refresh()
-            await anyio.sleep(self.poll_interval)
+        self.bypass_func_cache = self.bypass_func_cache or fetch
+        poller.request(self)
+
+    async def request_refresh(self, fetch: bool = False):
+        """Like `refresh`, on whichever replica leads this watcher."""
+        if self.is_leader:
+            self.refresh(fetch)
+        else:
+            await relay.publish(self.channel, {"origin": self.origin, "refresh": fetch})
+
+    async def patch(self, event_key: str, payload: dict):
+        """Apply a webhook to the values right away, on whichever replica leads this watcher. They
+        are fetched again (debounced, see `notify`) only when the payload isn't enough (or without a
+        patcher)."""
+        if not self.is_leader:
+            await relay.publish(self.channel, {"origin": self.origin, "patch": [event_key, payload]})
+            return
+        if self.patcher is None:
+            await self._refresh_later()
+            return
+        values, complete = self.patcher(list(self.snapshot.values.values()), event_key, payload)
+        self.patches += 1
+        events = await self.snapshot.update(values)
+        if events:
+            self.last_change = time.time()
+            await self.emit(events)
+        if complete:
+            # the function's cached values are behind the patched ones: the next poll gets them again
+            await self._drop_func_cache()
+        else:
+            await self._refresh_later()
+
+    async def _refresh_later(self):
+        if self.notify is None:
+            self.refresh(True)
+        else:
+            await self.notify()
+
+    async def _drop_func_cache(self):
+        if self.func_cache_key is None:
+            return
+        try:
+            await cache.delete_async(self.func_cache_key)
+        except RedisError as e:
+            logging.warning(f"{self.key}: can't drop the cached values, refreshing without the cache: {e}")
+            self.bypass_func_cache = True
 
 
 def standardize_watcher_values(values):
@@ -196,7 +362,7 @@ def standardize_watcher_values(values):
     values = list(
         map(
             lambda v: v if isinstance(v, WatcherType) else WatcherType(
-                key=hash(str(v)),
+                key=stable_hash(str(v)),
                 data=v.dict() if hasattr(v, "dict") else v,
                 )
             , values
@@ -204,9 +370,3 @@ def standardize_watcher_values(values):
         )
     return values
 
-
-async def get_keys_to_delete(values, cache_values):
-    values_keys = set(v.key for v in values)
-    cache_keys = set(v.key for v in cache_values)
-    delete_keys = cache_keys - values_keys
-    return delete_keys
@@ -1,54 +1,306 @@
+import asyncio
+import contextlib
 import functools
+import inspect
+import json
+import math
 import os
-import pickle
+import random
+import threading
+import time
+import uuid
 import weakref
+from collections import Counter
+from dataclasses import dataclass, field
 from datetime import timedelta
-from typing import Any
+from typing import Any, AsyncIterator, Iterable
 
-import dill
+import anyio.to_thread
 from loguru import logger
-from redis import Redis
+from redis import BlockingConnectionPool, Redis
+from redis.asyncio import BlockingConnectionPool as AsyncBlockingConnectionPool, Redis as AsyncRedis
+from redis.asyncio.cluster import ClusterNode as AsyncClusterNode, RedisCluster as AsyncRedisCluster
+from redis.asyncio.retry import Retry as AsyncRetry
+from redis.asyncio.sentinel import Sentinel as AsyncSentinel
+from redis.backoff import ExponentialBackoff
+from redis.cluster import ClusterNode, RedisCluster
+from redis.exceptions import (
+    ConnectionError as RedisConnectionError,
+    LockError,
+    RedisError,
+    ResponseError,
+    TimeoutError as RedisTimeoutError,
+    )
+from redis.retry import Retry
+from redis.sentinel import Sentinel
 
+from devops_console.sccs.circuit_breaker import OPEN, CircuitBreaker
+from devops_console.sccs.codec import Codec, IncompatibleValue, VersionedCodec
+from devops_console.sccs.errors import BitbucketHTTPError
+from devops_console.sccs.fallback_store import FallbackStore, Snapshot
+from devops_console.sccs.local_cache import LocalCache
+from devops_console.sccs.metrics import SIZE_BUCKETS, metrics
 from devops_console.sccs.plugins.cache_keys import CacheKeyFn
+from devops_console.sccs.singleflight import AsyncSingleFlight, SyncSingleFlight
 
+INVALIDATION_CHANNEL = "cache:invalidate"
 
-class Serializer:
-    @staticmethod
-    def needs_pickling(v):
-        if isinstance(v, (str, int, float)):
-            return False
-        return True
+metrics.counter("cache_hits_total", "Values found in the cache, by decorated function and layer")
+metrics.counter("cache_misses_total", "Values not found in the cache, by decorated function")
+metrics.counter("cache_fetches_total", "Calls bypassing the cache with fetch=True")
+metrics.counter("cache_refreshes_total", "Background refreshes of stale values")
+metrics.histogram("cache_compute_seconds", "Time spent computing values upstream")
+metrics.histogram("cache_serialize_seconds", "Time spent encoding values")
+metrics.histogram("cache_deserialize_seconds", "Time spent decoding values")
+metrics.histogram("cache_value_bytes", "Size of the encoded values", buckets=SIZE_BUCKETS)
+metrics.counter("cache_rejections_total", "Values not cached because they were over the size cap")
+metrics.counter("cache_evictions_total", "Entries evicted from a budget over its quota")
+metrics.gauge("cache_budget_bytes", "Bytes accounted to a budget, as of its last write on this replica")
+metrics.gauge("cache_degraded", "1 while redis is unreachable and the embedded fallback store is used")
+metrics.counter("cache_bypasses_total", "Calls sent upstream without the cache (failing, or breaker open)")
+metrics.gauge("cache_breaker_open", "1 while the cache circuit breaker is open")
+metrics.gauge("cache_pool_connections", "Connections of the redis pools, by client and state")
 
-    @staticmethod
-    def needs_unpickling(v):
-        if isinstance(v, bytes):
-            return True
-        return False
+# errors meaning redis can't be reached (as opposed to errors in a command)
+_UNAVAILABLE = (RedisConnectionError, RedisTimeoutError)
 
-    @staticmethod
-    def serialize(value: Any) -> bytes:
-        try:
-            serialized = pickle.dumps(value)
-        except AttributeError:
-            serialized = dill.dumps(value)  # slower than pickle, but can handle more types
-        return serialized
-
-    @staticmethod
-    def deserialize(value) -> Any:
-        if value is None:
-            return None
-        try:
-            deserialized = pickle.loads(value)
-        except (pickle.UnpicklingError, AttributeError, TypeError):
-            deserialized = dill.loads(value)
-        return deserialized
+# Accounts for the values just written to a budget and evicts its least frequently used entries
+# while it is over quota (never the ones just written). Only touches the budget's keys, which share a
+# cluster slot: the evicted entries are returned for the caller to delete.
+# KEYS: frequencies (sorted set), sizes (hash), total (string), expiries (sorted set)
+# ARGV: quota, now, then (key, size, expiry) triples
+# Returns the budget's total and the evicted keys.
+_ACCOUNT_SCRIPT = """
+local quota, now = tonumber(ARGV[1]), tonumber(ARGV[2])
+local written = {}
+local total = 0
+for i = 3, #ARGV, 3 do
+    local key, size = ARGV[i], tonumber(ARGV[i + 1])
+    written[key] = true
+    local old = tonumber(redis.call('HGET', KEYS[2], key) or '0')
+    redis.call('HSET', KEYS[2], key, size)
+    redis.call('ZADD', KEYS[1], 'NX', 1, key)
+    redis.call('ZADD', KEYS[4], ARGV[i + 2], key)
+    total = redis.call('INCRBY', KEYS[3], size - old)
+end
+local evicted = {}
+if total <= quota then
+    return {total, evicted}
+end
+
+local function forget(key)
+    total = redis.call('DECRBY', KEYS[3], tonumber(redis.call('HGET', KEYS[2], key) or '0'))
+    redis.call('HDEL', KEYS[2], key)
+    redis.call('ZREM', KEYS[1], key)
+    redis.call('ZREM', KEYS[4], key)
+end
+
+-- entries that expired on their own
+for _, key in ipairs(redis.call('ZRANGEBYSCORE', KEYS[4], '-inf', now)) do
+    forget(key)
+end
+-- then the least frequently used ones
+if total > quota then
+    for _, key in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+        if not written[key] then
+            forget(key)
+            table.insert(evicted, key)
+            if total <= quota then
+                break
+            end
+        end
+    end
+end
+return {total, evicted}
+"""
+
+
+@dataclass
+class RedisOptions:
+    """How to reach redis. `from_env` gives the defaults; the application builds these from its
+    settings and passes them to `RedisCache.configure`.
+
+    `mode` is "standalone" (`host` and `port`), "sentinel" (the master named `sentinel_master`, as
+    reported by the `sentinels`) or "cluster" (discovered from `cluster_nodes`, or `host` and
+    `port`). Nodes are "host:port" strings."""
+    mode: str = "standalone"
+    host: str = "localhost"
+    port: int = 6379
+    password: str | None = None
+    sentinels: list[str] = field(default_factory=list)
+    sentinel_master: str = "mymaster"
+    sentinel_password: str | None = None
+    cluster_nodes: list[str] = field(default_factory=list)
+    # per client (the blocking one and the asyncio one each have a pool)
+    max_connections: int = 50
+    # seconds to wait for a free connection once the pool is exhausted
+    pool_timeout: float = 5.0
+    socket_timeout: float | None = 5.0
+    connect_timeout: float | None = 2.0
+    health_check_interval: int = 30
+    # retries of a command on connection errors and timeouts, with an exponential backoff (seconds)
+    retries: int = 2
+    retry_backoff_base: float = 0.05
+    retry_backoff_cap: float = 0.5
+    # consecutive cache failures opening the circuit breaker, and how long it stays open (seconds)
+    breaker_threshold: int = 5
+    breaker_cooldown: float = 30.0
+
+    @classmethod
+    def from_env(cls) -> "RedisOptions":
+        env = os.environ.get
+        return cls(
+            mode=env('REDIS_MODE', cls.mode),
+            host=env('REDIS_HOST', cls.host),
+            port=int(env('REDIS_PORT', cls.port)),
+            password=env('REDIS_PASSWORD'),
+            sentinels=split_nodes(env('REDIS_SENTINELS', '')),
+            sentinel_master=env('REDIS_SENTINEL_MASTER', cls.sentinel_master),
+            sentinel_password=env('REDIS_SENTINEL_PASSWORD'),
+            cluster_nodes=split_nodes(env('REDIS_CLUSTER_NODES', '')),
+            max_connections=int(env('REDIS_MAX_CONNECTIONS', cls.max_connections)),
+            pool_timeout=float(env('REDIS_POOL_TIMEOUT', cls.pool_timeout)),
+            socket_timeout=float(env('REDIS_SOCKET_TIMEOUT', cls.socket_timeout)),
+            connect_timeout=float(env('REDIS_CONNECT_TIMEOUT', cls.connect_timeout)),
+            health_check_interval=int(env('REDIS_HEALTH_CHECK_INTERVAL', cls.health_check_interval)),
+            retries=int(env('REDIS_RETRIES', cls.retries)),
+            retry_backoff_base=float(env('REDIS_RETRY_BACKOFF_BASE', cls.retry_backoff_base)),
+            retry_backoff_cap=float(env('REDIS_RETRY_BACKOFF_CAP', cls.retry_backoff_cap)),
+            breaker_threshold=int(env('CACHE_BREAKER_THRESHOLD', cls.breaker_threshold)),
+            breaker_cooldown=float(env('CACHE_BREAKER_COOLDOWN', cls.breaker_cooldown)),
+            )
+
+    def connection_kwargs(self) -> dict:
+        return dict(
+            password=self.password,
+            decode_responses=False,
+            max_connections=self.max_connections,
+            socket_timeout=self.socket_timeout,
+            socket_connect_timeout=self.connect_timeout,
+            health_check_interval=self.health_check_interval,
+            )
+
+    def nodes(self, nodes: list[str]) -> list[tuple[str, int]]:
+        """`nodes` as (host, port) pairs; `host` and `port` if there are none."""
+        pairs = []
+        for node in nodes or [f"{self.host}:{self.port}"]:
+            host, _, port = node.rpartition(":")
+            pairs.append((host, int(port)))
+        return pairs
+
+    def backoff(self) -> ExponentialBackoff:
+        return ExponentialBackoff(cap=self.retry_backoff_cap, base=self.retry_backoff_base)
+
+
+def _degradable(fallback: str):
+    """Runs the method on redis or, while redis is unreachable, the `fallback` method (called with
+    the same arguments) on the embedded fallback store. A connection error switches over; other
+    errors are counted by the circuit breaker."""
+
+    def decorator(method):
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def async_wrapper(self, *args, **kwargs):
+                if not await self._degraded_async():
+                    try:
+                        result = await method(self, *args, **kwargs)
+                    except _UNAVAILABLE as e:
+                        self._degrade(e)
+                    except Exception:
+                        self._failed()
+                        raise
+                    else:
+                        self.breaker.record_success()
+                        return result
+                return await self._in_fallback_async(getattr(self, fallback), *args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not self._degraded():
+                try:
+                    result = method(self, *args, **kwargs)
+                except _UNAVAILABLE as e:
+                    self._degrade(e)
+                except Exception:
+                    self._failed()
+                    raise
+                else:
+                    self.breaker.record_success()
+                    return result
+            return getattr(self, fallback)(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
 
 
 class RedisCache:
-    """Basic singleton wrapper for redis client.  Pickles/Dills everything."""
+    """Basic singleton wrapper for redis client. Values are (de)serialized by `codec`, which can
+    be swapped for any `Codec` implementation.
+
+    Two clients share the same configuration: `redis` is the blocking client used by `cache_sync`
+    (which runs in worker threads) and `aredis` is a pooled `redis.asyncio` client used on the event
+    loop. Coroutines must only ever use the `*_async` methods.
+
+    Reads go through an in-process `LocalCache` first. Every write or delete is applied to the local
+    cache and broadcast on `INVALIDATION_CHANNEL` so that the other replicas drop their copy.
+
+    All the keys are stored under `prefix`. Entries can be registered under tags (see `repo_tag`,
+    `fn_tag` and `user_tag`) and invalidated together with `invalidate_tags`.
+
+    Memory: values larger than `max_value_bytes` are not cached. Each decorated function (or
+    namespace, for namespaced keys) is a budget; a budget with a quota in `quotas` (or
+    `default_quota`) tracks the size and hit count of its entries, and evicts the least frequently
+    used ones when it goes over quota. See `memory_report_async` for what is actually stored.
+
+    Redis being down is not fatal: the cache switches to an embedded `FallbackStore` (per replica)
+    and tries to reconnect with an exponential backoff. Once redis is back, what was written or
+    deleted in the meantime is replayed on it (see `_resync`).
+
+    Connections are pooled, with timeouts and retries set by `RedisOptions` (see `configure`). Other
+    failures open `breaker`, during which the decorators bypass the cache entirely.
+    """
     _cache = None
     redis = None
+    aredis = None
     _is_initialized = False
+    _pending_writes: set[asyncio.Task] = set()
+    _invalidation_listener: asyncio.Task | None = None
+    instance_id = uuid.uuid4().hex
+    prefix = os.environ.get('CACHE_KEY_PREFIX', 'devops-console:')
+    codec: Codec = VersionedCodec(
+        compression_threshold=int(os.environ.get('CACHE_COMPRESSION_THRESHOLD', 4096)),
+        compression=os.environ.get('CACHE_COMPRESSION', 'zstd') or None,
+        )
+    local = LocalCache(
+        max_entries=int(os.environ.get('CACHE_LOCAL_MAX_ENTRIES', 1024)),
+        max_bytes=int(os.environ.get('CACHE_LOCAL_MAX_BYTES', 64 * 1024 * 1024)),
+        max_ttl=timedelta(seconds=int(os.environ.get('CACHE_LOCAL_MAX_TTL', 300))),
+        )
+    # byte limits (0: no limit); quotas are given in json, e.g. {"get_repository_permissions": 50000000}
+    max_value_bytes = int(os.environ.get('CACHE_MAX_VALUE_BYTES', 0))
+    quotas: dict[str, int] = json.loads(os.environ.get('CACHE_QUOTAS', '{}'))
+    default_quota = int(os.environ.get('CACHE_DEFAULT_QUOTA', 0))
+    _hits: Counter = Counter()
+    fallback = FallbackStore(
+        max_bytes=int(os.environ.get('CACHE_FALLBACK_MAX_BYTES', 128 * 1024 * 1024)),
+        path=os.environ.get('CACHE_FALLBACK_PATH') or None,
+        spill_threshold=int(os.environ.get('CACHE_FALLBACK_SPILL_THRESHOLD', 64 * 1024)),
+        max_file_bytes=int(os.environ.get('CACHE_FALLBACK_MAX_FILE_BYTES', 1024 * 1024 * 1024)),
+        )
+    degraded = False
+    # first and longest wait between two reconnection attempts, in seconds
+    reconnect_backoff = (1.0, 60.0)
+    _backoff = 0.0
+    _retry_at = 0.0
+    _probe_lock = threading.Lock()
+    options: RedisOptions | None = None
+    breaker = CircuitBreaker(
+        threshold=int(os.environ.get('CACHE_BREAKER_THRESHOLD', RedisOptions.breaker_threshold)),
+        cooldown=float(os.environ.get('CACHE_BREAKER_COOLDOWN', RedisOptions.breaker_cooldown)),
+        )
 
     def __new__(cls, *args, **kwargs):
         if not cls._cache:
@@ -56,76 +308,1310 @@ class RedisCache:
         return cls._cache
 
     def init(self):
+        """Connect to redis. Doesn't fail if redis can't be reached: the cache starts on the fallback
+        store instead."""
         if self._is_initialized:
             return
+        self._is_initialized = True
 
         try:
-            redis_password = os.environ['REDIS_PASSWORD']
-            redis_host = os.environ.get('REDIS_HOST', 'localhost')
-
-            # redis_url = f'redis://:{redis_password}@{redis_host}:6379/0'
-            self.redis = Redis(redis_host, password=redis_password, decode_responses=False)
-            assert self.redis.ping()
+            self._connect()
+            self.redis.ping()
         except Exception as e:
-            logger.critical(e)
-            self.redis = None
-            raise e
+            self._degrade(e)
+            return
 
         logger.debug("REDIS CACHE initialized")
-        self._is_initialized = True
 
-    def set(self, key, value, ttl=timedelta(hours=1)) -> bool:
-        value = Serializer.serialize(value)
-        success = self.redis.set(key, value, ex=ttl)
+    def configure(self, options: RedisOptions):
+        """Use `options` instead of the environment. Must be called before `init`."""
+        self.options = options
+        self.breaker = CircuitBreaker(options.breaker_threshold, options.breaker_cooldown)
+
+    def _connect(self):
+        options = self.options or RedisOptions.from_env()
+        kwargs = options.connection_kwargs()
+        retry = Retry(options.backoff(), options.retries)
+        aretry = AsyncRetry(options.backoff(), options.retries)
+
+        # the asyncio clients only open connections on first use, so they are safe to build outside the loop
+        if options.mode == "sentinel":
+            sentinel_kwargs = dict(password=options.sentinel_password, socket_timeout=options.socket_timeout)
+            sentinels = options.nodes(options.sentinels)
+            self.redis = Sentinel(sentinels, sentinel_kwargs=sentinel_kwargs).master_for(
+                options.sentinel_master, retry=retry, **kwargs
+                )
+            self.aredis = AsyncSentinel(sentinels, sentinel_kwargs=sentinel_kwargs).master_for(
+                options.sentinel_master, retry=aretry, **kwargs
+                )
+        elif options.mode == "cluster":
+            # slots are discovered here: fails if none of the nodes answers
+            nodes = options.nodes(options.cluster_nodes)
+            self.redis = RedisCluster(
+                startup_nodes=[ClusterNode(host, port) for host, port in nodes], retry=retry, **kwargs
+                )
+            self.aredis = AsyncRedisCluster(
+                startup_nodes=[AsyncClusterNode(host, port) for host, port in nodes], retry=aretry, **kwargs
+                )
+        elif options.mode == "standalone":
+            # a full pool makes callers wait (up to pool_timeout) instead of failing right away
+            pool_kwargs = dict(host=options.host, port=options.port, timeout=options.pool_timeout, **kwargs)
+            self.redis = Redis(connection_pool=BlockingConnectionPool(retry=retry, **pool_kwargs))
+            self.aredis = AsyncRedis(connection_pool=AsyncBlockingConnectionPool(retry=aretry, **pool_kwargs))
+        else:
+            raise ValueError(f'Unknown redis mode "{options.mode}"')
+
+    def _failed(self):
+        if self.breaker.record_failure():
+            logger.error(f"REDIS CACHE failing, bypassing it for {self.breaker.cooldown}s")
+            metrics.set("cache_breaker_open", 1)
+
+    def bypassed(self) -> bool:
+        """Whether the decorators should skip the cache and call the upstream method (the circuit
+        breaker is open)."""
+        return not self.breaker.allow()
+
+    def pool_stats(self) -> dict[str, dict[str, int]]:
+        """Connections of both pools: how many exist, are in use and can exist at most. Also
+        updates the `cache_pool_connections` gauges."""
+        stats = {}
+        for client, redis in (("sync", self.redis), ("async", self.aredis)):
+            if redis is None:
+                continue
+            stats[client] = {"created": 0, "in_use": 0, "max": 0}
+            for created, in_use, max_connections in _pools_usage(redis):
+                stats[client]["created"] += created
+                stats[client]["in_use"] += in_use
+                stats[client]["max"] += max_connections
+            for state, n in stats[client].items():
+                metrics.set("cache_pool_connections", n, client=client, state=state)
+        metrics.set("cache_breaker_open", int(self.breaker.state == OPEN))
+        return stats
+
+    def _degrade(self, e: Exception):
+        if not self.degraded:
+            logger.error(f"REDIS CACHE unavailable, switching to the embedded fallback store: {e}")
+            self.degraded = True
+            self._backoff = self.reconnect_backoff[0]
+            self._retry_at = time.monotonic() + self._backoff
+            metrics.set("cache_degraded", 1)
+
+    def _next_attempt(self) -> bool:
+        """Whether it is time to try reconnecting. If so, the attempt after it is pushed back."""
+        with self._probe_lock:
+            now = time.monotonic()
+            if now < self._retry_at:
+                return False
+            self._backoff = min(self._backoff * 2, self.reconnect_backoff[1])
+            self._retry_at = now + self._backoff * random.uniform(0.5, 1)
+            return True
+
+    def _degraded(self) -> bool:
+        """Whether to use the fallback store. While degraded, this is where reconnecting happens."""
+        if not self.degraded:
+            return False
+        if not self._next_attempt():
+            return True
+        try:
+            if self.redis is None:
+                self._connect()
+            self.redis.ping()
+            self._resync()
+        except Exception as e:
+            logger.debug(f"REDIS CACHE still unavailable: {e}")
+            return True
+        return False
+
+    async def _degraded_async(self) -> bool:
+        if not self.degraded:
+            return False
+        if not self._next_attempt():
+            return True
+        try:
+            if self.aredis is None:
+                self._connect()
+            await self.aredis.ping()
+            await self._resync_async()
+        except Exception as e:
+            logger.debug(f"REDIS CACHE still unavailable: {e}")
+            return True
+        return False
+
+    def _resync(self):
+        """Replay on redis what was written and deleted while it was unreachable."""
+        snapshot = self.fallback.snapshot()
+        for prefix in [""] if snapshot.cleared else snapshot.deleted_prefixes:
+            keys = list(self.redis.scan_iter(self._k(f"{prefix}*"), count=500))
+            for i in range(0, len(keys), 500):
+                self.redis.unlink(*keys[i:i + 500])
+        if snapshot.invalidated_tags:
+            pipe = self.redis.pipeline(transaction=False)
+            for tag in snapshot.invalidated_tags:
+                pipe.zrange(self._tag_key(tag), 0, -1)
+            keys = {self._k(k) for members in pipe.execute() for k in members}
+            self.redis.unlink(*keys, *(self._tag_key(t) for t in snapshot.invalidated_tags))
+        pipe = self.redis.pipeline(transaction=False)
+        self._resync_commands(pipe, snapshot)
+        pipe.execute()
+        self._recovered(snapshot)
+
+    async def _resync_async(self):
+        snapshot = await self._in_fallback_async(self.fallback.snapshot)
+        for prefix in [""] if snapshot.cleared else snapshot.deleted_prefixes:
+            keys = [key async for key in self.aredis.scan_iter(match=self._k(f"{prefix}*"), count=500)]
+            for i in range(0, len(keys), 500):
+                await self.aredis.unlink(*keys[i:i + 500])
+        if snapshot.invalidated_tags:
+            async with self.aredis.pipeline(transaction=False) as pipe:
+                for tag in snapshot.invalidated_tags:
+                    pipe.zrange(self._tag_key(tag), 0, -1)
+                keys = {self._k(k) for members in await pipe.execute() for k in members}
+            await self.aredis.unlink(*keys, *(self._tag_key(t) for t in snapshot.invalidated_tags))
+        async with self.aredis.pipeline(transaction=False) as pipe:
+            self._resync_commands(pipe, snapshot)
+            await pipe.execute()
+        await self._in_fallback_async(self._recovered, snapshot)
+
+    def _resync_commands(self, pipe, snapshot: Snapshot):
+        if snapshot.deleted_keys:
+            pipe.unlink(*(self._k(k) for k in snapshot.deleted_keys))
+        for key, value, ttl, tags in snapshot.entries:
+            pipe.set(self._k(key), value, px=max(int(ttl * 1000), 1))
+            self._tag_commands(pipe, key, ttl, tags)
+        for name, scores in snapshot.scores.items():
+            for member, amount in scores.items():
+                pipe.zincrby(self._k(name), amount, member)
+        if snapshot:
+            # the other replicas' local caches may have missed invalidations too
+            self._publish_command(pipe, self._invalidation_message("clear"))
+
+    def _recovered(self, snapshot: Snapshot):
+        self.fallback.clear()
+        self.local.clear()
+        self.degraded = False
+        metrics.set("cache_degraded", 0)
+        logger.info(f"REDIS CACHE reconnected, resynced {len(snapshot.entries)} entries")
+
+    def _k(self, key) -> str:
+        """Physical redis key for a cache key: everything lives under `prefix`."""
+        return self.prefix + (key.decode() if isinstance(key, bytes) else str(key))
+
+    def _tag_key(self, tag: str) -> str:
+        # the tag is its own hash tag: "repo:" tags share their slot with the entries of the repository
+        return f"{self.prefix}tag:{{{tag}}}"
+
+    def _tag_of(self, tag_key: bytes) -> str:
+        return tag_key.decode()[len(self.prefix) + len("tag:{"):-1]
+
+    @property
+    def _channel(self) -> str:
+        return self._k(INVALIDATION_CHANNEL)
+
+    def _publish_command(self, pipe, message: str):
+        # cluster pipelines refuse `publish` (it has no slot), not the command itself: any node
+        # forwards it to the whole cluster
+        pipe.execute_command("PUBLISH", self._channel, message)
+
+    def _tag_commands(self, pipe, key, ttl, tags: Iterable[str]):
+        """Index `key` under each tag. Tags are sorted sets scored by the entry's expiry, so expired
+        members can be pruned as new ones are added."""
+        now = time.time()
+        expires_at = now + (ttl.total_seconds() if isinstance(ttl, timedelta) else ttl)
+        for tag in tags:
+            tag_key = self._tag_key(tag)
+            pipe.zadd(tag_key, {str(key): expires_at})
+            pipe.zremrangebyscore(tag_key, "-inf", now)
+
+    def set(
+            self, key, value, ttl=timedelta(hours=1), tags: Iterable[str] = (), function: str = None
+            ) -> bool:
+        """`function` is the decorated function the value comes from, for the metrics and the
+        memory budgets."""
+        value = self._encode(value, function)
+        if not self._admit(key, value, function):
+            self.delete(key)
+            return False
+        success = self._write(key, value, ttl, tags, function)
+        if success:
+            self._set_local(key, value, ttl)
+        return success
+
+    @_degradable("_fallback_write")
+    def _write(self, key, value: bytes, ttl, tags: Iterable[str] = (), function: str = None) -> bool:
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(self._k(key), value, ex=ttl)
+        self._tag_commands(pipe, key, ttl, tags)
+        self._publish_command(pipe, self._invalidation_message("keys", key))
+        self._hit_commands(pipe)
+        success = pipe.execute()[0]
         if success:
             logger.debug(f'REDIS CACHE SET for "{key}"')
+            self._account({key: value}, ttl, function)
         return success
 
-    def get(self, key, default=None) -> Any:
-        value = self.redis.get(key)
-        if value is None:
-            logger.debug(f'REDIS CACHE MISS for "{key}"')
-            return default
-        value = Serializer.deserialize(value)
-        logger.debug(f'REDIS CACHE HIT for "{key}"')
-        return value
+    def get(self, key, default=None, function: str = None) -> Any:
+        value = self._get_local(key, function)
+        if value is not _sentinel:
+            return value
+
+        data, pttl = self._read(key)
+        value = self._load(key, data, pttl, function)
+        if value is _incompatible:
+            self.delete(key)
+        return default if value is _sentinel or value is _incompatible else value
+
+    @_degradable("_fallback_read")
+    def _read(self, key) -> tuple[bytes | None, int]:
+        """The encoded value and its PTTL."""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(self._k(key))
+        pipe.pttl(self._k(key))
+        data, pttl = pipe.execute()
+        return data, pttl
+
+    def get_many(self, keys: list, default=None, function: str = None) -> list:
+        """`get` for several keys: the ones not in the local cache are read in one round-trip."""
+        values = [self._get_local(key, function) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is _sentinel]
+        if missing:
+            data, pttls = self._read_many([keys[i] for i in missing])
+            for i, d, pttl in zip(missing, data, pttls):
+                values[i] = self._load(keys[i], d, pttl, function)
+            incompatible = [keys[i] for i in missing if values[i] is _incompatible]
+            if incompatible:
+                self.delete(*incompatible)
+        return [default if value is _sentinel or value is _incompatible else value for value in values]
+
+    @_degradable("_fallback_read_many")
+    def _read_many(self, keys: list) -> tuple[list[bytes | None], list[int]]:
+        pipe = self.redis.pipeline(transaction=False)
+        self._get_many_commands(pipe, keys)
+        replies = pipe.execute()
+        return replies[:len(keys)], replies[len(keys):]
+
+    def set_many(
+            self,
+            items: dict,
+            ttl: timedelta | dict = timedelta(hours=1),
+            tags: dict[Any, Iterable[str]] = None,
+            function: str = None,
+            ) -> bool:
+        """`set` for several keys (`items` maps keys to values) in one round-trip. `ttl` can also map
+        keys to their ttl, and `tags` maps keys to their tags."""
+        if not items:
+            return True
+        encoded, rejected = self._admit_many(items, function)
+        if rejected:
+            self.delete(*rejected)
+        if not encoded:
+            return False
+        success = self._write_many(encoded, ttl, tags, function)
+        if success:
+            for key, value in encoded.items():
+                self._set_local(key, value, _ttl_of(ttl, key))
+        return success and not rejected
+
+    @_degradable("_fallback_write_many")
+    def _write_many(self, encoded: dict[Any, bytes], ttl, tags: dict | None, function: str | None) -> bool:
+        pipe = self.redis.pipeline(transaction=False)
+        self._set_many_commands(pipe, encoded, ttl, tags)
+        self._hit_commands(pipe)
+        success = all(pipe.execute()[:len(encoded)])
+        if success:
+            logger.debug(f"REDIS CACHE SET for {list(encoded)}")
+            self._account(encoded, ttl, function)
+        return success
 
+    @_degradable("_fallback_exists")
     def exists(self, key) -> bool:
-        return self.redis.exists(key) > 0
+        return self.redis.exists(self._k(key)) > 0
 
+    @_degradable("_fallback_delete")
     def delete(self, *keys) -> int:
-        n = self.redis.delete(*keys)
+        self.local.delete(*keys)
+        n = self.redis.unlink(*(self._k(k) for k in keys))
+        self.redis.publish(self._channel, self._invalidation_message("keys", *keys))
         logger.debug(f"REDIS CACHE DELETE {n} keys for {keys}")
         return n
 
+    @_degradable("_fallback_invalidate_tags")
+    def invalidate_tags(self, *tags: str) -> int:
+        """Delete every entry registered under any of `tags`. Only reads the tags' members: the rest
+        of the keyspace is never scanned."""
+        pipe = self.redis.pipeline(transaction=False)
+        for tag in tags:
+            pipe.zrangebyscore(self._tag_key(tag), time.time(), "+inf")
+        keys = {k.decode() for members in pipe.execute() for k in members}
+        n = self.delete(*keys) if keys else 0
+        self.redis.unlink(*(self._tag_key(t) for t in tags))
+        logger.debug(f"REDIS CACHE INVALIDATE {n} keys for tags {tags}")
+        return n
+
+    @_degradable("_fallback_delete_namespace")
     def delete_namespace(self, namespace) -> int:
+        """Delete every key starting with `namespace`. Scans the cache's keys: prefer tags."""
+        self.local.delete_prefix(namespace)
+        self.redis.publish(self._channel, self._invalidation_message("prefix", namespace))
         n = 0
-        for key in self.redis.scan_iter(f"{namespace}*"):
-            n += self.delete(key)
+        batch = []
+        for key in self.redis.scan_iter(self._k(f"{namespace}*"), count=500):
+            batch.append(key)
+            if len(batch) >= 500:
+                n += self.redis.unlink(*batch)
+                batch = []
+        if batch:
+            n += self.redis.unlink(*batch)
+        logger.debug(f'REDIS CACHE DELETE {n} keys in namespace "{namespace}"')
         return n
 
+    @_degradable("_fallback_clear")
     def clear(self):
+        """Delete everything the application stored (and nothing else)."""
+        logger.debug("REDIS CACHE CLEAR")
+        n = self.delete_namespace("")
+        self.local.clear()
+        self.redis.publish(self._channel, self._invalidation_message("clear"))
+        return n
+
+    def _get_local(self, key, function: str | None) -> Any:
+        value = self.local.get(key, _sentinel)
+        if value is not _sentinel:
+            logger.debug(f'LOCAL CACHE HIT for "{key}"')
+            _count("cache_hits_total", function, layer="local")
+            self._record_hit(key, function)
+        return value
+
+    def _load(self, key, data: bytes | None, pttl: int, function: str | None) -> Any:
+        """Decode a value read from redis and keep it in the local cache. Returns `_sentinel` on a
+        miss and `_incompatible` if the value must be dropped."""
+        if data is None:
+            logger.debug(f'REDIS CACHE MISS for "{key}"')
+            _count("cache_misses_total", function)
+            return _sentinel
+        try:
+            value = self._decode(data, function)
+        except IncompatibleValue as e:
+            _count("cache_misses_total", function)
+            logger.info(f'REDIS CACHE dropping incompatible value for "{key}": {e}')
+            return _incompatible
+        self.local.set(key, value, len(data), ttl=_pttl_to_ttl(pttl))
+        logger.debug(f'REDIS CACHE HIT for "{key}"')
+        _count("cache_hits_total", function, layer="redis")
+        self._record_hit(key, function)
+        return value
+
+    def _get_many_commands(self, pipe, keys: list):
+        # no MGET: the keys may be in different cluster slots
+        for key in keys:
+            pipe.get(self._k(key))
+        for key in keys:
+            pipe.pttl(self._k(key))
+
+    def _set_many_commands(self, pipe, encoded: dict[Any, bytes], ttl, tags: dict | None):
+        # the SET replies come first
+        for key, value in encoded.items():
+            pipe.set(self._k(key), value, ex=_ttl_of(ttl, key))
+        for key in encoded:
+            self._tag_commands(pipe, key, _ttl_of(ttl, key), (tags or {}).get(key, ()))
+        self._publish_command(pipe, self._invalidation_message("keys", *encoded))
+
+    def budget_of(self, key, function: str | None) -> str | None:
+        """The budget of an entry: its namespace, or else the name of the function it comes from."""
+        namespace, sep, _ = str(key).partition("::")
+        if sep:
+            return namespace
+        if function is not None:
+            return function.rsplit(".", 1)[-1]
+        return None
+
+    def quota_of(self, budget: str | None) -> int:
+        """Quota in bytes of `budget` (0: not tracked)."""
+        if budget is None:
+            return 0
+        return self.quotas.get(budget, self.default_quota)
+
+    def _budget_key(self, budget: str, part: str) -> str:
+        # the keys of a budget are used together by _ACCOUNT_SCRIPT: same slot
+        return f"{self.prefix}budget:{{{budget}}}:{part}"
+
+    def _admit(self, key, value: bytes, function: str | None) -> bool:
+        if self.max_value_bytes and len(value) > self.max_value_bytes:
+            logger.info(
+                f'REDIS CACHE not caching "{key}": {len(value)} bytes is over the '
+                f'{self.max_value_bytes} bytes cap'
+                )
+            metrics.inc("cache_rejections_total", function=function or "")
+            return False
+        return True
+
+    def _admit_many(self, items: dict, function: str | None) -> tuple[dict[Any, bytes], list]:
+        encoded, rejected = {}, []
+        for key, value in items.items():
+            data = self._encode(value, function)
+            if self._admit(key, data, function):
+                encoded[key] = data
+            else:
+                rejected.append(key)
+        return encoded, rejected
+
+    def _record_hit(self, key, function: str | None):
+        budget = self.budget_of(key, function)
+        if self.quota_of(budget):
+            self._hits[(budget, self._k(key))] += 1
+
+    def _hit_commands(self, pipe):
+        """Add the hits counted since the last write to the entries' frequencies. Entries that
+        are no longer tracked (evicted, expired) are not re-added."""
+        hits, self._hits = self._hits, Counter()
+        for (budget, key), n in hits.items():
+            pipe.zadd(self._budget_key(budget, "frequencies"), {key: n}, xx=True, incr=True)
+
+    def _account_args(self, encoded: dict[Any, bytes], ttl, function: str | None) -> dict[str, tuple]:
+        """Arguments of `_ACCOUNT_SCRIPT` for each tracked budget of the `encoded` values."""
+        now = time.time()
+        by_budget: dict[str, list] = {}
+        for key, value in encoded.items():
+            budget = self.budget_of(key, function)
+            if self.quota_of(budget):
+                expires_at = now + _seconds(_ttl_of(ttl, key))
+                by_budget.setdefault(budget, []).extend((self._k(key), len(value), expires_at))
+        return {
+            budget: (
+                [self._budget_key(budget, part) for part in ("frequencies", "sizes", "total", "expiries")],
+                [self.quota_of(budget), now, *args],
+                )
+            for budget, args in by_budget.items()
+            }
+
+    def _account(self, encoded: dict[Any, bytes], ttl, function: str | None):
+        for budget, (keys, args) in self._account_args(encoded, ttl, function).items():
+            total, evicted = self.redis.register_script(_ACCOUNT_SCRIPT)(keys=keys, args=args)
+            evicted = self._evicted(budget, total, evicted)
+            if evicted:
+                self.redis.unlink(*(self._k(k) for k in evicted))
+                self.redis.publish(self._channel, self._invalidation_message("keys", *evicted))
+
+    def _evicted(self, budget: str, total: int, evicted: list[bytes]) -> list[str]:
+        """Cache keys of the entries evicted from `budget`, which are also dropped locally."""
+        metrics.set("cache_budget_bytes", total, budget=budget)
+        if not evicted:
+            return []
+        keys = [k.decode()[len(self.prefix):] for k in evicted]
+        self.local.delete(*keys)
+        metrics.inc("cache_evictions_total", len(keys), budget=budget)
+        logger.info(f'REDIS CACHE evicted {len(keys)} entries from "{budget}" ({total} bytes left)')
+        return keys
+
+    def _encode(self, value, function: str | None) -> bytes:
+        if function is None:
+            return self.codec.encode(value)
+        start = time.perf_counter()
+        data = self.codec.encode(value)
+        metrics.observe("cache_serialize_seconds", time.perf_counter() - start, function=function)
+        metrics.observe("cache_value_bytes", len(data), function=function)
+        return data
+
+    def _decode(self, data: bytes, function: str | None) -> Any:
+        if function is None:
+            return self.codec.decode(data)
+        start = time.perf_counter()
+        value = self.codec.decode(data)
+        metrics.observe("cache_deserialize_seconds", time.perf_counter() - start, function=function)
+        return value
+
+    def _set_local(self, key, serialized: bytes, ttl):
+        # store a private copy: the caller keeps (and may mutate) the object it just computed
+        if self.local.enabled:
+            self.local.set(key, self.codec.decode(serialized), len(serialized), ttl=ttl)
+
+    def _invalidation_message(self, op: str, *keys) -> str:
+        return json.dumps({
+            "origin": self.instance_id,
+            "op": op,
+            "keys": [k.decode() if isinstance(k, bytes) else str(k) for k in keys],
+            })
+
+    def _apply_invalidation(self, message: bytes | str):
+        try:
+            message = json.loads(message)
+        except (TypeError, ValueError):
+            logger.warning(f"Invalid cache invalidation message: {message}")
+            return
+        if message.get("origin") == self.instance_id:
+            return
+
+        op, keys = message.get("op"), message.get("keys", [])
+        if op == "keys":
+            self.local.delete(*keys)
+        elif op == "prefix":
+            for prefix in keys:
+                self.local.delete_prefix(prefix)
+        elif op == "clear":
+            self.local.clear()
+
+    def start_invalidation_listener(self):
+        """Start listening (in a background task) for the invalidations sent by other replicas.
+        Must be called from the event loop."""
+        if self._invalidation_listener is None or self._invalidation_listener.done():
+            self._invalidation_listener = asyncio.get_running_loop().create_task(
+                self._listen_for_invalidations()
+                )
+
+    async def _listen_for_invalidations(self):
+        while True:
+            try:
+                async with self.aredis.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.subscribe(self._channel)
+                    async for message in pubsub.listen():
+                        self._apply_invalidation(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # anything published while we were disconnected is lost
+                logger.warning(f"REDIS CACHE invalidation listener error: {e}")
+                self.local.clear()
+                await asyncio.sleep(max(1.0, self._backoff if self.degraded else 0))
+
+    async def set_async(
+            self,
+            key,
+            value,
+            ttl=timedelta(hours=1),
+            write_behind=False,
+            tags: Iterable[str] = (),
+            function: str = None,
+            ) -> bool:
+        """Awaitable `set`. With `write_behind`, the value is serialized right away (so later
+        mutations by the caller are not cached) but the write itself is done in a background task
+        and this returns immediately."""
+        value = self._encode(value, function)
+        if not self._admit(key, value, function):
+            await self.delete_async(key)
+            return False
+        self._set_local(key, value, ttl)
+        if not write_behind:
+            return await self._write_async(key, value, ttl, tags, function)
+
+        task = asyncio.get_running_loop().create_task(self._write_async(key, value, ttl, tags, function))
+        self._pending_writes.add(task)
+        task.add_done_callback(self._write_behind_done)
+        return True
+
+    @_degradable("_fallback_write")
+    async def _write_async(
+            self, key, value: bytes, ttl, tags: Iterable[str] = (), function: str = None
+            ) -> bool:
+        async with self.aredis.pipeline(transaction=False) as pipe:
+            pipe.set(self._k(key), value, ex=ttl)
+            self._tag_commands(pipe, key, ttl, tags)
+            self._publish_command(pipe, self._invalidation_message("keys", key))
+            self._hit_commands(pipe)
+            success = (await pipe.execute())[0]
+        if success:
+            logger.debug(f'REDIS CACHE SET for "{key}"')
+            await self._account_async({key: value}, ttl, function)
+        return success
+
+    def _write_behind_done(self, task: asyncio.Task):
+        self._pending_writes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"REDIS CACHE write-behind failed: {task.exception()}")
+
+    async def get_async(self, key, default=None, function: str = None) -> Any:
+        value = self._get_local(key, function)
+        if value is not _sentinel:
+            return value
+
+        data, pttl = await self._read_async(key)
+        value = self._load(key, data, pttl, function)
+        if value is _incompatible:
+            await self.delete_async(key)
+        return default if value is _sentinel or value is _incompatible else value
+
+    @_degradable("_fallback_read")
+    async def _read_async(self, key) -> tuple[bytes | None, int]:
+        async with self.aredis.pipeline(transaction=False) as pipe:
+            pipe.get(self._k(key))
+            pipe.pttl(self._k(key))
+            data, pttl = await pipe.execute()
+        return data, pttl
+
+    async def get_many_async(self, keys: list, default=None, function: str = None) -> list:
+        values = [self._get_local(key, function) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is _sentinel]
+        if missing:
+            data, pttls = await self._read_many_async([keys[i] for i in missing])
+            for i, d, pttl in zip(missing, data, pttls):
+                values[i] = self._load(keys[i], d, pttl, function)
+            incompatible = [keys[i] for i in missing if values[i] is _incompatible]
+            if incompatible:
+                await self.delete_async(*incompatible)
+        return [default if value is _sentinel or value is _incompatible else value for value in values]
+
+    @_degradable("_fallback_read_many")
+    async def _read_many_async(self, keys: list) -> tuple[list[bytes | None], list[int]]:
+        async with self.aredis.pipeline(transaction=False) as pipe:
+            self._get_many_commands(pipe, keys)
+            replies = await pipe.execute()
+        return replies[:len(keys)], replies[len(keys):]
+
+    async def set_many_async(
+            self,
+            items: dict,
+            ttl: timedelta | dict = timedelta(hours=1),
+            tags: dict[Any, Iterable[str]] = None,
+            function: str = None,
+            ) -> bool:
+        if not items:
+            return True
+        encoded, rejected = self._admit_many(items, function)
+        if rejected:
+            await self.delete_async(*rejected)
+        if not encoded:
+            return False
+        for key, value in encoded.items():
+            self._set_local(key, value, _ttl_of(ttl, key))
+        return await self._write_many_async(encoded, ttl, tags, function) and not rejected
+
+    @_degradable("_fallback_write_many")
+    async def _write_many_async(
+            self, encoded: dict[Any, bytes], ttl, tags: dict | None, function: str | None
+            ) -> bool:
+        async with self.aredis.pipeline(transaction=False) as pipe:
+            self._set_many_commands(pipe, encoded, ttl, tags)
+            self._hit_commands(pipe)
+            success = all((await pipe.execute())[:len(encoded)])
+        if success:
+            logger.debug(f"REDIS CACHE SET for {list(encoded)}")
+            await self._account_async(encoded, ttl, function)
+        return success
+
+    async def _account_async(self, encoded: dict[Any, bytes], ttl, function: str | None):
+        for budget, (keys, args) in self._account_args(encoded, ttl, function).items():
+            total, evicted = await self.aredis.register_script(_ACCOUNT_SCRIPT)(keys=keys, args=args)
+            evicted = self._evicted(budget, total, evicted)
+            if evicted:
+                await self.aredis.unlink(*(self._k(k) for k in evicted))
+                await self.aredis.publish(self._channel, self._invalidation_message("keys", *evicted))
+
+    @_degradable("_fallback_memory_report")
+    async def memory_report_async(self, samples: int = 20) -> dict[str, dict]:
+        """Estimated bytes stored per function (`fn:` tags) and namespace (`ns:` tags): the
+        `MEMORY USAGE` of up to `samples` random entries of each, times their number. Falls back to
+        the size of the values when `MEMORY USAGE` isn't available. Budgets with a quota also
+        report their accounted bytes."""
+        now = time.time()
+        tag_keys = [key async for key in self.aredis.scan_iter(match=self._tag_key("fn:*"), count=500)]
+        tag_keys += [key async for key in self.aredis.scan_iter(match=self._tag_key("ns:*"), count=500)]
+
+        report = {}
+        for tag_key in tag_keys:
+            tag = self._tag_of(tag_key)
+            async with self.aredis.pipeline(transaction=False) as pipe:
+                pipe.zcount(tag_key, now, "+inf")
+                pipe.zrandmember(tag_key, samples)
+                entries, sampled = await pipe.execute()
+            # tags list the cache keys, not the redis ones
+            sampled = [self._k(key) for key in sampled]
+            sizes = [size for size in await self._memory_usage_async(sampled) if size is not None]
+            average = sum(sizes) / len(sizes) if sizes else 0
+            report[tag] = {
+                "entries": entries,
+                "sampled": len(sizes),
+                "average_bytes": round(average),
+                "estimated_bytes": round(average * entries),
+                }
+
+        for name, r in report.items():
+            budget = name.split(":", 1)[1]
+            quota = self.quota_of(budget)
+            if quota:
+                total = await self.aredis.get(self._budget_key(budget, "total"))
+                r["quota_bytes"] = quota
+                r["accounted_bytes"] = int(total or 0)
+        return dict(sorted(report.items(), key=lambda i: i[1]["estimated_bytes"], reverse=True))
+
+    async def _memory_usage_async(self, keys: list[bytes]) -> list[int | None]:
+        async with self.aredis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.memory_usage(key)
+            sizes = await pipe.execute(raise_on_error=False)
+        if not any(isinstance(size, ResponseError) for size in sizes):
+            return sizes
+        # MEMORY is often disabled on managed redis: count the values only
+        async with self.aredis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.strlen(key)
+            return [size or None for size in await pipe.execute()]
+
+    @_degradable("_fallback_exists")
+    async def exists_async(self, key) -> bool:
+        return await self.aredis.exists(self._k(key)) > 0
+
+    @_degradable("_fallback_delete")
+    async def delete_async(self, *keys) -> int:
+        self.local.delete(*keys)
+        n = await self.aredis.unlink(*(self._k(k) for k in keys))
+        await self.aredis.publish(self._channel, self._invalidation_message("keys", *keys))
+        logger.debug(f"REDIS CACHE DELETE {n} keys for {keys}")
+        return n
+
+    @_degradable("_fallback_invalidate_tags")
+    async def invalidate_tags_async(self, *tags: str) -> int:
+        async with self.aredis.pipeline(transaction=False) as pipe:
+            for tag in tags:
+                pipe.zrangebyscore(self._tag_key(tag), time.time(), "+inf")
+            keys = {k.decode() for members in await pipe.execute() for k in members}
+        n = await self.delete_async(*keys) if keys else 0
+        await self.aredis.unlink(*(self._tag_key(t) for t in tags))
+        logger.debug(f"REDIS CACHE INVALIDATE {n} keys for tags {tags}")
+        return n
+
+    async def scan_async(self, match: str, count: int = 500) -> AsyncIterator[bytes]:
+        """Iterates over the cache keys (without the prefix) matching `match`."""
+        if await self._degraded_async():
+            for key in await self._in_fallback_async(self.fallback.keys, match):
+                yield key.encode()
+            return
+        async for key in self.aredis.scan_iter(match=self._k(match), count=count):
+            yield key[len(self.prefix):]
+
+    @_degradable("_fallback_delete_namespace")
+    async def delete_namespace_async(self, namespace) -> int:
+        self.local.delete_prefix(namespace)
+        await self.aredis.publish(self._channel, self._invalidation_message("prefix", namespace))
+        n = 0
+        batch = []
+        async for key in self.scan_async(f"{namespace}*"):
+            batch.append(self._k(key))
+            if len(batch) >= 500:
+                n += await self.aredis.unlink(*batch)
+                batch = []
+        if batch:
+            n += await self.aredis.unlink(*batch)
+        logger.debug(f'REDIS CACHE DELETE {n} keys in namespace "{namespace}"')
+        return n
+
+    @_degradable("_fallback_clear")
+    async def clear_async(self):
         logger.debug("REDIS CACHE CLEAR")
-        self.redis.flushall()
+        n = await self.delete_namespace_async("")
+        self.local.clear()
+        await self.aredis.publish(self._channel, self._invalidation_message("clear"))
+        return n
+
+    @_degradable("_fallback_increment_score")
+    def increment_score(self, key, member: str, amount: float = 1, ttl: timedelta = None):
+        """Increment `member` in the sorted set `key`, e.g. to count how often something is used."""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zincrby(self._k(key), amount, member)
+        if ttl is not None:
+            pipe.expire(self._k(key), ttl)
+        pipe.execute()
+
+    @_degradable("_fallback_increment_score")
+    async def increment_score_async(self, key, member: str, amount: float = 1, ttl: timedelta = None):
+        async with self.aredis.pipeline(transaction=False) as pipe:
+            pipe.zincrby(self._k(key), amount, member)
+            if ttl is not None:
+                pipe.expire(self._k(key), ttl)
+            await pipe.execute()
+
+    @_degradable("_fallback_top")
+    async def top_async(self, key, n: int) -> list[str]:
+        """The `n` members of the sorted set `key` with the highest scores."""
+        if n <= 0:
+            return []
+        return [m.decode() for m in await self.aredis.zrevrange(self._k(key), 0, n - 1)]
+
+    async def flush_pending_writes(self):
+        """Wait for all the write-behind tasks that are still in flight."""
+        if self._pending_writes:
+            await asyncio.gather(*self._pending_writes, return_exceptions=True)
+
+    async def close(self):
+        if self._invalidation_listener is not None:
+            self._invalidation_listener.cancel()
+            self._invalidation_listener = None
+        await self.flush_pending_writes()
+        if self.aredis is not None:
+            await self.aredis.close()
+            await self.aredis.connection_pool.disconnect()
+
+    @contextlib.contextmanager
+    def lease(self, key, ttl: timedelta, function: str):
+        """Try to take a short-lived cross-replica lease on `key`, for computing `function`. Yields
+        whether it was acquired; the lease expires on its own if the holder dies. Always acquired
+        while redis is unreachable (or failing: the call goes through without a lease)."""
+        lock = None
+        if not self._degraded():
+            lock = self.redis.lock(self._k(f"lease:{key}"), timeout=ttl.total_seconds(), blocking=False)
+            try:
+                acquired = lock.acquire()
+            except _UNAVAILABLE as e:
+                self._degrade(e)
+            except RedisError as e:
+                self._failed()
+                _bypass(function, e)
+                lock = None
+        if lock is None or self.degraded:
+            yield True
+            return
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                _release(lock.release, function)
+
+    @_degradable("_fallback_wait_for")
+    def wait_for(self, key, timeout: timedelta, interval: float = 0.1) -> Any:
+        """Wait for the holder of the lease on `key` to cache a value. Returns None if the lease is
+        released (or expires) without a value being cached."""
+        deadline = time.monotonic() + timeout.total_seconds()
+        while time.monotonic() < deadline:
+            value = self.get(key)
+            if value is not None or not self.redis.exists(self._k(f"lease:{key}")):
+                return value
+            time.sleep(interval)
+        return None
+
+    @contextlib.asynccontextmanager
+    async def lease_async(self, key, ttl: timedelta, function: str):
+        lock = None
+        if not await self._degraded_async():
+            lock = self.aredis.lock(self._k(f"lease:{key}"), timeout=ttl.total_seconds(), blocking=False)
+            try:
+                acquired = await lock.acquire()
+            except _UNAVAILABLE as e:
+                self._degrade(e)
+            except RedisError as e:
+                self._failed()
+                _bypass(function, e)
+                lock = None
+        if lock is None or self.degraded:
+            yield True
+            return
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                await _release_async(lock.release, function)
+
+    @_degradable("_fallback_wait_for")
+    async def wait_for_async(self, key, timeout: timedelta, interval: float = 0.1) -> Any:
+        deadline = time.monotonic() + timeout.total_seconds()
+        while time.monotonic() < deadline:
+            value = await self.get_async(key)
+            if value is not None or not await self.aredis.exists(self._k(f"lease:{key}")):
+                return value
+            await asyncio.sleep(interval)
+        return None
 
     @property
     def initialized(self):
         return self._is_initialized
 
+    async def _in_fallback_async(self, method, *args, **kwargs):
+        """Call `method`, which uses the fallback store, from a coroutine: in a worker thread when the
+        store has a file, not to block the event loop on SQLite."""
+        if self.fallback.path is None:
+            return method(*args, **kwargs)
+        return await anyio.to_thread.run_sync(functools.partial(method, *args, **kwargs))
+
+    # The `_degradable` methods' counterparts on the fallback store. They are called from coroutines
+    # too (see `_in_fallback_async`): none of them may wait.
+
+    def _fallback_read(self, key) -> tuple[bytes | None, int]:
+        return self.fallback.get(_str_key(key))
+
+    def _fallback_read_many(self, keys: list) -> tuple[list[bytes | None], list[int]]:
+        data, pttls = [], []
+        for key in keys:
+            d, pttl = self.fallback.get(_str_key(key))
+            data.append(d)
+            pttls.append(pttl)
+        return data, pttls
+
+    def _fallback_write(self, key, value: bytes, ttl, tags: Iterable[str] = (), function: str = None) -> bool:
+        self.fallback.set(_str_key(key), value, ttl, tuple(tags))
+        return True
+
+    def _fallback_write_many(self, encoded: dict[Any, bytes], ttl, tags: dict | None, function: str | None):
+        for key, value in encoded.items():
+            self.fallback.set(_str_key(key), value, _ttl_of(ttl, key), tuple((tags or {}).get(key, ())))
+        return True
+
+    def _fallback_exists(self, key) -> bool:
+        return self.fallback.exists(_str_key(key))
+
+    def _fallback_delete(self, *keys) -> int:
+        self.local.delete(*keys)
+        return self.fallback.delete(*(_str_key(k) for k in keys))
+
+    def _fallback_invalidate_tags(self, *tags: str) -> int:
+        self.local.delete(*self.fallback.tagged(*tags))
+        return self.fallback.invalidate_tags(*tags)
+
+    def _fallback_delete_namespace(self, namespace) -> int:
+        self.local.delete_prefix(namespace)
+        return self.fallback.delete_prefix(namespace)
+
+    def _fallback_clear(self):
+        self.local.clear()
+        return self.fallback.delete_prefix("")
+
+    def _fallback_increment_score(self, key, member: str, amount: float = 1, ttl: timedelta = None):
+        self.fallback.increment_score(_str_key(key), member, amount)
+
+    def _fallback_top(self, key, n: int) -> list[str]:
+        return self.fallback.top(_str_key(key), n)
+
+    def _fallback_wait_for(self, key, timeout: timedelta, interval: float = 0.1) -> Any:
+        # leases are always acquired without redis: there's nothing to wait for
+        value = self._get_local(key, None)
+        if value is _sentinel:
+            value = self._load(key, *self._fallback_read(key), None)
+        return None if value is _sentinel or value is _incompatible else value
+
+    def _fallback_memory_report(self, samples: int = 20) -> dict[str, dict]:
+        return {"fallback": {"degraded": True, **self.fallback.stats()}}
+
+
+_sentinel = object()
+_incompatible = object()
+
+_inflight_async = AsyncSingleFlight()
+_inflight_sync = SyncSingleFlight()
+_background_tasks: set[asyncio.Task] = set()
+
+
+def split_nodes(nodes: str) -> list[str]:
+    """"host:port,host:port" as a list."""
+    return [node.strip() for node in nodes.split(",") if node.strip()]
+
+
+def _pools_usage(client) -> list[tuple[int, int, int]]:
+    """(created, in use, max) connections of each pool of a client (one per node for clusters)."""
+    if isinstance(client, RedisCluster):
+        pools = [
+            node.redis_connection.connection_pool for node in client.get_nodes() if node.redis_connection
+            ]
+    elif isinstance(client, AsyncRedisCluster):
+        # asyncio cluster nodes hold their connections themselves
+        return [
+            (len(node._connections), len(node._connections) - len(node._free), node.max_connections)
+            for node in client.get_nodes()
+            ]
+    else:
+        pools = [client.connection_pool]
+    usage = []
+    for pool in pools:
+        if hasattr(pool, "_in_use_connections"):
+            in_use = len(pool._in_use_connections)
+            created = in_use + len(pool._available_connections)
+        else:  # sync blocking pool: the queue holds the idle connections and placeholders (None)
+            created = len(pool._connections)
+            in_use = created - sum(1 for c in pool.pool.queue if c is not None)
+        usage.append((created, in_use, pool.max_connections))
+    return usage
+
+
+def _seconds(ttl: timedelta | int) -> float:
+    return ttl.total_seconds() if isinstance(ttl, timedelta) else ttl
+
+
+def _str_key(key) -> str:
+    return key.decode() if isinstance(key, bytes) else str(key)
+
+
+def _ttl_of(ttl: timedelta | dict, key) -> timedelta:
+    return ttl[key] if isinstance(ttl, dict) else ttl
+
+
+def _pttl_to_ttl(pttl: int) -> timedelta | None:
+    """Converts a PTTL reply to a ttl (None when the key has no expiry)."""
+    return timedelta(milliseconds=pttl) if pttl is not None and pttl >= 0 else None
+
+
+@dataclass
+class CacheEntry:
+    """What the cache decorators store in redis: the value plus what is needed to refresh it early.
+
+    Attributes:
+        value: the wrapped method's result
+        stale_at: wall-clock time after which the value should be refreshed (soft ttl, or the hard
+        ttl if there is none)
+        delta: seconds it took to compute the value
+        not_found: for a cached 404, the error message (the value is None)
+    """
+    value: Any
+    stale_at: float
+    delta: float
+    not_found: str | None = None
+
+    def is_stale(self) -> bool:
+        return time.time() >= self.stale_at
+
+    def should_refresh(self, beta: float) -> bool:
+        """XFetch (probabilistic early expiration): the closer to `stale_at` and the more expensive
+        the value is to compute, the more likely a reader is to trigger a refresh. Always true once
+        stale."""
+        if beta <= 0:
+            return self.is_stale()
+        return time.time() - self.delta * beta * math.log(1.0 - random.random()) >= self.stale_at
+
+
+def _count(name: str, function: str | None, **labels):
+    if function is not None:
+        metrics.inc(name, function=function, **labels)
+
+
+def cache_stats() -> dict[str, dict]:
+    """Per decorated function summary of the cache metrics."""
+    stats: dict[str, dict] = {}
+
+    def of(labels) -> dict:
+        return stats.setdefault(dict(labels)["function"], {
+            "hits": 0, "local_hits": 0, "misses": 0, "fetches": 0, "refreshes": 0,
+            })
+
+    for labels, n in metrics.samples("cache_hits_total").items():
+        of(labels)["hits"] += n
+        if dict(labels)["layer"] == "local":
+            of(labels)["local_hits"] += n
+    for name, stat in (("cache_misses_total", "misses"), ("cache_fetches_total", "fetches"),
+                       ("cache_refreshes_total", "refreshes")):
+        for labels, n in metrics.samples(name).items():
+            of(labels)[stat] += n
+    for name, stat in (("cache_compute_seconds", "compute_seconds"),
+                       ("cache_serialize_seconds", "serialize_seconds"),
+                       ("cache_deserialize_seconds", "deserialize_seconds"),
+                       ("cache_value_bytes", "value_bytes")):
+        for labels, histogram in metrics.samples(name).items():
+            of(labels)[stat] = histogram.summary()
+
+    for s in stats.values():
+        lookups = s["hits"] + s["misses"]
+        s["hit_ratio"] = s["hits"] / lookups if lookups else None
+    return stats
+
+
+def _jittered(ttl: timedelta, jitter: float) -> timedelta:
+    """Shortens `ttl` by a random fraction (up to `jitter`) so that entries written together don't
+    expire together."""
+    return ttl * (1 - jitter * random.random())
+
+
+def _make_entry(
+        value, ttl: timedelta, soft_ttl: timedelta | None, jitter: float, delta: float, hard: timedelta = None
+        ):
+    if hard is None:
+        hard = _jittered(ttl, jitter)
+    soft = min(_jittered(soft_ttl, jitter), hard) if soft_ttl is not None else hard
+    return CacheEntry(value=value, stale_at=time.time() + soft.total_seconds(), delta=delta), hard
+
+
+def _make_result_entry(
+        result,
+        ttl: timedelta,
+        soft_ttl: timedelta | None,
+        negative_ttl: timedelta | None,
+        jitter: float,
+        delta: float,
+        hard: timedelta = None,
+        ) -> tuple[CacheEntry | None, timedelta | None]:
+    """Entry for a method's result. None results get `negative_ttl` and aren't cached without it."""
+    if result is not None:
+        return _make_entry(result, ttl, soft_ttl, jitter, delta, hard=hard)
+    if negative_ttl is None:
+        return None, None
+    return _make_entry(None, negative_ttl, None, jitter, delta)
+
+
+def _is_not_found(e: Exception) -> bool:
+    return isinstance(e, BitbucketHTTPError) and e.status_code == 404
+
+
+def _not_found_entry(e: Exception, negative_ttl: timedelta, jitter: float, delta: float):
+    entry, hard = _make_entry(None, negative_ttl, None, jitter, delta)
+    entry.not_found = str(e)
+    return entry, hard
+
+
+def _not_found_error(message: str) -> BitbucketHTTPError:
+    return BitbucketHTTPError(404, message=message)
+
+
+def _unwrap(cached) -> tuple[Any, CacheEntry | None]:
+    # values cached before CacheEntry existed are returned as is
+    if isinstance(cached, CacheEntry):
+        return cached.value, cached
+    return cached, None
+
+
+def _value(cached) -> Any:
+    """The value to return for a cache hit: cached 404s are raised again."""
+    value, entry = _unwrap(cached)
+    if entry is not None and entry.not_found is not None:
+        raise _not_found_error(entry.not_found)
+    return value
+
+
+def _bypass(function: str, e: Exception | None = None):
+    """Count a call sent straight upstream, because the cache failed with `e` (or the breaker is
+    open)."""
+    if e is not None:
+        logger.warning(f"REDIS CACHE failed, calling {function} directly: {e}")
+    metrics.inc("cache_bypasses_total", function=function)
+
+
+def _release(release, function: str):
+    """Release a lease; it expires on its own if that fails."""
+    try:
+        release()
+    except LockError:
+        pass  # already expired
+    except RedisError as e:
+        _bypass(function, e)
+
+
+async def _release_async(release, function: str):
+    try:
+        await release()
+    except LockError:
+        pass
+    except RedisError as e:
+        _bypass(function, e)
+
+
+def _store(set_, *args, **kwargs) -> bool:
+    """Cache a computed value; failing to do so doesn't fail the call."""
+    try:
+        return set_(*args, **kwargs)
+    except Exception as e:
+        logger.warning(f"REDIS CACHE SET failed: {e}")
+        return False
+
+
+async def _store_async(set_, *args, **kwargs) -> bool:
+    try:
+        return await set_(*args, **kwargs)
+    except Exception as e:
+        logger.warning(f"REDIS CACHE SET failed: {e}")
+        return False
+
+
+def _run_in_background(coro, description: str):
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_tasks.add(task)
+
+    def done(t: asyncio.Task):
+        _background_tasks.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            logger.warning(f"REDIS CACHE: {description} failed: {t.exception()}")
+
+    task.add_done_callback(done)
+
+
+def repo_tag(slug: str) -> str:
+    return f"repo:{slug}"
+
+
+def fn_tag(name: str) -> str:
+    return f"fn:{name}"
+
+
+def user_tag(user: str) -> str:
+    return f"user:{user}"
+
+
+def _make_tags(method, tags: list[str], namespace: str, *args, **kwargs) -> list[str]:
+    """`tags` are format strings filled with the method's arguments, e.g. "repo:{repo_slug}".
+    Every entry is also tagged with the method's name (and namespace, if any)."""
+    arguments = {}
+    if tags:
+        try:
+            bound = inspect.signature(method).bind(None, *args, **kwargs)
+        except TypeError:
+            tags = None
+        else:
+            bound.apply_defaults()
+            arguments = bound.arguments
+    return _format_tags(method, tags, namespace, arguments)
+
+
+def _format_tags(method, tags: list[str] | None, namespace: str, arguments: dict) -> list[str]:
+    _tags = [fn_tag(method.__name__)]
+    if namespace:
+        _tags.append(f"ns:{namespace}")
+    for tag in tags or ():
+        try:
+            _tags.append(tag.format(**arguments))
+        except (AttributeError, KeyError, IndexError) as e:
+            logger.warning(f'REDIS CACHE: unable to make tag "{tag}" for {method.__name__}: {e}')
+    return _tags
+
+
+def _make_key(method, key: str | CacheKeyFn | None, namespace: str, tags: list[str], *args, **kwargs) -> str:
+    """Default keys are hash-tagged with the entry's first repository tag, so that the entries of a
+    repository (and the tag listing them) share a cluster slot. `CacheKeyFn`s have their own."""
+    _key = None
+    if key is None:
+        hash_tag = next((tag for tag in tags if tag.startswith("repo:")), None)
+        _key = CacheKeyFn.make_default_key(method.__name__, *args, hash_tag=hash_tag, **kwargs)
+    elif isinstance(key, str):
+        _key = key
+    elif isinstance(key, CacheKeyFn):
+        _key = key.infer_from_orig(method, *args, **kwargs)
+    if _key is None:
+        raise ValueError('Invalid key')
+
+    if namespace:
+        _key = CacheKeyFn.prepend_namespace(namespace, _key)
+
+    return _key
+
 
 def cache_async(
         ttl: timedelta,
         key: str | CacheKeyFn | None = None,
         namespace: str = "",
+        write_behind: bool = False,
+        lease: timedelta = timedelta(seconds=30),
+        soft_ttl: timedelta | None = None,
+        jitter: float = 0.1,
+        beta: float = 1.0,
+        tags: list[str] | None = None,
+        negative_ttl: timedelta | None = None,
         ):
     """Wrapper for caching **method**  results in redis.
 
+    Concurrent misses for the same key are coalesced: within the process they wait for a single
+    call, and across replicas only the holder of a short redis lease calls the method while the
+    others wait for it to cache the result.
+
+    Once a value is stale (older than `soft_ttl`), it is still returned but refreshed in the
+    background. A refresh may also start a little before that (see `CacheEntry.should_refresh`).
+
     Args:
-        ttl: time to live for the cached value
+        ttl: time to live for the cached value (hard ttl: the value is gone after that)
         key: key to use for the cache. Can be an static string, a function or None. In the case of
         a function, it is expected to have some, or all of the same arguments as the wrapped method.
         namespace: prefix to use for the cache key. Useful for differentiating between different
         instances of the same class, for example.
+        write_behind: return the result without waiting for it to be written to the cache.
+        lease: how long other replicas wait for the lease holder before calling the method
+        themselves.
+        soft_ttl: age after which the value is served stale while being refreshed.
+        jitter: both ttls are shortened by a random fraction up to this value.
+        beta: XFetch parameter; greater than 1 favors earlier refreshes, 0 disables them.
+        tags: format strings for the tags of the cached value, filled with the method's arguments
+        (e.g. "repo:{repo_slug}"). See `RedisCache.invalidate_tags`.
+        negative_ttl: if set, None results and 404 errors (BitbucketHTTPError) are cached for that
+        long, otherwise they aren't cached at all.
+
+    The decorated method has a `cache_key` attribute, returning the key of the value cached for
+    some arguments (e.g. to delete it).
     """
 
     def _decorator(method):
@@ -134,36 +1620,84 @@ def cache_async(
             if not _cache.initialized:
                 _cache.init()
 
-            # key
-            _key = None
-            if key is None:
-                _key = CacheKeyFn.make_default_key(method.__name__, *args, **kwargs)
-            elif isinstance(key, str):
-                _key = key
-            elif isinstance(key, CacheKeyFn):
-                _key = key.infer_from_orig(method, *args, **kwargs)
-            if _key is None:
-                raise ValueError('Invalid key')
+            _tags = _make_tags(method, tags, namespace, *args, **kwargs)
+            _key = _make_key(method, key, namespace, _tags, *args, **kwargs)
+            _function = method.__qualname__
 
-            if namespace:
-                _key = CacheKeyFn.prepend_namespace(namespace, _key)
+            async def compute_and_store():
+                start = time.monotonic()
+                try:
+                    result = await method(_self(), *args, **kwargs)
+                except Exception as e:
+                    if negative_ttl is not None and _is_not_found(e):
+                        entry, hard_ttl = _not_found_entry(e, negative_ttl, jitter, time.monotonic() - start)
+                        await _store_async(
+                            _cache.set_async, _key, entry, ttl=hard_ttl, tags=_tags, function=_function
+                            )
+                    raise
+                delta = time.monotonic() - start
+                metrics.observe("cache_compute_seconds", delta, function=_function)
+                entry, hard_ttl = _make_result_entry(result, ttl, soft_ttl, negative_ttl, jitter, delta)
+                if entry is not None:
+                    await _store_async(
+                        _cache.set_async,
+                        _key,
+                        entry,
+                        ttl=hard_ttl,
+                        write_behind=write_behind,
+                        tags=_tags,
+                        function=_function,
+                        )
+                return result
+
+            async def compute():
+                async with _cache.lease_async(_key, lease, _function) as acquired:
+                    if not acquired:
+                        logger.debug(f'REDIS CACHE: waiting for another replica to compute "{_key}"')
+                        cached = await _cache.wait_for_async(_key, lease)
+                        if cached is not None:
+                            return _value(cached)
+                    return await compute_and_store()
 
-            if fetch:
-                logger.debug('REDIS CACHE: fetch flag set, deleting cached value')
-                _cache.delete(_key)
+            async def refresh():
+                async with _cache.lease_async(_key, lease, _function) as acquired:
+                    if acquired:  # otherwise another replica is already refreshing it
+                        logger.debug(f'REDIS CACHE: refreshing "{_key}" in the background')
+                        metrics.inc("cache_refreshes_total", function=_function)
+                        await compute_and_store()
 
-            cached = _cache.get(_key)
+            if _cache.bypassed():
+                _bypass(_function)
+                return await method(_self(), *args, **kwargs)
+
+            try:
+                if fetch:
+                    logger.debug('REDIS CACHE: fetch flag set, deleting cached value')
+                    metrics.inc("cache_fetches_total", function=_function)
+                    await _cache.delete_async(_key)
+
+                cached = await _cache.get_async(_key, function=None if fetch else _function)
+            except Exception as e:
+                _bypass(_function, e)
+                return await method(_self(), *args, **kwargs)
             if cached is not None:
-                return cached
+                _, entry = _unwrap(cached)
+                if entry is not None and entry.should_refresh(beta):
+                    _run_in_background(_inflight_async.do(_key, refresh), f'refresh of "{_key}"')
+                return _value(cached)
 
-            result = await method(_self(), *args, **kwargs)
-            _cache.set(_key, result, ttl=ttl)
-            return result
+            return await _inflight_async.do(_key, compute)
 
         @functools.wraps(method)
         async def inner(self, *args, fetch=False, **kwargs):
             return await _async_wrapper(weakref.ref(self), *args, fetch=fetch, **kwargs)
 
+        def cache_key(*args, **kwargs) -> str:
+            """The key of the value cached for these arguments (self excluded)."""
+            _tags = _make_tags(method, tags, namespace, *args, **kwargs)
+            return _make_key(method, key, namespace, _tags, *args, **kwargs)
+
+        inner.cache_key = cache_key
         return inner
 
     return _decorator
@@ -173,15 +1707,31 @@ def cache_sync(
         ttl: timedelta,
         key: str | CacheKeyFn | None = None,
         namespace: str = "",
+        lease: timedelta = timedelta(seconds=30),
+        soft_ttl: timedelta | None = None,
+        jitter: float = 0.1,
+        beta: float = 1.0,
+        tags: list[str] | None = None,
+        negative_ttl: timedelta | None = None,
         ):
-    """Wrapper for caching **method**  results in redis.
+    """Wrapper for caching **method**  results in redis. Concurrent misses are coalesced and stale
+    values are refreshed (in a background thread) like in `cache_async`.
 
     Args:
-        ttl: time to live for the cached value
+        ttl: time to live for the cached value (hard ttl: the value is gone after that)
         key: key to use for the cache. Can be an static string, a function or None. In the case of
         a function, it is expected to have some, or all of the same arguments as the wrapped method.
         namespace: prefix to use for the cache key. Useful for differentiating between different
         instances of the same class, for example.
+        lease: how long other replicas wait for the lease holder before calling the method
+        themselves.
+        soft_ttl: age after which the value is served stale while being refreshed.
+        jitter: both ttls are shortened by a random fraction up to this value.
+        beta: XFetch parameter; greater than 1 favors earlier refreshes, 0 disables them.
+        tags: format strings for the tags of the cached value, filled with the method's arguments
+        (e.g. "repo:{repo_slug}"). See `RedisCache.invalidate_tags`.
+        negative_ttl: if set, None results and 404 errors (BitbucketHTTPError) are cached for that
+        long, otherwise they aren't cached at all.
     """
 
     def _decorator(method):
@@ -190,31 +1740,284 @@ def cache_sync(
             if not _cache.initialized:
                 _cache.init()
 
-            # key
-            _key = None
-            if key is None:
-                _key = CacheKeyFn.make_default_key(method.__name__, *args, **kwargs)
-            elif isinstance(key, str):
-                _key = key
-            elif isinstance(key, CacheKeyFn):
-                _key = key.infer_from_orig(method, *args, **kwargs)
-            if _key is None:
-                raise ValueError('Invalid key')
+            _tags = _make_tags(method, tags, namespace, *args, **kwargs)
+            _key = _make_key(method, key, namespace, _tags, *args, **kwargs)
+            _function = method.__qualname__
+
+            def compute_and_store():
+                start = time.monotonic()
+                try:
+                    result = method(_self(), *args, **kwargs)
+                except Exception as e:
+                    if negative_ttl is not None and _is_not_found(e):
+                        entry, hard_ttl = _not_found_entry(e, negative_ttl, jitter, time.monotonic() - start)
+                        _store(_cache.set, _key, entry, ttl=hard_ttl, tags=_tags, function=_function)
+                    raise
+                delta = time.monotonic() - start
+                metrics.observe("cache_compute_seconds", delta, function=_function)
+                entry, hard_ttl = _make_result_entry(result, ttl, soft_ttl, negative_ttl, jitter, delta)
+                if entry is not None:
+                    _store(_cache.set, _key, entry, ttl=hard_ttl, tags=_tags, function=_function)
+                return result
 
+            def compute():
+                with _cache.lease(_key, lease, _function) as acquired:
+                    if not acquired:
+                        logger.debug(f'REDIS CACHE: waiting for another replica to compute "{_key}"')
+                        cached = _cache.wait_for(_key, lease)
+                        if cached is not None:
+                            return _value(cached)
+                    return compute_and_store()
+
+            def refresh():
+                try:
+                    with _cache.lease(_key, lease, _function) as acquired:
+                        if acquired:
+                            logger.debug(f'REDIS CACHE: refreshing "{_key}" in the background')
+                            metrics.inc("cache_refreshes_total", function=_function)
+                            compute_and_store()
+                except Exception as e:
+                    logger.warning(f'REDIS CACHE: refresh of "{_key}" failed: {e}')
+
+            if _cache.bypassed():
+                _bypass(_function)
+                return method(_self(), *args, **kwargs)
+
+            try:
+                if fetch:
+                    logger.debug('REDIS CACHE: fetch flag set, deleting cached value')
+                    metrics.inc("cache_fetches_total", function=_function)
+                    _cache.delete(_key)
+
+                cached = _cache.get(_key, function=None if fetch else _function)
+            except Exception as e:
+                _bypass(_function, e)
+                return method(_self(), *args, **kwargs)
+            if cached is not None:
+                _, entry = _unwrap(cached)
+                if entry is not None and entry.should_refresh(beta):
+                    threading.Thread(target=_inflight_sync.do, args=(_key, refresh), daemon=True).start()
+                return _value(cached)
+
+            return _inflight_sync.do(_key, compute)
+
+        @functools.wraps(method)
+        def inner(self, *args, fetch=False, **kwargs):
+            return _wrapper(weakref.ref(self), *args, fetch=fetch, **kwargs)
+
+        return inner
+
+    return _decorator
+
+
+class _Batch:
+    """The call to a batch method, split by item. Each item gets the cache key (and tags) of the
+    single-item call, i.e. `key` called with `item_arg` set to the item."""
+
+    def __init__(
+            self, method, key: CacheKeyFn, namespace: str, tags: list[str] | None,
+            batch_arg: str, item_arg: str, args: tuple, kwargs: dict,
+            ):
+        self.bound = inspect.signature(method).bind(None, *args, **kwargs)
+        self.bound.apply_defaults()
+        self.batch_arg = batch_arg
+        self.items = list(dict.fromkeys(self.bound.arguments[batch_arg]))
+        self.keys = {}
+        self.tags = {}
+        for item in self.items:
+            arguments = {**self.bound.arguments, item_arg: item}
+            _key = key(*(arguments[n] for n in key.arg_names), **{n: arguments[n] for n in key.kwarg_names})
             if namespace:
                 _key = CacheKeyFn.prepend_namespace(namespace, _key)
+            self.keys[item] = _key
+            self.tags[_key] = _format_tags(method, tags, namespace, arguments)
 
-            if fetch:
-                logger.debug('REDIS CACHE: fetch flag set, deleting cached value')
-                _cache.delete(_key)
+    def call_args(self, items: list) -> tuple[tuple, dict]:
+        """Arguments (without self) for calling the method with only `items`."""
+        # self.bound is shared by the concurrent calls (e.g. a refresh in a thread)
+        bound = inspect.BoundArguments(self.bound.signature, {**self.bound.arguments, self.batch_arg: items})
+        return bound.args[1:], bound.kwargs
 
-            cached = _cache.get(_key)
-            if cached is not None:
-                return cached
+    def entries(
+            self, results: dict, ttl, soft_ttl, negative_ttl, jitter: float, delta: float
+            ) -> tuple[dict, dict]:
+        """Entries to cache, and their ttls, by key."""
+        hard = _jittered(ttl, jitter)
+        entries, ttls = {}, {}
+        for item, value in results.items():
+            if item not in self.keys:
+                continue
+            entry, entry_ttl = _make_result_entry(
+                value, ttl, soft_ttl, negative_ttl, jitter, delta, hard=hard
+                )
+            if entry is not None:
+                entries[self.keys[item]] = entry
+                ttls[self.keys[item]] = entry_ttl
+        return entries, ttls
+
+    def split(self, cached: list, beta: float) -> tuple[dict, list, list]:
+        """Returns the cached results, the missing items and the items to refresh."""
+        results, missing, stale = {}, [], []
+        for item, c in zip(self.items, cached):
+            if c is None:
+                missing.append(item)
+                continue
+            value, entry = _unwrap(c)
+            results[item] = value
+            if entry is not None and entry.should_refresh(beta):
+                stale.append(item)
+        return results, missing, stale
+
+
+def cache_async_many(
+        ttl: timedelta,
+        key: CacheKeyFn,
+        batch_arg: str,
+        item_arg: str,
+        namespace: str = "",
+        soft_ttl: timedelta | None = None,
+        jitter: float = 0.1,
+        beta: float = 1.0,
+        tags: list[str] | None = None,
+        negative_ttl: timedelta | None = None,
+        ):
+    """Batch variant of `cache_async`, for methods taking a list of items (`batch_arg`) and
+    returning a dict of results by item.
+
+    Each item is cached under the key the single-item method uses (`key` called with `item_arg` set
+    to the item) so both share their entries. The cached items are read in one round-trip and the
+    method is called once, with the missing items only. Items left out of the returned dict are not
+    cached. Unlike `cache_async`, there is no cross-replica lease.
+
+    Args:
+        batch_arg: name of the method's argument holding the items
+        item_arg: name of the argument holding the item in `key` and `tags`
+        (see `cache_async` for the others)
+    """
+
+    def _decorator(method):
+        async def _async_wrapper(_self, *args, fetch: bool, **kwargs):
+            _cache = RedisCache()
+            if not _cache.initialized:
+                _cache.init()
+
+            batch = _Batch(method, key, namespace, tags, batch_arg, item_arg, args, kwargs)
+            _function = method.__qualname__
+
+            async def compute_and_store(items: list) -> dict:
+                call_args, call_kwargs = batch.call_args(items)
+                start = time.monotonic()
+                results = await method(_self(), *call_args, **call_kwargs)
+                delta = time.monotonic() - start
+                metrics.observe("cache_compute_seconds", delta, function=_function)
+                entries, ttls = batch.entries(results, ttl, soft_ttl, negative_ttl, jitter, delta)
+                await _store_async(
+                    _cache.set_many_async, entries, ttl=ttls, tags=batch.tags, function=_function
+                    )
+                return results
+
+            async def refresh(items: list):
+                metrics.inc("cache_refreshes_total", function=_function)
+                await compute_and_store(items)
+
+            if _cache.bypassed():
+                _bypass(_function)
+                return await method(_self(), *args, **kwargs)
+
+            keys = [batch.keys[item] for item in batch.items]
+            try:
+                if fetch and keys:
+                    metrics.inc("cache_fetches_total", function=_function)
+                    await _cache.delete_async(*keys)
+
+                cached = await _cache.get_many_async(keys, function=None if fetch else _function)
+            except Exception as e:
+                _bypass(_function, e)
+                return await method(_self(), *args, **kwargs)
+            results, missing, stale = batch.split(cached, beta)
+            if stale:
+                flight = ("refresh",) + tuple(batch.keys[item] for item in stale)
+                _run_in_background(
+                    _inflight_async.do(flight, lambda: refresh(stale)), f"refresh of {len(stale)} items"
+                    )
+            if missing:
+                flight = tuple(batch.keys[item] for item in missing)
+                results.update(await _inflight_async.do(flight, lambda: compute_and_store(missing)))
+            return {item: results[item] for item in batch.items if item in results}
+
+        @functools.wraps(method)
+        async def inner(self, *args, fetch=False, **kwargs):
+            return await _async_wrapper(weakref.ref(self), *args, fetch=fetch, **kwargs)
+
+        return inner
+
+    return _decorator
+
+
+def cache_sync_many(
+        ttl: timedelta,
+        key: CacheKeyFn,
+        batch_arg: str,
+        item_arg: str,
+        namespace: str = "",
+        soft_ttl: timedelta | None = None,
+        jitter: float = 0.1,
+        beta: float = 1.0,
+        tags: list[str] | None = None,
+        negative_ttl: timedelta | None = None,
+        ):
+    """Batch variant of `cache_sync`. See `cache_async_many`."""
+
+    def _decorator(method):
+        def _wrapper(_self, *args, fetch: bool, **kwargs):
+            _cache = RedisCache()
+            if not _cache.initialized:
+                _cache.init()
+
+            batch = _Batch(method, key, namespace, tags, batch_arg, item_arg, args, kwargs)
+            _function = method.__qualname__
+
+            def compute_and_store(items: list) -> dict:
+                call_args, call_kwargs = batch.call_args(items)
+                start = time.monotonic()
+                results = method(_self(), *call_args, **call_kwargs)
+                delta = time.monotonic() - start
+                metrics.observe("cache_compute_seconds", delta, function=_function)
+                entries, ttls = batch.entries(results, ttl, soft_ttl, negative_ttl, jitter, delta)
+                _store(_cache.set_many, entries, ttl=ttls, tags=batch.tags, function=_function)
+                return results
+
+            def refresh(items: list):
+                try:
+                    metrics.inc("cache_refreshes_total", function=_function)
+                    compute_and_store(items)
+                except Exception as e:
+                    logger.warning(f"REDIS CACHE: refresh of {len(items)} items failed: {e}")
+
+            if _cache.bypassed():
+                _bypass(_function)
+                return method(_self(), *args, **kwargs)
+
+            keys = [batch.keys[item] for item in batch.items]
+            try:
+                if fetch and keys:
+                    metrics.inc("cache_fetches_total", function=_function)
+                    _cache.delete(*keys)
 
-            result = method(_self(), *args, **kwargs)
-            _cache.set(_key, result, ttl=ttl)
-            return result
+                cached = _cache.get_many(keys, function=None if fetch else _function)
+            except Exception as e:
+                _bypass(_function, e)
+                return method(_self(), *args, **kwargs)
+            results, missing, stale = batch.split(cached, beta)
+            if stale:
+                flight = ("refresh",) + tuple(batch.keys[item] for item in stale)
+                threading.Thread(
+                    target=_inflight_sync.do, args=(flight, lambda: refresh(stale)), daemon=True
+                    ).start()
+            if missing:
+                flight = tuple(batch.keys[item] for item in missing)
+                results.update(_inflight_sync.do(flight, lambda: compute_and_store(missing)))
+            return {item: results[item] for item in batch.items if item in results}
 
         @functools.wraps(method)
         def inner(self, *args, fetch=False, **kwargs):
@@ -0,0 +1,83 @@
+"""
+Request coalescing
+
+Concurrent calls sharing a key wait for a single in-flight computation instead of each running it.
+Used by the cache decorators so that an expired hot key only goes upstream once per process.
+"""
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable
+
+from loguru import logger
+
+
+class AsyncSingleFlight:
+    def __init__(self):
+        self._calls: dict[Any, asyncio.Task] = {}
+
+    async def do(self, key, fn: Callable[[], Awaitable]):
+        """Run `fn` unless a call for `key` is already in flight, in which case wait for its result.
+
+        The computation runs in its own task so that a cancelled caller doesn't cancel it for
+        the others."""
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            logger.debug(f'SINGLE FLIGHT: waiting for in-flight call "{key}"')
+        return await asyncio.shield(task)
+
+    def _done(self, key, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # mark as retrieved; every waiter gets it re-raised anyway
+
+    def __len__(self):
+        return len(self._calls)
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+
+
+class SyncSingleFlight:
+    def __init__(self):
+        self._calls: dict[Any, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn: Callable[[], Any]):
+        """Run `fn` unless a call for `key` is already in flight in another thread, in which case
+        block until its result is available."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            logger.debug(f'SINGLE FLIGHT: waiting for in-flight call "{key}"')
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def __len__(self):
+        return len(self._calls)
@@ -23,6 +23,9 @@ from pydantic import BaseModel
 
 
 class WatcherType(BaseModel):
+    # 2: keys are stable digests (utils.digest) instead of hash(); see codec.schema_digest
+    __schema_version__ = 2
+
     key: int
     data: Any | None = None
     parent: "Optional[WatcherType]" = None
@@ -38,6 +38,8 @@ class Event(BaseModel):  # AKA dataResponse
     key: int
     type: EventType = Field(alias="_type")
     value: Any
+    # position in the watcher's history, to resume a watch from (see realtime.snapshot)
+    seq: int | None = None
 
     class Config:
         json_encoders = {EventType: lambda t: str(t)}
@@ -0,0 +1,52 @@
+"""
+Stable digests
+
+Python's `hash()` is salted per process, so it can't identify anything shared between replicas or
+kept across restarts (cache keys, watcher ids, the keys of the values sent to the clients). These
+helpers hash a canonical JSON encoding of the value with blake2b instead: same value, same digest,
+everywhere.
+"""
+import dataclasses
+import hashlib
+import json
+from enum import Enum
+from typing import Any
+
+from pydantic import BaseModel
+
+# the keys sent to the frontend must stay exact as javascript numbers
+MAX_SAFE_BITS = 53
+
+
+def canonical(value: Any) -> bytes:
+    """Encoding of `value` that only depends on its content (dicts and sets are sorted)."""
+    return json.dumps(
+        value, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=_to_json
+        ).encode()
+
+
+def stable_digest(value: Any, digest_size: int = 8) -> str:
+    """Hex digest of `value`, for string identities (cache keys, redis keys)."""
+    return hashlib.blake2b(canonical(value), digest_size=digest_size).hexdigest()
+
+
+def stable_hash(value: Any) -> int:
+    """Drop-in replacement for `hash()` where the result leaves the process: a non-negative int
+    that fits in a javascript number."""
+    digest = hashlib.blake2b(canonical(value), digest_size=8).digest()
+    return int.from_bytes(digest, "big") >> (64 - MAX_SAFE_BITS)
+
+
+def _to_json(o):
+    if isinstance(o, BaseModel):
+        return o.dict()
+    if dataclasses.is_dataclass(o) and not isinstance(o, type):
+        return dataclasses.asdict(o)
+    if isinstance(o, Enum):
+        return o.value
+    if isinstance(o, (set, frozenset)):
+        return sorted(o, key=canonical)
+    if isinstance(o, bytes):
+        return o.hex()
+    # str(o) could contain a memory address and silently differ between processes
+    raise TypeError(f"{type(o).__name__} has no stable encoding")
@@ -0,0 +1,151 @@
+"""
+Cache warm-up
+
+Precomputes the values users ask for first (repositories, CD configs, versions available...) so
+that the first requests after a deploy or a cache clear don't pay the full Bitbucket cost.
+
+The jobs go through the cached methods: entries that are still fresh only cost a cache read,
+missing ones are computed and stale ones are refreshed.
+"""
+import asyncio
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
+
+from anyio import CapacityLimiter, create_task_group
+from loguru import logger
+from pydantic import BaseModel
+
+from .redis import RedisCache
+
+USAGE_KEY = "usage:repositories"
+USAGE_TTL = timedelta(days=30)
+
+Job = tuple[str, Callable[[], Awaitable]]
+
+
+class WarmUpStatus(BaseModel):
+    running: bool = False
+    runs: int = 0
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    next_run_at: datetime | None = None
+    total: int = 0
+    done: int = 0
+    failed: int = 0
+    errors: list[str] = []
+
+
+class WarmUp:
+    max_errors = 20
+
+    def __init__(
+            self,
+            jobs: Callable[[], Awaitable[list[Job]]],
+            concurrency: int = 4,
+            interval: timedelta | None = timedelta(hours=6),
+            ):
+        """
+        Args:
+            jobs: returns the jobs of a run, as (description, coroutine function) pairs
+            concurrency: how many jobs run at the same time
+            interval: time between the end of a run and the start of the next one (None: only run
+            when asked to)
+        """
+        self.jobs = jobs
+        self.concurrency = concurrency
+        self.interval = interval
+        self.status = WarmUpStatus()
+        self._task: asyncio.Task | None = None
+        self._run: asyncio.Task | None = None
+
+    async def start(self):
+        """Run now, then on schedule, in the background."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._schedule())
+
+    async def stop(self):
+        for task in (self._task, self._run):
+            if task is not None:
+                task.cancel()
+        self._task = None
+
+    def trigger(self) -> bool:
+        """Start a run in the background, unless one is already running."""
+        if self.status.running:
+            return False
+        self._begin()
+        self._run = asyncio.get_running_loop().create_task(self._execute())
+        return True
+
+    async def _schedule(self):
+        while True:
+            try:
+                await self.run()
+            except Exception as e:
+                logger.error(f"CACHE WARM-UP failed: {e}")
+            if self.interval is None:
+                return
+            self.status.next_run_at = datetime.now() + self.interval
+            await asyncio.sleep(self.interval.total_seconds())
+
+    async def run(self):
+        if self.status.running:
+            return
+        self._begin()
+        await self._execute()
+
+    def _begin(self):
+        self.status = WarmUpStatus(
+            running=True,
+            runs=self.status.runs + 1,
+            started_at=datetime.now(),
+            next_run_at=self.status.next_run_at,
+            )
+
+    async def _execute(self):
+        try:
+            jobs = await self.jobs()
+            self.status.total = len(jobs)
+            logger.info(f"CACHE WARM-UP: {len(jobs)} jobs")
+
+            limiter = CapacityLimiter(self.concurrency)
+            async with create_task_group() as tg:
+                for description, job in jobs:
+                    tg.start_soon(self._run_job, limiter, description, job)
+        finally:
+            self.status.running = False
+            self.status.finished_at = datetime.now()
+        logger.info(
+            f"CACHE WARM-UP done in {self.status.finished_at - self.status.started_at}: "
+            f"{self.status.done} ok, {self.status.failed} failed"
+            )
+
+    async def _run_job(self, limiter: CapacityLimiter, description: str, job: Callable[[], Awaitable]):
+        async with limiter:
+            try:
+                await job()
+                self.status.done += 1
+            except Exception as e:
+                self.status.failed += 1
+                logger.warning(f"CACHE WARM-UP: {description} failed: {e}")
+                if len(self.status.errors) < self.max_errors:
+                    self.status.errors.append(f"{description}: {e}")
+
+
+def record_repository_usage(repo_slug: str):
+    """Count a request for `repo_slug`; the most used repositories are kept warm."""
+    try:
+        RedisCache().increment_score(USAGE_KEY, repo_slug, ttl=USAGE_TTL)
+    except Exception as e:
+        logger.warning(f"Unable to record usage of {repo_slug}: {e}")
+
+
+async def record_repository_usage_async(repo_slug: str):
+    try:
+        await RedisCache().increment_score_async(USAGE_KEY, repo_slug, ttl=USAGE_TTL)
+    except Exception as e:
+        logger.warning(f"Unable to record usage of {repo_slug}: {e}")
+
+
+async def most_used_repositories(n: int) -> list[str]:
+    return await RedisCache().top_async(USAGE_KEY, n)
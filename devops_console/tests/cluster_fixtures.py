@@ -0,0 +1,218 @@
+"""
+A local redis cluster stand-in, without docker
+
+Each node is a fakeredis TCP server owning a range of the 16384 slots. Nodes answer CLUSTER SLOTS
+(so the redis-py cluster clients route as they would on a real cluster), redirect commands for
+slots they don't own (MOVED) and reject multi-key commands spanning several slots (CROSSSLOT).
+PUBLISH reaches the subscribers of every node, like on a cluster.
+
+Not checked: Lua scripts accessing keys they were not given.
+"""
+from __future__ import annotations
+
+import threading
+
+import fakeredis
+from fakeredis import TcpFakeServer
+from fakeredis._clients._tcp_server import TCPFakeRequestHandler
+from fakeredis._helpers import SimpleError
+from redis.crc import REDIS_CLUSTER_HASH_SLOTS, key_slot
+
+HOST = "127.0.0.1"
+
+# commands whose key positions fakeredis doesn't report like redis does: (first, last, step)
+_KEY_POSITIONS = {
+    b"del": (1, -1, 1),
+    b"unlink": (1, -1, 1),
+    b"exists": (1, -1, 1),
+    b"touch": (1, -1, 1),
+    b"mget": (1, -1, 1),
+    b"mset": (1, -1, 2),
+    }
+# single-key commands (the key is the first argument) used by the cache
+_KEYED = {
+    b"get", b"set", b"pttl", b"ttl", b"expire", b"pexpire", b"strlen", b"incrby", b"decrby", b"type",
+    b"zadd", b"zrem", b"zrange", b"zrangebyscore", b"zrevrange", b"zremrangebyscore", b"zcount",
+    b"zrandmember", b"zincrby", b"zscore", b"zcard", b"hget", b"hset", b"hdel", b"hgetall",
+    b"xadd", b"xrange", b"xrevrange", b"xtrim", b"xlen",
+    }
+_SCRIPTS = (b"eval", b"evalsha", b"eval_ro", b"evalsha_ro", b"fcall", b"fcall_ro")
+
+
+def _command_table() -> list:
+    """COMMAND reply of the nodes: fakeredis' own, with the key positions fixed."""
+    table = []
+    for name, info in fakeredis.FakeRedis().command().items():
+        if "|" in name:
+            continue
+        first, last, step = _KEY_POSITIONS.get(
+            name.encode(), (info["first_key_pos"], info["last_key_pos"], info["step_count"])
+            )
+        flags = [f.encode() for f in info["flags"]]
+        subcommands = info["subcommands"]
+        table.append([name.encode(), info["arity"], flags, first, last, step, [], [], [], subcommands])
+    memory_usage = [b"memory|usage", -3, [b"readonly"], 2, 2, 1, [], [], [], []]
+    table.append([b"memory", -2, [], 0, 0, 0, [], [], [], [memory_usage]])
+    return table
+
+
+def _keys(args: list[bytes]) -> list[bytes]:
+    name = args[0].lower()
+    if name in _SCRIPTS:
+        return args[3:3 + int(args[2])]
+    if name in (b"xread", b"xreadgroup"):
+        rest = args[[a.upper() for a in args].index(b"STREAMS") + 1:]
+        return rest[:len(rest) // 2]
+    if name == b"memory" and len(args) > 2 and args[1].lower() == b"usage":
+        return [args[2]]
+    first, last, step = _KEY_POSITIONS.get(name, (1, 1, 1))
+    if name not in _KEY_POSITIONS and name not in _KEYED:
+        return []
+    last = len(args) + last if last < 0 else last
+    return args[first:last + 1:step]
+
+
+
+def _parse(buffer: bytes) -> tuple[list[bytes] | None, bytes]:
+    """One command (array of bulk strings) off the front of `buffer`, if complete."""
+    if not buffer.startswith(b"*"):
+        line, sep, rest = buffer.partition(b"\r\n")
+        return (line.split(), rest) if sep else (None, buffer)
+    end = buffer.find(b"\r\n")
+    if end < 0:
+        return None, buffer
+    n, pos, args = int(buffer[1:end]), end + 2, []
+    for _ in range(n):
+        end = buffer.find(b"\r\n", pos)
+        if end < 0:
+            return None, buffer
+        size = int(buffer[pos + 1:end])
+        start = end + 2
+        if len(buffer) < start + size + 2:
+            return None, buffer
+        args.append(buffer[start:start + size])
+        pos = start + size + 2
+    return args, buffer[pos:]
+
+
+def _encode(args: list[bytes]) -> bytes:
+    return b"*%d\r\n" % len(args) + b"".join(b"$%d\r\n%s\r\n" % (len(a), a) for a in args)
+
+
+class _NodeHandler(TCPFakeRequestHandler):
+    def handle(self):
+        buffer = b""
+        self.connection.settimeout(0.01)
+        while not self.server._shutdown_event.is_set():
+            self._flush()
+            try:
+                data = self.connection.recv(65536)
+            except TimeoutError:
+                continue
+            except OSError:
+                break
+            if not data:
+                break
+            buffer += data
+            while True:
+                args, buffer = _parse(buffer)
+                if args is None:
+                    break
+                if args:
+                    self._execute(args)
+
+    def _execute(self, args: list[bytes]):
+        node: _Node = self.server
+        reply = node.cluster.intercept(node, args)
+        if reply is None:
+            self.current_client.get_socket().sendall(_encode(args))
+            return
+        # replies go out in order: first the ones of the commands already sent to fakeredis
+        self._flush()
+        self.writer.dump(reply)
+
+    def _flush(self):
+        while self.current_client.can_read():
+            try:
+                reply = self.current_client.read_response()
+            except Exception as e:  # error replies are raised
+                reply = e
+            self.writer.dump(reply)
+
+
+class _Node(TcpFakeServer):
+    def __init__(self, cluster: LocalRedisCluster, slots: range):
+        super().__init__((HOST, 0))
+        self.RequestHandlerClass = _NodeHandler
+        self.cluster = cluster
+        self.slots = slots
+        self.port = self.server_address[1]
+        self.node_id = f"{self.port:040x}".encode()
+
+
+class LocalRedisCluster:
+    def __init__(self, nodes: int = 3):
+        size = REDIS_CLUSTER_HASH_SLOTS // nodes
+        bounds = [i * size for i in range(nodes)] + [REDIS_CLUSTER_HASH_SLOTS]
+        self.nodes = [_Node(self, range(bounds[i], bounds[i + 1])) for i in range(nodes)]
+        self.commands = _command_table()
+        self.errors: list[str] = []
+        self._threads = []
+
+    def __enter__(self) -> LocalRedisCluster:
+        for node in self.nodes:
+            thread = threading.Thread(target=node.serve_forever, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def __exit__(self, *exc):
+        for node in self.nodes:
+            node.shutdown()
+            node.server_close()
+
+    @property
+    def startup_nodes(self) -> list[str]:
+        return [f"{HOST}:{node.port}" for node in self.nodes]
+
+    def node_of(self, key: bytes | str) -> _Node:
+        slot = key_slot(key.encode() if isinstance(key, str) else key)
+        return next(node for node in self.nodes if slot in node.slots)
+
+    def client(self, node: _Node) -> fakeredis.FakeRedis:
+        """Direct access to a node's data."""
+        return fakeredis.FakeRedis(server=node.fake_server)
+
+    def intercept(self, node: _Node, args: list[bytes]):
+        """The reply to the commands a cluster node answers differently, None for the others."""
+        name = args[0].upper()
+        if name == b"CLUSTER":
+            return self._cluster(node, args[1].upper(), args[2:])
+        if name in (b"READONLY", b"READWRITE"):
+            return b"OK"
+        if name == b"COMMAND" and len(args) == 1:
+            return self.commands
+        if name == b"PUBLISH":
+            return sum(self.client(n).publish(args[1], args[2]) for n in self.nodes)
+        slots = {key_slot(key) for key in _keys(args)}
+        if len(slots) > 1:
+            self.errors.append(f"CROSSSLOT {args[0].decode()}")
+            return SimpleError("CROSSSLOT Keys in request don't hash to the same slot")
+        if slots and slots.isdisjoint(node.slots):
+            slot = slots.pop()
+            owner = next(n for n in self.nodes if slot in n.slots)
+            return SimpleError(f"MOVED {slot} {HOST}:{owner.port}")
+        return None
+
+    def _cluster(self, node: _Node, sub: bytes, args: list[bytes]):
+        if sub == b"SLOTS":
+            return [[n.slots.start, n.slots.stop - 1, [HOST.encode(), n.port, n.node_id]] for n in self.nodes]
+        if sub == b"MYID":
+            return node.node_id
+        if sub == b"KEYSLOT":
+            return key_slot(args[0])
+        if sub == b"INFO":
+            return b"cluster_state:ok\r\ncluster_slots_assigned:16384\r\ncluster_known_nodes:%d\r\n" % len(
+                self.nodes
+                )
+        return SimpleError(f"ERR unsupported CLUSTER {sub.decode()} in the stand-in")
@@ -0,0 +1,207 @@
+from datetime import timedelta
+from types import SimpleNamespace
+
+import anyio
+import fakeredis
+import fakeredis.aioredis
+import pytest
+from aiohttp import web
+
+from devops_console.sccs.errors import AccessForbidden, BitbucketHTTPError
+from devops_console.sccs.plugins.bitbucket_api import Bitbucket, close_connections
+from devops_console.sccs.plugins import bitbucketcloud
+from devops_console.sccs.plugins.bitbucketcloud import BitbucketCloud
+from devops_console.sccs.redis import RedisCache
+from devops_console.sccs.schemas.config import EnvironmentConfiguration
+from devops_console.sccs.typing.credentials import Credentials
+from devops_console.sccs.typing.repositories import Repository
+
+BRANCH = {
+    "name": "deploy/dev",
+    "target": {
+        "hash": "c0ffee",
+        "date": "2022-06-01T12:00:00+00:00",
+        "author": {"raw": "Jane <jane@example.com>", "user": {"display_name": "Jane"}},
+        },
+    }
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def cache():
+    server = fakeredis.FakeServer()
+    _cache = RedisCache()
+    _cache.redis = fakeredis.FakeRedis(server=server)
+    _cache.aredis = fakeredis.aioredis.FakeRedis(server=server)
+    _cache._is_initialized = True
+    _cache.local.clear()
+    yield _cache
+    _cache.local.clear()
+    _cache.redis = None
+    _cache.aredis = None
+    _cache._is_initialized = False
+
+
+@pytest.fixture
+async def bitbucket():
+    """A client of a fake Bitbucket, with 250 repositories and 3 pages of pipelines."""
+    requests = []
+
+    async def permissions(request: web.Request):
+        start = int(request.query.get("start", 0))
+        page = {
+            "values": [
+                {"permission": "write", "repository": {"full_name": f"team/repo-{i}"}}
+                for i in range(start, min(start + 100, 250))
+                ],
+            }
+        if start + 100 < 250:
+            page["next"] = str(request.url.with_query(start=start + 100))
+        return web.json_response(page)
+
+    async def repositories(request: web.Request):
+        return web.json_response({"values": [{
+            "name": "Repo",
+            "full_name": "team/repo",
+            "links": {"html": {"href": "https://bitbucket.org/team/repo"}},
+            }]})
+
+    async def pipelines(request: web.Request):
+        page = int(request.query["page"])
+        return web.json_response({"values": [{"build_number": page}] if page <= 3 else []})
+
+    async def branch(request: web.Request):
+        if request.match_info["name"] != BRANCH["name"]:
+            return web.json_response({"type": "error", "error": {"message": "Branch not found"}}, status=404)
+        return web.json_response(BRANCH)
+
+    async def src(request: web.Request):
+        return web.Response(body=b"1.2\n")
+
+    async def pullrequests(request: web.Request):
+        return web.json_response({"values": [{
+            "title": "Upgrade dev [CD]",
+            "destination": {"branch": {"name": "deploy/dev"}},
+            "links": {"html": {"href": "https://bitbucket.org/team/repo/pull-requests/1"}},
+            }]})
+
+    @web.middleware
+    async def record(request: web.Request, handler):
+        requests.append(request.path_qs)
+        return await handler(request)
+
+    app = web.Application(middlewares=[record])
+    app.router.add_get("/2.0/user/permissions/repositories", permissions)
+    app.router.add_get("/2.0/repositories/team", repositories)
+    app.router.add_get("/2.0/repositories/team/repo/pipelines/", pipelines)
+    app.router.add_get("/2.0/repositories/team/repo/refs/branches/{name:.+}", branch)
+    app.router.add_get("/2.0/repositories/team/repo/src/{commit}/{path:.+}", src)
+    app.router.add_get("/2.0/repositories/team/repo/pullrequests", pullrequests)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    client = Bitbucket("user", "secret", url=f"http://127.0.0.1:{port}/2.0")
+    client.requests = requests
+    yield client
+    await close_connections()
+    await runner.cleanup()
+
+
+@pytest.mark.anyio
+async def test_pages_are_fetched_as_they_are_consumed(bitbucket):
+    permissions = bitbucket.permissions(fields="next,values.permission")
+    assert (await anext(permissions))["repository"]["full_name"] == "team/repo-0"
+    assert len(bitbucket.requests) == 1
+    assert len([p async for p in permissions]) == 249
+    assert len(bitbucket.requests) == 3
+    # the next links keep the parameters
+    assert "fields=next" in bitbucket.requests[0] and "start=200" in bitbucket.requests[2]
+
+    # the pipelines are paged by number
+    assert [p["build_number"] async for p in bitbucket.pipelines("team", "repo")] == [1, 2, 3]
+
+
+@pytest.mark.anyio
+async def test_errors_are_http_errors(bitbucket):
+    with pytest.raises(BitbucketHTTPError) as e:
+        await bitbucket.branch("team", "repo", "nope")
+    assert e.value.status_code == 404 and b"Branch not found" in e.value.body
+    assert "Branch not found" in str(e.value)
+
+
+@pytest.mark.anyio
+async def test_the_plugin_reads_the_cd_config(bitbucket):
+    plugin = BitbucketCloud.__new__(BitbucketCloud)
+    plugin.team = "team"
+    plugin.admin_session = bitbucket
+    plugin.cd_pullrequest_tag = "[CD]"
+    environment = EnvironmentConfiguration(
+        name="dev", branch="deploy/dev", version={"file": "version.txt"}, trigger={"pullrequest": True}
+        )
+
+    branch = await bitbucket.branch("team", "repo", "deploy/dev")
+    with anyio.fail_after(5):
+        name, config = await plugin.get_continuous_deployment_config_by_branch("repo", branch, environment)
+    assert name == "deploy/dev"
+    assert (config.version, config.author) == ("1.2", "Jane")
+    assert config.pullrequest == "https://bitbucket.org/team/repo/pull-requests/1"
+
+
+@pytest.mark.anyio
+async def test_access_is_checked_again_without_the_cache(bitbucket, monkeypatch):
+    monkeypatch.setattr(bitbucketcloud, "_permissions_refetched", {})
+    plugin = BitbucketCloud.__new__(BitbucketCloud)
+    fetches = []
+
+    async def get_repository_permissions(session: Bitbucket, fetch: bool = False):
+        fetches.append(fetch)
+        # a repository created since the permissions were cached
+        return {"repo": "write"} if fetch else {}
+
+    plugin.get_repository_permissions = get_repository_permissions
+    await plugin.accesscontrol(bitbucket, "repo")
+    assert fetches == [False, True]
+
+    # not again within PERMISSIONS_REFETCH_INTERVAL
+    fetches.clear()
+    with pytest.raises(AccessForbidden):
+        await plugin.accesscontrol(bitbucket, "other")
+    assert fetches == [False]
+
+    monkeypatch.setattr(bitbucketcloud, "PERMISSIONS_REFETCH_INTERVAL", timedelta(0))
+    fetches.clear()
+    with pytest.raises(AccessForbidden):
+        await plugin.accesscontrol(bitbucket, "other")
+    assert fetches == [False, True]
+
+
+@pytest.mark.anyio
+async def test_the_plugin_and_v2_repository_caches_are_distinct(cache, bitbucket):
+    plugin = BitbucketCloud.__new__(BitbucketCloud)
+    plugin.team = "team"
+    plugin.admin_session = bitbucket
+    [repository] = await plugin.get_repository_catalog()
+    assert isinstance(repository, Repository)
+    assert len(await plugin.get_repository_permissions(bitbucket)) == 250
+
+    try:
+        from devops_console.clients.sccs_v2 import SccsV2
+    except (KeyError, SystemExit):
+        pytest.skip("the clients need the app's settings")
+    v2 = object.__new__(SccsV2)
+    v2.config = SimpleNamespace(team="team")
+    v2.session = lambda credentials: bitbucket
+    [description] = await v2.get_repository_catalog()
+    assert not isinstance(description, Repository)
+    credentials = Credentials(user=bitbucket.username, author="Jane", apikey=bitbucket.password)
+    assert len(await v2.get_repository_permissions(credentials)) == 250
+    # each fetched its own
+    assert len([path for path in bitbucket.requests if path.startswith("/2.0/repositories/team?")]) == 2
+    assert len([path for path in bitbucket.requests if path.startswith("/2.0/user/permissions")]) == 6
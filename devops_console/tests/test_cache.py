@@ -0,0 +1,775 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+from datetime import timedelta
+
+import fakeredis
+import fakeredis.aioredis
+import pytest
+from redis.exceptions import ResponseError
+
+from devops_console.sccs.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from devops_console.sccs.errors import BitbucketHTTPError
+from devops_console.sccs.fallback_store import FallbackStore
+from devops_console.sccs.local_cache import LocalCache
+from devops_console.sccs.metrics import metrics
+from devops_console.sccs.plugins.cache_keys import CacheKeyFn
+from devops_console.sccs.typing.credentials import Credentials
+from devops_console.sccs.warmup import (
+    WarmUp,
+    most_used_repositories,
+    record_repository_usage,
+    record_repository_usage_async,
+    )
+from devops_console.sccs.redis import (
+    CacheEntry,
+    RedisCache,
+    RedisOptions,
+    cache_async,
+    cache_async_many,
+    cache_stats,
+    cache_sync,
+    cache_sync_many,
+    fn_tag,
+    repo_tag,
+    user_tag,
+    )
+
+from .cluster_fixtures import LocalRedisCluster
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def cache(server):
+    _cache = RedisCache()
+    _cache.redis = fakeredis.FakeRedis(server=server)
+    _cache.aredis = fakeredis.aioredis.FakeRedis(server=server)
+    _cache._is_initialized = True
+    _cache.local.clear()
+    yield _cache
+    _cache.local.clear()
+    _cache.fallback.clear()
+    _cache.degraded = False
+    _cache.breaker.reset()
+    _cache.redis = None
+    _cache.aredis = None
+    _cache._is_initialized = False
+
+
+class Upstream:
+    def __init__(self):
+        self.calls = 0
+
+    @cache_async(ttl=timedelta(minutes=1))
+    async def get_async(self, slug: str):
+        self.calls += 1
+        return {"slug": slug, "calls": self.calls}
+
+    @cache_async(ttl=timedelta(minutes=1), write_behind=True)
+    async def get_async_write_behind(self, slug: str):
+        self.calls += 1
+        return [slug] * 3
+
+    @cache_async(ttl=timedelta(minutes=1))
+    async def get_async_slow(self, slug: str):
+        self.calls += 1
+        await asyncio.sleep(0.05)
+        return slug
+
+    @cache_async(ttl=timedelta(minutes=1), soft_ttl=timedelta(0))
+    async def get_async_always_stale(self, slug: str):
+        self.calls += 1
+        return self.calls
+
+    @cache_sync(ttl=timedelta(minutes=1))
+    def get_sync(self, slug: str):
+        self.calls += 1
+        return {"slug": slug, "calls": self.calls}
+
+    @cache_sync(ttl=timedelta(minutes=1))
+    def get_sync_slow(self, slug: str):
+        self.calls += 1
+        time.sleep(0.05)
+        return slug
+
+
+@pytest.mark.anyio
+async def test_async_roundtrip(cache):
+    assert await cache.set_async("k", {"a": 1})
+    assert await cache.get_async("k") == {"a": 1}
+    assert await cache.get_async("missing", default=[]) == []
+    assert await cache.delete_async("k") == 1
+
+
+@pytest.mark.anyio
+async def test_async_delete_namespace(cache):
+    for i in range(3):
+        await cache.set_async(f"ns::{i}", i)
+    await cache.set_async("other", 0)
+
+    assert await cache.delete_namespace_async("ns") == 3
+    assert await cache.get_async("other") == 0
+
+
+@pytest.mark.anyio
+async def test_cache_async_decorator(cache):
+    upstream = Upstream()
+    assert (await upstream.get_async("a"))["calls"] == 1
+    assert (await upstream.get_async("a"))["calls"] == 1
+    assert (await upstream.get_async("a", fetch=True))["calls"] == 2
+
+
+@pytest.mark.anyio
+async def test_write_behind(cache):
+    upstream = Upstream()
+    assert await upstream.get_async_write_behind("a") == ["a", "a", "a"]
+    await cache.flush_pending_writes()
+    assert (await cache.get_async("get_async_write_behind(a)")).value == ["a", "a", "a"]
+
+
+def test_cache_sync_decorator(cache):
+    upstream = Upstream()
+    assert upstream.get_sync("a")["calls"] == 1
+    assert upstream.get_sync("a")["calls"] == 1
+    assert upstream.get_sync("a", fetch=True)["calls"] == 2
+
+
+def test_local_cache_lru_and_ttl():
+    local = LocalCache(max_entries=2, max_bytes=100)
+    local.set("a", 1, size=10)
+    local.set("b", 2, size=10)
+    local.get("a")
+    local.set("c", 3, size=10)
+    assert local.get("b") is None  # least recently used
+    assert local.get("a") == 1
+
+    local.set("big", 4, size=101)
+    assert local.get("big") is None
+
+    local.set("expired", 5, size=1, ttl=timedelta(seconds=0))
+    assert local.get("expired") is None
+
+
+@pytest.mark.anyio
+async def test_local_cache_in_front_of_redis(cache):
+    await cache.set_async("k", [1, 2])
+    await cache.aredis.delete(cache._k("k"))  # bypass the cache: only the local copy is left
+    assert await cache.get_async("k") == [1, 2]
+
+    await cache.delete_async("k")
+    assert await cache.get_async("k") is None
+
+
+def test_remote_invalidation(cache):
+    cache.set("ns::k", 1)
+    cache.set("other", 2)
+
+    cache._apply_invalidation(cache._invalidation_message("keys", "other"))  # our own message
+    assert cache.local.get("other") == 2
+
+    cache.instance_id, origin = "another-replica", cache.instance_id
+    try:
+        cache._apply_invalidation(
+            '{"origin": "%s", "op": "prefix", "keys": ["ns"]}' % origin
+            )
+    finally:
+        cache.instance_id = origin
+    assert cache.local.get("ns::k") is None
+    assert cache.local.get("other") == 2
+
+
+@pytest.mark.anyio
+async def test_single_flight_async(cache):
+    upstream = Upstream()
+    results = await asyncio.gather(*(upstream.get_async_slow("a") for _ in range(10)))
+    assert results == ["a"] * 10
+    assert upstream.calls == 1
+
+
+def test_single_flight_sync(cache):
+    upstream = Upstream()
+    threads = [threading.Thread(target=upstream.get_sync_slow, args=("a",)) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert upstream.calls == 1
+
+
+@pytest.mark.anyio
+async def test_single_flight_across_replicas(cache):
+    upstream = Upstream()
+    lease = cache.lease_async("get_async_slow(a)", timedelta(seconds=5), "Upstream.get_async_slow")
+    async with lease as acquired:
+        assert acquired  # another replica is computing the value...
+        waiter = asyncio.create_task(upstream.get_async_slow("a"))
+        await asyncio.sleep(0.2)
+        await cache.set_async("get_async_slow(a)", "from another replica")
+        assert await waiter == "from another replica"
+    assert upstream.calls == 0
+
+
+@pytest.mark.anyio
+async def test_a_failing_lease_is_bypassed(cache, monkeypatch):
+    upstream = Upstream()
+
+    class FailingLock:
+        async def acquire(self):
+            raise ResponseError("OOM command not allowed")
+
+    monkeypatch.setattr(cache.aredis, "lock", lambda *args, **kwargs: FailingLock())
+    assert await upstream.get_async_slow("a") == "a"
+    assert upstream.calls == 1
+    assert metrics.samples("cache_bypasses_total")[(("function", "Upstream.get_async_slow"),)] == 1
+
+
+@pytest.mark.anyio
+async def test_stale_while_revalidate(cache):
+    upstream = Upstream()
+    assert await upstream.get_async_always_stale("a") == 1
+    assert await upstream.get_async_always_stale("a") == 1  # stale value, refresh started
+    await asyncio.sleep(0.1)
+    assert upstream.calls == 2
+    assert (await cache.get_async("get_async_always_stale(a)")).value == 2
+
+
+def test_xfetch_probability():
+    fresh = CacheEntry(value=None, stale_at=time.time() + 3600, delta=0.1)
+    assert not any(fresh.should_refresh(beta=1.0) for _ in range(1000))
+
+    # an expensive value close to its expiry is refreshed early most of the time
+    almost = CacheEntry(value=None, stale_at=time.time() + 1, delta=10)
+    assert sum(almost.should_refresh(beta=1.0) for _ in range(1000)) > 800
+
+    stale = CacheEntry(value=None, stale_at=time.time() - 1, delta=0)
+    assert stale.should_refresh(beta=0)
+
+
+class Tagged:
+    @cache_async(ttl=timedelta(minutes=1), tags=["repo:{slug}"])
+    async def get_async(self, slug: str, page: int = 0):
+        return [slug, page]
+
+    @cache_sync(ttl=timedelta(minutes=1), tags=["repo:{slug}", "user:{user}"])
+    def get_sync(self, user: str, *, slug: str):
+        return [user, slug]
+
+
+@pytest.mark.anyio
+async def test_tag_invalidation(cache):
+    tagged = Tagged()
+    await tagged.get_async("a")
+    await tagged.get_async("a", page=1)
+    await tagged.get_async("b")
+    await asyncio.to_thread(tagged.get_sync, "alice", slug="a")
+
+    assert await cache.invalidate_tags_async(repo_tag("a")) == 3
+    # the entries of a repository share its hash tag
+    assert await cache.get_async("{repo:a}get_async(a)") is None
+    assert await cache.get_async("{repo:b}get_async(b)") is not None
+    assert await cache.invalidate_tags_async(repo_tag("a")) == 0
+
+    assert cache.invalidate_tags(fn_tag("get_async"), user_tag("alice")) == 1
+
+
+def test_clear_leaves_foreign_keys_alone(cache):
+    cache.redis.set("someone-else", b"1")
+    cache.set("k", 1, tags=["t"])
+
+    cache.clear()
+    assert cache.get("k") is None
+    assert cache.redis.get("someone-else") == b"1"
+    assert cache.redis.keys() == [b"someone-else"]
+
+
+@pytest.mark.anyio
+async def test_cache_stats(cache):
+    metrics.reset()
+    upstream = Upstream()
+    await upstream.get_async("a")
+    await upstream.get_async("a")
+    await upstream.get_async("a", fetch=True)
+    cache.local.clear()
+    await upstream.get_async("a")
+
+    stats = cache_stats()["Upstream.get_async"]
+    assert (stats["hits"], stats["local_hits"], stats["misses"], stats["fetches"]) == (2, 1, 1, 1)
+    assert stats["hit_ratio"] == 2 / 3
+    assert stats["compute_seconds"]["count"] == 2
+    assert stats["value_bytes"]["count"] == 2
+    assert stats["deserialize_seconds"]["count"] == 1
+
+    text = metrics.to_prometheus()
+    assert 'cache_hits_total{function="Upstream.get_async",layer="local"} 1' in text
+    assert 'cache_compute_seconds_count{function="Upstream.get_async"} 2' in text
+    assert 'cache_compute_seconds_bucket{function="Upstream.get_async",le="+Inf"} 2' in text
+
+
+@pytest.mark.anyio
+async def test_get_many_set_many(cache):
+    assert await cache.set_many_async({"a": 1, "b": [2]}, tags={"a": ["t"]})
+    assert cache.set_many({"c": 3})
+    cache.local.clear()
+    assert await cache.get_many_async(["a", "missing", "b"], default=0) == [1, 0, [2]]
+    assert cache.get_many(["c", "a"]) == [3, 1]
+    assert await cache.invalidate_tags_async("t") == 1
+
+
+status_key = CacheKeyFn("status", kwarg_names=["slug", "env"])
+
+
+class Batched:
+    def __init__(self):
+        self.calls = []
+
+    @cache_sync(ttl=timedelta(minutes=1), key=status_key)
+    def status(self, *, slug: str, env: str):
+        self.calls.append([env])
+        return f"{slug}@{env}"
+
+    @cache_sync_many(ttl=timedelta(minutes=1), key=status_key, batch_arg="envs", item_arg="env")
+    def status_many(self, *, slug: str, envs: list[str]):
+        self.calls.append(envs)
+        return {env: f"{slug}@{env}" for env in envs if env != "unknown"}
+
+    @cache_async_many(
+        ttl=timedelta(minutes=1), key=status_key, batch_arg="envs", item_arg="env", tags=["repo:{slug}"]
+        )
+    async def status_many_async(self, *, slug: str, envs: list[str]):
+        self.calls.append(envs)
+        return {env: f"{slug}@{env}" for env in envs}
+
+
+def test_cache_sync_many(cache):
+    batched = Batched()
+    assert batched.status(slug="a", env="qa") == "a@qa"
+    assert batched.status_many(slug="a", envs=["qa", "prod", "unknown"]) == {"qa": "a@qa", "prod": "a@prod"}
+    assert batched.calls == [["qa"], ["prod", "unknown"]]  # only the misses go upstream
+
+    assert batched.status(slug="a", env="prod") == "a@prod"  # shared with the single-item method
+    assert batched.status_many(slug="a", envs=["prod", "unknown"]) == {"prod": "a@prod"}
+    assert batched.calls[2:] == [["unknown"]]  # "unknown" was not cached
+
+    batched.status_many(slug="a", envs=["qa"], fetch=True)
+    assert batched.calls[-1] == ["qa"]
+
+
+@pytest.mark.anyio
+async def test_cache_async_many(cache):
+    batched = Batched()
+    assert await batched.status_many_async(slug="a", envs=["qa", "prod"]) == {"qa": "a@qa", "prod": "a@prod"}
+    cache.local.clear()
+    result = await batched.status_many_async(slug="a", envs=["prod", "dev"])
+    assert result == {"prod": "a@prod", "dev": "a@dev"}
+    assert batched.calls == [["qa", "prod"], ["dev"]]
+    assert await cache.invalidate_tags_async(repo_tag("a")) == 3
+
+
+@pytest.mark.anyio
+async def test_warmup(cache):
+    running, peak, seen = 0, 0, []
+
+    async def job(i):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        if i == 3:
+            raise RuntimeError("boom")
+        seen.append(i)
+
+    async def jobs():
+        return [(f"job {i}", functools.partial(job, i)) for i in range(10)]
+
+    warmup = WarmUp(jobs, concurrency=2, interval=None)
+    assert warmup.trigger()
+    assert not warmup.trigger()  # already running
+    assert warmup.status.running
+    await warmup._run
+
+    assert sorted(seen) == [0, 1, 2, 4, 5, 6, 7, 8, 9]
+    assert peak == 2
+    assert (warmup.status.total, warmup.status.done, warmup.status.failed) == (10, 9, 1)
+    assert warmup.status.errors == ["job 3: boom"]
+    assert not warmup.status.running
+
+
+@pytest.mark.anyio
+async def test_most_used_repositories(cache):
+    for slug in ["a", "b", "b", "c", "c", "c"]:
+        await record_repository_usage_async(slug)
+    for _ in range(3):
+        record_repository_usage("a")
+    assert await most_used_repositories(2) == ["a", "c"]
+
+
+class Negative:
+    def __init__(self):
+        self.calls = 0
+
+    @cache_async(ttl=timedelta(minutes=1), negative_ttl=timedelta(seconds=30))
+    async def find(self, slug: str):
+        self.calls += 1
+        if slug == "gone":
+            raise BitbucketHTTPError(404, message=f"{slug} not found")
+        return None
+
+    @cache_sync(ttl=timedelta(minutes=1))
+    def find_uncached_none(self, slug: str):
+        self.calls += 1
+        return None
+
+    @cache_sync_many(
+        ttl=timedelta(minutes=1),
+        key=status_key,
+        batch_arg="envs",
+        item_arg="env",
+        negative_ttl=timedelta(seconds=30),
+        )
+    def status_many(self, *, slug: str, envs: list[str]):
+        self.calls += 1
+        return {env: None for env in envs}
+
+
+@pytest.mark.anyio
+async def test_negative_caching(cache):
+    negative = Negative()
+    assert await negative.find("unknown") is None
+    assert await negative.find("unknown") is None
+    assert negative.calls == 1
+    assert 0 < await cache.aredis.ttl(cache._k("find(unknown)")) <= 30
+
+    for _ in range(2):
+        with pytest.raises(BitbucketHTTPError) as e:
+            await negative.find("gone")
+        assert e.value.status_code == 404
+        assert "gone not found" in str(e.value)
+    assert negative.calls == 2
+
+    assert negative.find_uncached_none("a") is None
+    assert negative.find_uncached_none("a") is None
+    assert negative.calls == 4
+
+    assert negative.status_many(slug="a", envs=["qa"]) == {"qa": None}
+    assert negative.status_many(slug="a", envs=["qa"]) == {"qa": None}
+    assert negative.calls == 5
+
+
+class PerUser:
+    def __init__(self):
+        self.calls = 0
+
+    @cache_sync(ttl=timedelta(minutes=1), tags=["user:{credentials.user}"])
+    def permissions(self, credentials: Credentials):
+        self.calls += 1
+        return {"repo-a": "write"}
+
+
+def test_credentials_are_not_written_in_keys(cache):
+    per_user = PerUser()
+    alice = Credentials(user="alice", author="Alice <alice@example.com>", apikey="s3cr3t")
+    assert per_user.permissions(alice) == {"repo-a": "write"}
+    assert per_user.permissions(alice.copy()) == {"repo-a": "write"}
+    assert per_user.calls == 1
+
+    # another api key is another entry: a wrong key can't read the user's cached values
+    per_user.permissions(alice.copy(update={"apikey": "other"}))
+    assert per_user.calls == 2
+
+    keys = [k.decode() for k in cache.redis.keys("*")]
+    assert any(k.startswith(cache._k("permissions(alice:")) for k in keys)
+    assert not any("s3cr3t" in k for k in keys)
+
+
+class Budgeted:
+    @cache_async(ttl=timedelta(minutes=1))
+    async def versions(self, slug: str):
+        return "v" * 100
+
+    @cache_async(ttl=timedelta(minutes=1))
+    async def huge(self, slug: str):
+        return os.urandom(2000).hex()  # doesn't compress
+
+
+@pytest.fixture
+def budgets(cache):
+    quotas, max_value_bytes = cache.quotas, cache.max_value_bytes
+    cache.quotas = {"versions": 1000}
+    cache.max_value_bytes = 2000
+    yield cache
+    cache.quotas, cache.max_value_bytes = quotas, max_value_bytes
+
+
+@pytest.mark.anyio
+async def test_values_over_the_cap_are_not_cached(budgets):
+    assert len(await Budgeted().huge("a")) == 4000
+    assert not await budgets.aredis.exists(budgets._k("huge(a)"))
+
+    # an older value would never be refreshed
+    await budgets.set_async("k", "small")
+    assert not await budgets.set_async("k", os.urandom(2000).hex())
+    assert not await budgets.aredis.exists(budgets._k("k"))
+    assert budgets.local.get("k") is None
+
+
+@pytest.mark.anyio
+async def test_least_frequently_used_entries_are_evicted(budgets):
+    budgeted = Budgeted()
+    for slug in "abc":
+        await budgeted.versions(slug)
+    # hits are counted locally and flushed with the next write
+    budgets.local.clear()
+    for _ in range(3):
+        await budgeted.versions("a")
+    await budgeted.versions("c")
+    budgets.local.clear()
+
+    await budgeted.versions("d")  # 4 entries of ~300 bytes: over the quota
+    assert not await budgets.aredis.exists(budgets._k("versions(b)"))
+    for slug in "acd":
+        assert await budgets.aredis.exists(budgets._k(f"versions({slug})"))
+    assert metrics.samples("cache_evictions_total")[(("budget", "versions"),)] == 1
+
+    report = await budgets.memory_report_async()
+    assert report["fn:versions"]["entries"] == 4  # the tag still lists the evicted entry
+    assert report["fn:versions"]["sampled"] == 3
+    assert report["fn:versions"]["average_bytes"] > 100
+    assert report["fn:versions"]["quota_bytes"] == 1000
+    assert 0 < report["fn:versions"]["accounted_bytes"] <= 1000
+
+
+@pytest.mark.anyio
+async def test_the_cache_falls_back_to_the_embedded_store_while_redis_is_down(cache, server):
+    upstream = Upstream()
+    await cache.set_async("gone", "x")
+    server.connected = False
+
+    assert (await upstream.get_async("a"))["calls"] == 1
+    cache.local.clear()
+    assert (await upstream.get_async("a"))["calls"] == 1
+    assert upstream.calls == 1
+    assert cache.degraded
+
+    assert cache.get("gone") is None  # lived in redis only
+    cache.delete("gone")
+    cache.increment_score("usage", "a")
+
+    server.connected = True
+    cache._retry_at = 0
+    cache.local.clear()
+    assert (await upstream.get_async("a"))["calls"] == 1
+    assert not cache.degraded
+    assert await cache.aredis.exists(cache._k("get_async(a)"))
+    assert await cache.aredis.zrange(cache._tag_key(fn_tag("get_async")), 0, -1) == [b"get_async(a)"]
+    assert not await cache.aredis.exists(cache._k("gone"))
+    assert await cache.top_async("usage", 1) == ["a"]
+    assert cache.fallback.stats()["entries"] == 0
+
+
+def test_redis_is_retried_with_a_backoff(cache, server):
+    server.connected = False
+    assert cache.set("k", "v")
+    first = cache._retry_at
+    assert cache.get("k") == "v"
+    assert cache._retry_at == first  # too early to retry
+
+    cache._retry_at = 0
+    cache.local.clear()
+    assert cache.get("k") == "v"
+    assert cache._backoff == 2 * cache.reconnect_backoff[0]
+
+
+def test_startup_does_not_fail_without_redis(monkeypatch):
+    monkeypatch.setenv("REDIS_HOST", "127.0.0.1:1")
+    monkeypatch.setenv("REDIS_CONNECT_TIMEOUT", "0.1")
+    _cache = RedisCache()
+    _cache._is_initialized = False
+    try:
+        _cache.init()
+        assert _cache.initialized and _cache.degraded
+        assert _cache.set("k", "v")
+        _cache.local.clear()
+        assert _cache.get("k") == "v"
+    finally:
+        _cache.fallback.clear()
+        _cache.local.clear()
+        _cache.degraded = False
+        _cache.redis = None
+        _cache.aredis = None
+        _cache._is_initialized = False
+
+
+def test_large_fallback_values_are_written_to_a_file(tmp_path):
+    store = FallbackStore(max_bytes=100, path=str(tmp_path / "fallback.db"), spill_threshold=10)
+    store.set("small", b"s", 60)
+    store.set("large", b"l" * 1000, 60, tags=("t",))
+    assert store.get("large")[0] == b"l" * 1000
+    assert store.stats()["memory_bytes"] == 1 and store.stats()["file_bytes"] == 1000
+
+    for i in range(200):
+        store.set(f"k{i}", b"x", 60)
+    assert store.get("small") == (None, -2)  # evicted, least recently used
+    assert store.exists("large")
+
+    assert store.invalidate_tags("t") == 1
+    assert store.snapshot().invalidated_tags == ["t"]
+
+
+@pytest.mark.anyio
+async def test_the_fallback_file_is_not_used_on_the_event_loop(cache, server, tmp_path, monkeypatch):
+    fallback = FallbackStore(path=str(tmp_path / "fallback.db"), spill_threshold=10)
+    monkeypatch.setattr(cache, "fallback", fallback)
+    threads = set()
+    connection = cache.fallback._connection
+
+    def connection_of_thread():
+        threads.add(threading.current_thread())
+        return connection()
+
+    monkeypatch.setattr(cache.fallback, "_connection", connection_of_thread)
+    server.connected = False
+    upstream = Upstream()
+    assert (await upstream.get_async("a" * 100))["calls"] == 1
+    cache.local.clear()
+    assert (await upstream.get_async("a" * 100))["calls"] == 1
+    assert threads and threading.main_thread() not in threads
+
+
+def test_circuit_breaker_opens_after_repeated_failures():
+    breaker = CircuitBreaker(threshold=2, cooldown=0.05)
+    assert not breaker.record_failure()
+    assert breaker.record_failure()
+    assert breaker.state == OPEN and not breaker.allow()
+
+    time.sleep(0.05)
+    assert breaker.allow()  # the trial call
+    assert not breaker.allow()
+    assert breaker.record_failure()  # failed: open again
+    time.sleep(0.05)
+    assert breaker.state == HALF_OPEN and breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+
+
+@pytest.mark.anyio
+async def test_the_cache_is_bypassed_while_failing(cache, monkeypatch):
+    cache.breaker.threshold = 2
+    upstream = Upstream()
+
+    def failing(*args, **kwargs):
+        raise ResponseError("OOM command not allowed")
+
+    monkeypatch.setattr(cache.aredis, "pipeline", failing)
+    assert (await upstream.get_async("a"))["calls"] == 1
+    assert (await upstream.get_async("a"))["calls"] == 2
+    assert cache.breaker.state == OPEN
+
+    monkeypatch.undo()
+    assert (await upstream.get_async("a"))["calls"] == 3  # still open: not even read
+    assert metrics.samples("cache_bypasses_total")[(("function", "Upstream.get_async"),)] == 3
+
+
+@pytest.mark.anyio
+async def test_a_trial_answered_locally_does_not_hold_the_breaker_half_open(cache):
+    cache.breaker.threshold = 1
+    cache.breaker.cooldown = 0.05
+    upstream = Upstream()
+    assert (await upstream.get_async("a"))["calls"] == 1
+    cache.breaker.record_failure()
+    assert cache.breaker.state == OPEN
+
+    time.sleep(0.05)
+    assert (await upstream.get_async("a"))["calls"] == 1  # the trial: a local cache hit
+    assert cache.breaker.state == HALF_OPEN
+    assert (await upstream.get_async("b"))["calls"] == 2  # no outcome recorded yet: bypassed
+
+    time.sleep(0.05)
+    cache.local.clear()
+    assert (await upstream.get_async("a"))["calls"] == 1  # another trial, read from redis
+    assert cache.breaker.state == CLOSED
+
+
+def test_redis_options_configure_the_pools(cache):
+    options = RedisOptions(max_connections=7, socket_timeout=0.5, retries=4, breaker_threshold=9)
+    cache.configure(options)
+    try:
+        cache._connect()
+        kwargs = cache.redis.connection_pool.connection_kwargs
+        assert cache.redis.connection_pool.max_connections == 7
+        assert kwargs["socket_timeout"] == 0.5 and kwargs["retry"]._retries == 4
+        assert cache.aredis.connection_pool.max_connections == 7
+        assert cache.breaker.threshold == 9
+        assert cache.pool_stats() == {
+            "sync": {"created": 0, "in_use": 0, "max": 7},
+            "async": {"created": 0, "in_use": 0, "max": 7},
+            }
+    finally:
+        del cache.options, cache.breaker
+
+
+@pytest.fixture
+def cluster():
+    with LocalRedisCluster(nodes=3) as _cluster:
+        yield _cluster
+
+
+@pytest.mark.anyio
+async def test_the_cache_runs_on_a_cluster(cluster):
+    cache = RedisCache()
+    cache.configure(RedisOptions(mode="cluster", cluster_nodes=cluster.startup_nodes))
+    quotas = cache.quotas
+    cache.quotas = {"versions": 1000}
+    try:
+        cache._connect()
+        cache._is_initialized = True
+        cache.local.clear()
+
+        tagged = Tagged()
+        for slug in "abc":
+            await tagged.get_async(slug)
+        # everything about a repository lands in its slot
+        keys = [cache._k(f"{{repo:{slug}}}get_async({slug})") for slug in "abc"]
+        assert len({cluster.node_of(key) for key in keys}) > 1
+        for key in keys:
+            assert cluster.client(cluster.node_of(key)).exists(key)
+            tag = cache._tag_key(repo_tag(key[-2]))
+            assert cluster.node_of(tag) is cluster.node_of(key)
+
+        assert await cache.set_many_async({"x": 1, "y": 2, "z": 3})
+        cache.local.clear()
+        assert await cache.get_many_async(["x", "y", "z", "w"]) == [1, 2, 3, None]
+        assert cache.get_many(["z", "x"]) == [3, 1]
+
+        assert await cache.invalidate_tags_async(repo_tag("a")) == 1
+        assert not await cache.aredis.exists(keys[0])
+        assert await cache.aredis.exists(keys[1])
+
+        budgeted = Budgeted()
+        for slug in "abcd":
+            await budgeted.versions(slug)
+        assert sum([await cache.aredis.exists(cache._k(f"versions({slug})")) for slug in "abcd"]) == 3
+
+        for i in range(10):  # across the nodes
+            await cache.set_async(f"ns::{i}", i)
+        assert await cache.delete_namespace_async("ns") == 10
+        assert cluster.errors == []
+    finally:
+        cache.quotas = quotas
+        cache.local.clear()
+        cache._is_initialized = False
+        cache.redis.close()
+        await cache.aredis.aclose()
+        cache.redis = cache.aredis = None
+        del cache.options, cache.breaker
@@ -0,0 +1,93 @@
+import pickle
+
+import orjson
+import pytest
+
+from devops_console.sccs.codec import (
+    COMPRESSION_NONE,
+    FORMAT_JSON,
+    FORMAT_PICKLE,
+    IncompatibleValue,
+    MAGIC,
+    VersionedCodec,
+    )
+from devops_console.sccs.redis import CacheEntry
+from devops_console.sccs.typing.cd import Available, EnvironmentConfig
+from devops_console.sccs.typing.event import Event, EventType
+from devops_console.sccs.typing.repositories import Repository
+
+codec = VersionedCodec(compression_threshold=1024)
+
+
+def repositories(n=400):
+    return [
+        Repository(key=i, name=f"repo-{i}", slug=f"repo-{i}", url=f"https://x/repo-{i}", permission="admin")
+        for i in range(n)
+        ]
+
+
+class Opaque:
+    def __init__(self, v):
+        self.v = v
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        None,
+        "s",
+        [1, 2.5, True, None],
+        {"a": {"b": [1, 2]}, 3: (4, 5)},
+        b"\x00\x01",
+        repositories(3),
+        [EnvironmentConfig(key=1, environment="qa", version="1.0", author=None, date=None)],
+        Event(_type=EventType.ADDED, key=1, value=Available(key=2, build="3", version="abc")),
+        CacheEntry(value=repositories(2), stale_at=1.0, delta=0.5),
+        ],
+    )
+def test_roundtrip(value):
+    data = codec.encode(value)
+    assert data.startswith(MAGIC)
+    assert data[2] == FORMAT_JSON
+    assert codec.decode(data) == value
+
+
+def test_models_keep_their_types():
+    decoded = codec.decode(codec.encode(repositories(1)))
+    assert type(decoded[0]) is Repository
+
+
+def test_pickle_fallback():
+    data = codec.encode(Opaque(1))
+    assert data[2] == FORMAT_PICKLE
+    assert codec.decode(data).v == 1
+
+
+def test_legacy_pickled_values():
+    assert codec.decode(pickle.dumps(repositories(2))) == repositories(2)
+
+
+def test_compression():
+    value = repositories()
+    data = codec.encode(value)
+    assert data[3] != COMPRESSION_NONE
+    assert codec.decode(data) == value
+    assert len(data) < len(pickle.dumps(value))
+
+
+def test_schema_change_is_incompatible():
+    data = VersionedCodec(compression=None).encode(repositories(1))
+    document = orjson.loads(data[4:])
+    document["t"][0][1] = "0" * 16  # written by a version where Repository had other fields
+    with pytest.raises(IncompatibleValue):
+        codec.decode(data[:4] + orjson.dumps(document))
+
+    document["t"][0][0] = "devops_console.sccs.typing.repositories:Gone"
+    with pytest.raises(IncompatibleValue):
+        codec.decode(data[:4] + orjson.dumps(document))
+
+
+def test_other_application_version_is_incompatible():
+    data = codec.encode(Opaque(1))
+    with pytest.raises(IncompatibleValue):
+        codec.decode(data[:4] + b"0.0.0\x00" + data[4:].split(b"\x00", 1)[1])
@@ -0,0 +1,59 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from devops_console.sccs.codec import IncompatibleValue, VersionedCodec, schema_digest
+from devops_console.sccs.plugins.cache_keys import CacheKeyFn
+from devops_console.sccs.typing.repositories import Repository
+from devops_console.sccs.utils.digest import MAX_SAFE_BITS, stable_digest, stable_hash
+
+
+def test_same_digest_in_every_process():
+    code = (
+        "from devops_console.sccs.utils.digest import stable_digest, stable_hash;"
+        "print(stable_digest(('watch', 'repo-a')), stable_hash(('repo-a', 12)))"
+        )
+    outputs = {
+        subprocess.run(
+            [sys.executable, "-c", code],
+            env={**os.environ, "PYTHONHASHSEED": seed},
+            capture_output=True,
+            check=True,
+            text=True,
+            ).stdout
+        for seed in ("1", "2")
+        }
+    assert outputs == {f"{stable_digest(('watch', 'repo-a'))} {stable_hash(('repo-a', 12))}\n"}
+
+
+def test_canonical_encoding():
+    assert stable_digest({"a": 1, "b": {2, 1}}) == stable_digest({"b": {1, 2}, "a": 1})
+    assert stable_digest(("a", 1)) != stable_digest(("a", "1"))
+    repository = Repository(key=1, name="a", slug="a")
+    assert stable_hash(repository) == stable_hash(repository.copy())
+    assert 0 <= stable_hash("repo") < 2 ** MAX_SAFE_BITS
+
+    with pytest.raises(TypeError):
+        stable_digest(object())
+
+
+def test_hashed_cache_keys_are_stable():
+    assert CacheKeyFn.make_default_key("f", "a", hash_it=True) == stable_hash("f(a)")
+
+
+def test_values_cached_with_unstable_keys_are_incompatible():
+    codec = VersionedCodec(compression=None)
+    data = codec.encode([Repository(key=1, name="a", slug="a")])
+    # written before WatcherType.__schema_version__ existed
+    Repository.__schema_version__ = None
+    schema_digest.cache_clear()
+    try:
+        legacy = codec.encode([Repository(key=1, name="a", slug="a")])
+    finally:
+        del Repository.__schema_version__
+        schema_digest.cache_clear()
+    assert codec.decode(data)[0].name == "a"
+    with pytest.raises(IncompatibleValue):
+        codec.decode(legacy)
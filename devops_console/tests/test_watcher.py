@@ -0,0 +1,490 @@
+import functools
+import time
+from datetime import timedelta
+
+import anyio
+import fakeredis
+import fakeredis.aioredis
+import pytest
+
+from devops_console.sccs.plugins.bitbucketcloud import BitbucketCloud
+from devops_console.sccs.realtime.activity import COLD, HOT, WARM, Tiers, record_webhook, last_webhook
+from devops_console.sccs.realtime.leadership import relay
+from devops_console.sccs.realtime.polling import INTERACTIVE, PollScheduler, poller
+from devops_console.sccs.realtime.scheduler import Scheduler
+from devops_console.sccs.realtime.snapshot import Snapshot
+from devops_console.sccs.realtime.subscription import SlowSubscriber, Subscription
+from devops_console.sccs.realtime.watcher import Watcher, standardize_watcher_values
+from devops_console.sccs.redis import RedisCache, cache_async
+from devops_console.sccs.schemas.config import EnvironmentConfiguration
+from devops_console.sccs.typing import WatcherType
+from devops_console.sccs.typing.cd import EnvironmentConfig
+from devops_console.sccs.typing.event import Event, EventType
+from devops_console.sccs.utils.digest import stable_digest, stable_hash
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def cache():
+    server = fakeredis.FakeServer()
+    _cache = RedisCache()
+    _cache.redis = fakeredis.FakeRedis(server=server)
+    _cache.aredis = fakeredis.aioredis.FakeRedis(server=server)
+    _cache._is_initialized = True
+    _cache.local.clear()
+    yield _cache
+    _cache.local.clear()
+    _cache.redis = None
+    _cache.aredis = None
+    _cache._is_initialized = False
+
+
+@pytest.fixture
+def polls():
+    startup_spread, poller.startup_spread = poller.startup_spread, 0
+    yield poller
+    poller.startup_spread = startup_spread
+
+
+class Upstream:
+    def __init__(self):
+        self.calls = 0
+        self.versions = ["1.0", "1.1"]
+
+    async def get_versions(self, fetch: bool = False):
+        self.calls += 1
+        return [{"version": v} for v in self.versions]
+
+
+async def receive(subscription: Subscription, n: int) -> list:
+    with anyio.fail_after(2):
+        return [await anext(subscription) for _ in range(n)]
+
+
+@pytest.mark.anyio
+async def test_only_the_leader_polls(cache, polls):
+    upstream = Upstream()
+    # the same watcher on two replicas
+    replicas = [Watcher("versions", 3600, upstream.get_versions, (), {}) for _ in range(2)]
+    subscriptions = []
+    for watcher in replicas:
+        watcher.lease.ttl = 0.3
+        subscriptions.append(Subscription())
+
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(replicas[0].subscribe, subscriptions[0])
+        assert {e.type for e in await receive(subscriptions[0], 2)} == {EventType.ADDED}
+        assert replicas[0].is_leader
+
+        # the follower starts from what the leader has seen
+        tg.start_soon(replicas[1].subscribe, subscriptions[1])
+        assert {e.type for e in await receive(subscriptions[1], 2)} == {EventType.ADDED}
+        await anyio.sleep(0.2)
+        assert not replicas[1].is_leader
+        assert upstream.calls == 1
+
+        # refreshes requested on the follower are done by the leader, and relayed
+        upstream.versions.append("1.2")
+        await replicas[1].request_refresh(True)
+        for subscription in subscriptions:
+            [event] = await receive(subscription, 1)
+            assert event.type == EventType.ADDED and event.value.data == {"version": "1.2"}
+        assert upstream.calls == 2
+
+        # the follower takes over when the leader leaves
+        await replicas[0].stop()
+        with anyio.fail_after(2):
+            while not replicas[1].is_leader:
+                await anyio.sleep(0.05)
+        await anyio.sleep(0.1)
+        assert upstream.calls == 3
+        assert len(subscriptions[1]) == 0  # nothing changed
+
+        await replicas[1].stop()
+    await anyio.sleep(0.2)  # the relay stops listening
+    assert not relay._handlers
+
+
+@pytest.mark.anyio
+async def test_snapshots_only_write_what_changed(cache, monkeypatch):
+    snapshot = Snapshot("test:{w}")
+    values = [WatcherType(key=i, data={"build": i}) for i in range(5)]
+    events = await snapshot.update(values)
+    assert [(e.type, e.key) for e in events] == [(EventType.ADDED, i) for i in range(5)]
+
+    writes = []
+    pipeline = cache.aredis.pipeline
+
+    def recording_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        hset = pipe.hset
+        pipe.hset = lambda key, mapping: writes.append(sorted(mapping)) or hset(key, mapping=mapping)
+        return pipe
+
+    monkeypatch.setattr(cache.aredis, "pipeline", recording_pipeline)
+    values = [WatcherType(key=5, data={"build": 5})] + values[:2] + [WatcherType(key=2, data={"build": -2})]
+    events = await snapshot.update(values)
+    assert [(e.type, e.key) for e in events] == [
+        (EventType.DELETED, 3), (EventType.DELETED, 4),
+        (EventType.ADDED, 5), (EventType.MODIFIED, 2),
+        ]
+    assert events[0].value == WatcherType(key=3, data={"build": 3})
+    assert writes == [[2, 5], [2, 5]]
+
+    # another replica sees the same values, in the same order
+    follower = Snapshot("test:{w}")
+    await follower.load()
+    assert [e.value for e in follower.events()] == values
+    assert await follower.update(values) == []
+
+
+@pytest.mark.anyio
+async def test_subscribers_resume_from_their_last_event(cache):
+    watcher = Watcher("versions", 3600, Upstream().get_versions, (), {})
+    values = [WatcherType(key=i, data={"build": i}) for i in range(5)]
+    added = await watcher.snapshot.update(values)
+    seq = added[-1].seq
+    assert [e.seq for e in added] == list(range(seq - 4, seq + 1))
+
+    modified = await watcher.snapshot.update(values[:4] + [WatcherType(key=4, data={"build": -4})])
+    assert [(e.type, e.key, e.seq) for e in modified] == [(EventType.MODIFIED, 4, seq + 1)]
+
+    # on another replica: only the missed change
+    subscription = Subscription(since=seq)
+    await Watcher("versions", 3600, Upstream().get_versions, (), {}).replay(subscription)
+    [event] = await receive(subscription, 1)
+    assert (event.type, event.key, event.seq) == (EventType.MODIFIED, 4, seq + 1)
+    assert len(subscription) == 0
+
+    # from another history
+    subscription = Subscription(since=seq + 2)
+    await watcher.replay(subscription)
+    assert (await receive(subscription, 1))[0].type == EventType.INFO
+
+    # more changes than items: a reset, then the snapshot
+    subscription = Subscription(since=seq - 5)
+    await watcher.replay(subscription)
+    events = await receive(subscription, 6)
+    assert (events[0].type, events[0].value) == (EventType.INFO, {"reset": True})
+    assert [e.key for e in events[1:]] == list(range(5))
+    assert {e.seq for e in events} == {seq + 1}
+
+    # the events dispatched during a replay come after it, without duplicates
+    subscription = Subscription(since=seq)
+    with subscription.replaying():
+        for event in modified + [Event(_type=EventType.DELETED, key=3, value=values[3], seq=seq + 2)]:
+            subscription.put(event)
+        subscription.replay(modified, seq + 1)
+    assert [(e.type, e.seq) for e in await receive(subscription, 2)] == [
+        (EventType.MODIFIED, seq + 1), (EventType.DELETED, seq + 2),
+        ]
+
+
+@pytest.mark.anyio
+async def test_polls_are_capped_and_interactive_ones_go_first():
+    scheduler = PollScheduler(concurrency=2, budget=0, jitter=0, startup_spread=0)
+    running, started = 0, []
+    gate = anyio.Event()
+
+    async def poll(name: str):
+        nonlocal running
+        async with scheduler.turn(name):
+            running += 1
+            started.append(name)
+            assert running <= 2
+            await gate.wait()
+            running -= 1
+
+    for name in "abcd":
+        scheduler.register(name, 3600, has_values=True)
+    async with anyio.create_task_group() as tg:
+        for name in "abcd":
+            tg.start_soon(poll, name)
+        await anyio.sleep(0.05)
+        assert len(started) == 2
+        waiting = sorted(set("abcd") - set(started))
+        scheduler.request(waiting[1])
+        gate.set()
+    assert started[2] == waiting[1]
+
+    # then every hour
+    assert scheduler._entries["a"].priority != INTERACTIVE
+    assert 3599 < scheduler._entries["a"].due - time.monotonic() <= 3600
+    for name in "abcd":
+        scheduler.unregister(name)
+
+
+@pytest.mark.anyio
+async def test_polls_are_rate_budgeted():
+    scheduler = PollScheduler(concurrency=10, budget=60, jitter=0, startup_spread=0)  # bursts of 1
+    started = []
+
+    async def poll(name: str):
+        async with scheduler.turn(name):
+            started.append(name)
+
+    for name in "ab":
+        scheduler.register(name, 3600, has_values=False)
+    async with anyio.create_task_group() as tg:
+        for name in "ab":
+            tg.start_soon(poll, name)
+        await anyio.sleep(0.1)
+        assert len(started) == 1  # the next token comes in a minute
+        tg.cancel_scope.cancel()
+    for name in "ab":
+        scheduler.unregister(name)
+
+
+def event(_type: EventType, key: int, build: int) -> Event:
+    return Event(_type=_type, key=key, value=WatcherType(key=key, data={"build": build}))
+
+
+@pytest.mark.anyio
+async def test_slow_subscribers_get_the_latest_state():
+    watcher = Watcher("versions", 3600, Upstream().get_versions, (), {})
+    slow, fast = Subscription(max_size=3), Subscription(max_size=3)
+    watcher.streams = {slow, fast}
+
+    events = [
+        event(EventType.ADDED, 1, 1),
+        event(EventType.ADDED, 2, 2),
+        event(EventType.MODIFIED, 1, 10),
+        event(EventType.DELETED, 2, 2),
+        event(EventType.MODIFIED, 1, 100),
+        ]
+    for e in events[:3]:
+        await watcher.dispatch_event(e)  # never waits for the subscribers
+    assert await receive(fast, 3) == events[:3]
+    for e in events[3:]:
+        await watcher.dispatch_event(e)
+    assert await receive(fast, 2) == events[3:]
+
+    # coalesced once it had more than 3 events pending
+    assert [(e.type, e.key, e.value.data) for e in await receive(slow, 2)] == [
+        (EventType.ADDED, 1, {"build": 100}),
+        (EventType.DELETED, 2, {"build": 2}),
+        ]
+    assert len(slow) == 0
+
+
+@pytest.mark.anyio
+async def test_coalesced_events_keep_their_sequence_number():
+    subscription = Subscription(max_size=1)
+    for seq, (_type, build) in enumerate([(EventType.ADDED, 1), (EventType.MODIFIED, 2)], 1):
+        subscription.put(event(_type, 1, build).copy(update={"seq": seq}))
+    for seq, (_type, build) in enumerate([(EventType.DELETED, 1), (EventType.ADDED, 2)], 1):
+        subscription.put(event(_type, 2, build).copy(update={"seq": 2 + seq}))
+
+    # a subscriber resuming after these events must start from the last one
+    assert [(e.type, e.key, e.seq) for e in await receive(subscription, 2)] == [
+        (EventType.ADDED, 1, 2),
+        (EventType.MODIFIED, 2, 4),
+        ]
+
+
+@pytest.mark.anyio
+async def test_lagging_subscribers_are_disconnected():
+    subscription = Subscription(max_lag=0.05)
+    assert subscription.put(event(EventType.ADDED, 1, 1))
+    await anyio.sleep(0.1)
+    assert not subscription.put(event(EventType.MODIFIED, 1, 2))
+    assert subscription.disconnected and len(subscription) == 0
+    with pytest.raises(SlowSubscriber):
+        await receive(subscription, 1)
+
+
+@pytest.mark.anyio
+async def test_watchers_poll_by_activity_tier(cache):
+    tiers = Tiers(hot_window=900, cold_window=86400, cold_max_subscribers=1, hot_factor=1 / 12,
+                  cold_factor=4, min_interval=60, max_interval=6 * 3600)
+    now = time.time()
+    assert tiers.tier(now - 60, None, 1) == HOT
+    assert tiers.tier(None, now - 60, 1) == HOT
+    assert tiers.tier(now - 3600, None, 1) == WARM
+    assert tiers.tier(None, None, 1) == COLD
+    assert tiers.tier(None, None, 2) == WARM  # still watched by several users
+    assert tiers.interval(HOT, 3600) == 300
+    assert tiers.interval(HOT, 300) == 60
+    assert tiers.interval(COLD, 3600) == 4 * 3600
+    assert tiers.interval(COLD, 3 * 3600) == 6 * 3600
+
+    # webhooks received by another replica count
+    await record_webhook("my-repo")
+    assert now <= await cache.aredis.zscore(f"{cache.prefix}activity:webhooks", "my-repo")
+    assert await last_webhook("other-repo") is None
+
+    # moving to a shorter interval brings the next poll closer
+    scheduler = PollScheduler(jitter=0, startup_spread=0)
+    scheduler.register("w", 3600, has_values=True)
+    scheduler._entries["w"].due = time.monotonic() + 3600  # polled just now
+    scheduler.reschedule("w", 300)
+    assert 299 < scheduler._entries["w"].due - time.monotonic() <= 300
+    scheduler.unregister("w")
+
+
+@pytest.mark.anyio
+async def test_notifications_are_debounced():
+    scheduler = Scheduler(debounce={"cd": 0.1, "repositories": 0})
+    refreshes = []
+
+    class Refreshed:
+        def __init__(self, identity: tuple):
+            scheduler.watchers[stable_digest(identity)] = self
+            self.identity = identity
+
+        async def request_refresh(self, fetch: bool = False):
+            refreshes.append(self.identity)
+
+    Refreshed(("cd", "repo")), Refreshed(("repositories", "session"))
+
+    # the webhooks of a merge
+    for _ in range(4):
+        await scheduler.notify(("cd", "repo"))
+        await anyio.sleep(0.03)
+    assert refreshes == []
+    await anyio.sleep(0.15)
+    assert refreshes == [("cd", "repo")]
+
+    # not debounced
+    await scheduler.notify(("repositories", "session"))
+    assert refreshes == [("cd", "repo"), ("repositories", "session")]
+
+
+@pytest.mark.anyio
+async def test_incomplete_webhooks_are_debounced():
+    scheduler = Scheduler(debounce={"cd": 0.1})
+    identity = ("cd", "repo")
+
+    async def fetch_configs(fetch: bool = False):
+        return []
+
+    watcher = Watcher(stable_digest(identity), 3600, fetch_configs, (), {},
+                      patcher=lambda values, event_key, payload: (values, False),
+                      notify=functools.partial(scheduler.notify, identity))
+    watcher.is_leader = True
+    scheduler.watchers[stable_digest(identity)] = watcher
+    refreshes = []
+    watcher.refresh = refreshes.append
+
+    # the webhooks of a merge
+    for _ in range(4):
+        await scheduler.patch(identity, "repo:push", {})
+    assert refreshes == []
+    await anyio.sleep(0.15)
+    assert refreshes == [True]
+
+
+@pytest.mark.anyio
+async def test_polls_overtaken_by_a_webhook_are_discarded(cache, polls):
+    fetching, release = anyio.Event(), anyio.Event()
+    calls = []
+
+    async def get_versions(fetch: bool = False):
+        calls.append(fetch)
+        if len(calls) == 1:
+            fetching.set()
+            await release.wait()
+            return [{"version": "1.0"}]
+        return [{"version": "1.1"}]
+
+    watcher = Watcher("versions", 3600, get_versions, (), {},
+                      patcher=lambda values, event_key, payload: (
+                          standardize_watcher_values([{"version": "1.1"}]), True))
+    watcher.is_leader = True
+    poller.register(watcher, 3600, has_values=False)
+    polled = []
+    try:
+        async with anyio.create_task_group() as tg:
+            async def poll():
+                polled.append(await watcher.poll())
+
+            tg.start_soon(poll)
+            await fetching.wait()
+            await watcher.patch("repo:push", {})
+            release.set()
+
+        # the poll started before the webhook: its values are older than the patched ones
+        assert polled == [[]]
+        assert [v.data for v in watcher.snapshot.values.values()] == [{"version": "1.1"}]
+        with anyio.fail_after(2):
+            assert await watcher.poll() == []
+        assert calls == [False, True]
+    finally:
+        poller.unregister(watcher)
+
+
+def push(branch: str, message: str) -> dict:
+    target = {
+        "hash": "c0ffee",
+        "date": "2022-06-01T12:00:00+00:00",
+        "author": {"raw": "Jane <jane@example.com>", "user": {"display_name": "Jane"}},
+        }
+    commits = [{"hash": "c0ffee", "message": message}]
+    return {"push": {"changes": [{"new": {"type": "branch", "name": branch, "target": target},
+                                  "commits": commits, "truncated": False}]}}
+
+
+@pytest.mark.anyio
+async def test_webhooks_patch_the_cd_config(cache):
+    plugin = BitbucketCloud.__new__(BitbucketCloud)
+    plugin.cd_pullrequest_tag = "[CD]"
+    plugin.cd_environments = [
+        EnvironmentConfiguration(name="master", branch="master", version={"git": True}),
+        EnvironmentConfiguration(name="dev", branch="deploy/dev", version={"file": "version.txt"},
+                                 trigger={"pullrequest": True}),
+        ]
+    configs = [
+        EnvironmentConfig(key=stable_hash(("repo", branch)), environment=name, version="1.0",
+                          author="John", date="2022-01-01T00:00:00+00:00")
+        for name, branch in (("master", "master"), ("dev", "deploy/dev"))
+        ]
+
+    class Plugin:
+        @cache_async(ttl=timedelta(minutes=1), tags=["repo:{repo_slug}"])
+        async def get_configs(self, repo_slug: str):
+            return configs
+
+    notified = []
+
+    async def notify():
+        notified.append(True)
+
+    fetch_configs = Plugin().get_configs
+    watcher = Watcher("cd", 3600, fetch_configs, ("repo",), {},
+                      patcher=functools.partial(plugin.patch_continuous_deployment_config, "repo"),
+                      notify=notify)
+    watcher.is_leader = True
+    await fetch_configs("repo")
+    assert await cache.get_async(watcher.func_cache_key) is not None
+    await watcher.snapshot.update(configs)
+    subscription = Subscription()
+    watcher.streams.add(subscription)
+
+    # the version is in the payload: nothing to fetch, the cached configs are dropped
+    await watcher.patch("repo:push", push("deploy/dev", "deploy version 1.1\n"))
+    [event] = await receive(subscription, 1)
+    assert event.type == EventType.MODIFIED
+    assert (event.value.version, event.value.author) == ("1.1", "Jane")
+    assert await cache.get_async(watcher.func_cache_key) is None
+    assert not watcher.bypass_func_cache and not notified and len(poller._interactive) == 0
+
+    # any other commit may have changed the version file
+    await watcher.patch("repo:push", push("deploy/dev", "fix the version"))
+    assert len(subscription) == 0  # same author and date
+    assert notified == [True] and not watcher.bypass_func_cache
+
+    pullrequest = {"pullrequest": {
+        "title": "Upgrade dev [CD]",
+        "destination": {"branch": {"name": "deploy/dev"}},
+        "links": {"html": {"href": "https://bitbucket.org/team/repo/pull-requests/1"}},
+        }}
+    await watcher.patch("pullrequest:created", pullrequest)
+    [event] = await receive(subscription, 1)
+    assert event.value.pullrequest == "https://bitbucket.org/team/repo/pull-requests/1"
+    await watcher.patch("pullrequest:fulfilled", pullrequest)
+    [event] = await receive(subscription, 1)
+    assert event.value.pullrequest is None
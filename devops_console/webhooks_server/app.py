@@ -10,6 +10,7 @@ from devops_console.clients.client import CoreClient
 from devops_console.clients.wscom import manager as ws_manager
 from devops_console.sccs.context import Context
 from devops_console.sccs.plugins.cache_keys import cache_key_fns
+from devops_console.sccs.realtime.activity import record_webhook
 from devops_console.sccs.redis import RedisCache
 from devops_console.sccs.utils import repo_slug_from_full_name
 from ..schemas.webhooks import (
@@ -56,6 +57,11 @@ async def handle_webhook_event(request: Request):
 
     logging.debug(f"Webhook body: {json.dumps(body)}")
 
+    # the watchers of an active repository poll more often (see realtime.activity)
+    full_name = (body.get("repository") or {}).get("full_name")
+    if isinstance(full_name, str) and "/" in full_name:
+        await record_webhook(repo_slug_from_full_name(full_name))
+
     match event_key:
         case WebhookEventKey.repo_push:
             await handle_repo_push(event=body)
@@ -103,17 +109,26 @@ async def handle_repo_push(event: dict):
     except ValidationError as e:
         validation_exception_handler(e)
 
+    repo_slug = repo_slug_from_full_name(repopushevent.repository.full_name)
     await ws_manager.broadcast(f"repo:push:{repopushevent.repository.name}", legacy=True)
+    await patch_cd_watcher(repo_slug, WebhookEventKey.repo_push, event)
 
 
-def clear_cd_cache(repo_slug: str):
-    pass
+async def clear_cd_cache(repo_slug: str):
     key = cache_key_fns["get_continuous_deployment_config"](repo_slug, None)
-    cache.delete(key)
+    await cache.delete_async(key)
     # key = "watcher:get_continuous_deployment_config"
     # cache.delete_namespace(key)
 
 
+async def patch_cd_watcher(repo_slug: str, event_key: WebhookEventKey, event: dict):
+    """Apply the webhook to the CD config watcher right away, instead of fetching the whole
+    configuration again (only done when the payload isn't enough)."""
+    await core.sccs.core.scheduler.patch(
+        (Context.UUID_WATCH_CONTINOUS_DEPLOYMENT_CONFIG, repo_slug), event_key.value, event
+        )
+
+
 async def handle_repo_build_created(event: dict):
     logging.info('Handling "repo:build_created" webhook event')
 
@@ -139,11 +154,9 @@ async def handle_repo_build_updated(event: dict):
     full_name = repobuildstatusupdated.repository.full_name
     repo_slug = repo_slug_from_full_name(full_name)
 
-    clear_cd_cache(repo_slug)
+    await clear_cd_cache(repo_slug)
     await ws_manager.broadcast(f"pr:updated:{repo_slug}", legacy=True)
-    await core.sccs.core.scheduler.notify(
-        (Context.UUID_WATCH_CONTINOUS_DEPLOYMENT_CONFIG, repo_slug)
-        )
+    await patch_cd_watcher(repo_slug, WebhookEventKey.repo_build_updated, event)
 
     # TODO: get environment from commit status. For now we'll do without it on the
     #  receiving end
@@ -162,8 +175,9 @@ async def handle_pr_created(event: dict):
     full_name = prcreated.repository.full_name
     repo_slug = repo_slug_from_full_name(full_name)
 
-    clear_cd_cache(repo_slug)
+    await clear_cd_cache(repo_slug)
     await ws_manager.broadcast(f"pr:created:{prcreated.repository.name}", legacy=True)
+    await patch_cd_watcher(repo_slug, WebhookEventKey.pr_created, event)
 
 
 async def handle_pr_updated(event: dict):
@@ -175,7 +189,9 @@ async def handle_pr_updated(event: dict):
     except ValidationError as e:
         validation_exception_handler(e)
 
+    repo_slug = repo_slug_from_full_name(prupdated.repository.full_name)
     await ws_manager.broadcast(f"pr:updated:{prupdated.repository.name}", legacy=True)
+    await patch_cd_watcher(repo_slug, WebhookEventKey.pr_updated, event)
 
 
 async def handle_pr_merged(event: dict):
@@ -190,8 +206,9 @@ async def handle_pr_merged(event: dict):
     full_name = prmerged.repository.full_name
     repo_slug = repo_slug_from_full_name(full_name)
 
-    clear_cd_cache(repo_slug)
+    await clear_cd_cache(repo_slug)
     await ws_manager.broadcast(f"pr:merged:{prmerged.repository.name}", legacy=True)
+    await patch_cd_watcher(repo_slug, WebhookEventKey.pr_merged, event)
 
 
 async def handle_pr_approved(event: dict):
@@ -218,5 +235,6 @@ async def handle_pr_declined(event: dict):
     full_name = prdeclined.repository.full_name
     repo_slug = repo_slug_from_full_name(full_name)
 
-    clear_cd_cache(repo_slug)
+    await clear_cd_cache(repo_slug)
     await ws_manager.broadcast(f"pr:declined:{prdeclined.repository.name}", legacy=True)
+    await patch_cd_watcher(repo_slug, WebhookEventKey.pr_declined, event)